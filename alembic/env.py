@@ -8,8 +8,9 @@ from alembic import context
 # Import Base and models to ensure Alembic detects them
 from app.db import Base
 from app.models import (
-    User, Vehicle, DriverLocation, Geofence, Trip,
-    IntermediateDestination, Notification, DelayReport
+    User, Vehicle, DriverLocation, DriverLocationHistory, Geofence, Trip,
+    IntermediateDestination, Notification, DelayReport, ScheduledTimer, Facility,
+    GeocodedAddress
 )  # Import all models explicitly for Alembic to detect them
 
 # This is the Alembic Config object, which provides access to .ini file values.
@@ -0,0 +1,32 @@
+"""Trip source and intermediate stop coordinates
+
+Revision ID: 0b7e5a9c2d18
+Revises: f2c86d1a3e57
+Create Date: 2026-10-18 16:02:47.318204
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0b7e5a9c2d18'
+down_revision: Union[str, None] = 'f2c86d1a3e57'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('trips', sa.Column('source_lat', sa.Float(), nullable=True))
+    op.add_column('trips', sa.Column('source_lng', sa.Float(), nullable=True))
+    op.add_column('intermediate_destinations', sa.Column('latitude', sa.Float(), nullable=True))
+    op.add_column('intermediate_destinations', sa.Column('longitude', sa.Float(), nullable=True))
+
+
+def downgrade() -> None:
+    op.drop_column('intermediate_destinations', 'longitude')
+    op.drop_column('intermediate_destinations', 'latitude')
+    op.drop_column('trips', 'source_lng')
+    op.drop_column('trips', 'source_lat')
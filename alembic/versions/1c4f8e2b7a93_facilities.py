@@ -0,0 +1,37 @@
+"""Facilities
+
+Revision ID: 1c4f8e2b7a93
+Revises: 0b7e5a9c2d18
+Create Date: 2026-10-18 16:41:09.552817
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '1c4f8e2b7a93'
+down_revision: Union[str, None] = '0b7e5a9c2d18'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table('facilities',
+                    sa.Column('id', sa.Integer(), nullable=False),
+                    sa.Column('name', sa.String(length=100), nullable=False),
+                    sa.Column('latitude', sa.Float(), nullable=False),
+                    sa.Column('longitude', sa.Float(), nullable=False),
+                    sa.Column('created_at', sa.DateTime(), nullable=True),
+                    sa.PrimaryKeyConstraint('id')
+                    )
+    op.create_index(op.f('ix_facilities_id'), 'facilities', ['id'], unique=False)
+    op.create_index(op.f('ix_facilities_name'), 'facilities', ['name'], unique=True)
+
+
+def downgrade() -> None:
+    op.drop_index(op.f('ix_facilities_name'), table_name='facilities')
+    op.drop_index(op.f('ix_facilities_id'), table_name='facilities')
+    op.drop_table('facilities')
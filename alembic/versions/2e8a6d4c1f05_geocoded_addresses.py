@@ -0,0 +1,38 @@
+"""Geocoded addresses
+
+Revision ID: 2e8a6d4c1f05
+Revises: 1c4f8e2b7a93
+Create Date: 2026-10-18 17:20:33.104562
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '2e8a6d4c1f05'
+down_revision: Union[str, None] = '1c4f8e2b7a93'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table('geocoded_addresses',
+                    sa.Column('id', sa.Integer(), nullable=False),
+                    sa.Column('address', sa.String(length=255), nullable=False),
+                    sa.Column('latitude', sa.Float(), nullable=False),
+                    sa.Column('longitude', sa.Float(), nullable=False),
+                    sa.Column('source', sa.String(length=50), nullable=False),
+                    sa.Column('created_at', sa.DateTime(), nullable=True),
+                    sa.PrimaryKeyConstraint('id')
+                    )
+    op.create_index(op.f('ix_geocoded_addresses_id'), 'geocoded_addresses', ['id'], unique=False)
+    op.create_index(op.f('ix_geocoded_addresses_address'), 'geocoded_addresses', ['address'], unique=True)
+
+
+def downgrade() -> None:
+    op.drop_index(op.f('ix_geocoded_addresses_address'), table_name='geocoded_addresses')
+    op.drop_index(op.f('ix_geocoded_addresses_id'), table_name='geocoded_addresses')
+    op.drop_table('geocoded_addresses')
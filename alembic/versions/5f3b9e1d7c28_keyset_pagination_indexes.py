@@ -0,0 +1,33 @@
+"""Keyset pagination indexes
+
+Revision ID: 5f3b9e1d7c28
+Revises: 2e8a6d4c1f05
+Create Date: 2026-10-18 18:02:47.381920
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '5f3b9e1d7c28'
+down_revision: Union[str, None] = '2e8a6d4c1f05'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # The composite indexes also serve every lookup the single-column ones did
+    op.create_index('ix_trips_vehicle_id_id', 'trips', ['vehicle_id', 'id'], unique=False)
+    op.drop_index(op.f('ix_trips_vehicle_id'), table_name='trips')
+    op.create_index('ix_delay_reports_driver_id_id', 'delay_reports', ['driver_id', 'id'], unique=False)
+    op.drop_index(op.f('ix_delay_reports_driver_id'), table_name='delay_reports')
+
+
+def downgrade() -> None:
+    op.create_index(op.f('ix_delay_reports_driver_id'), 'delay_reports', ['driver_id'], unique=False)
+    op.drop_index('ix_delay_reports_driver_id_id', table_name='delay_reports')
+    op.create_index(op.f('ix_trips_vehicle_id'), 'trips', ['vehicle_id'], unique=False)
+    op.drop_index('ix_trips_vehicle_id_id', table_name='trips')
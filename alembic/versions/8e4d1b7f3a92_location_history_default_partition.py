@@ -0,0 +1,37 @@
+"""Location history default partition
+
+Revision ID: 8e4d1b7f3a92
+Revises: 5f3b9e1d7c28
+Create Date: 2026-10-19 10:14:05.527316
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.sql import text
+
+
+# revision identifiers, used by Alembic.
+revision: str = '8e4d1b7f3a92'
+down_revision: Union[str, None] = '5f3b9e1d7c28'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Fixes of days without a daily partition land here instead of failing the whole insert
+    conn = op.get_bind()
+    if conn.dialect.name != "postgresql":
+        return
+    conn.execute(text(
+        "CREATE TABLE IF NOT EXISTS driver_location_history_default "
+        "PARTITION OF driver_location_history DEFAULT"
+    ))
+
+
+def downgrade() -> None:
+    conn = op.get_bind()
+    if conn.dialect.name != "postgresql":
+        return
+    conn.execute(text("DROP TABLE IF EXISTS driver_location_history_default"))
@@ -0,0 +1,52 @@
+"""Location history
+
+Revision ID: a91c3e5f2b10
+Revises: 6d2c73e2a45f
+Create Date: 2026-10-18 09:12:40.118204
+
+"""
+from typing import Sequence, Union
+from datetime import datetime, timedelta
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.sql import text
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'a91c3e5f2b10'
+down_revision: Union[str, None] = '6d2c73e2a45f'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Append-only history, range partitioned by day on recorded_at
+    op.create_table(
+        'driver_location_history',
+        sa.Column('driver_id', sa.Integer(), nullable=False),
+        sa.Column('recorded_at', sa.DateTime(), nullable=False),
+        sa.Column('latitude', sa.Float(precision=24), nullable=False),
+        sa.Column('longitude', sa.Float(precision=24), nullable=False),
+        sa.PrimaryKeyConstraint('driver_id', 'recorded_at'),
+        postgresql_partition_by='RANGE (recorded_at)',
+    )
+
+    # Partitions for the next few days; the app creates the rest as it runs.
+    # Other databases get a plain table.
+    conn = op.get_bind()
+    if conn.dialect.name != "postgresql":
+        return
+    today = datetime.utcnow().date()
+    for offset in range(-1, 4):
+        day = today + timedelta(days=offset)
+        conn.execute(text(
+            f"CREATE TABLE IF NOT EXISTS driver_location_history_p{day:%Y%m%d} "
+            f"PARTITION OF driver_location_history "
+            f"FOR VALUES FROM ('{day:%Y-%m-%d}') TO ('{day + timedelta(days=1):%Y-%m-%d}')"
+        ))
+
+
+def downgrade() -> None:
+    # Dropping the parent drops every partition with it
+    op.drop_table('driver_location_history')
@@ -0,0 +1,30 @@
+"""Geofence shapes
+
+Revision ID: b52e8d1c7a04
+Revises: a91c3e5f2b10
+Create Date: 2026-10-18 10:03:17.524391
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b52e8d1c7a04'
+down_revision: Union[str, None] = 'a91c3e5f2b10'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Existing fences are all circles
+    op.add_column('geofences', sa.Column('shape', sa.String(length=20),
+                  server_default='circle', nullable=False))
+    op.add_column('geofences', sa.Column('polygon', sa.Text(), nullable=True))
+
+
+def downgrade() -> None:
+    op.drop_column('geofences', 'polygon')
+    op.drop_column('geofences', 'shape')
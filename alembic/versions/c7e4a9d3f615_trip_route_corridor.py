@@ -0,0 +1,28 @@
+"""Trip route and corridor
+
+Revision ID: c7e4a9d3f615
+Revises: b52e8d1c7a04
+Create Date: 2026-10-18 11:26:48.107352
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c7e4a9d3f615'
+down_revision: Union[str, None] = 'b52e8d1c7a04'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('trips', sa.Column('route_details', sa.JSON(), nullable=True))
+    op.add_column('trips', sa.Column('corridor_geofence_ids', sa.JSON(), nullable=True))
+
+
+def downgrade() -> None:
+    op.drop_column('trips', 'corridor_geofence_ids')
+    op.drop_column('trips', 'route_details')
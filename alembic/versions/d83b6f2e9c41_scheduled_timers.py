@@ -0,0 +1,41 @@
+"""Scheduled timers
+
+Revision ID: d83b6f2e9c41
+Revises: c7e4a9d3f615
+Create Date: 2026-10-18 12:14:09.631857
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'd83b6f2e9c41'
+down_revision: Union[str, None] = 'c7e4a9d3f615'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table('scheduled_timers',
+                    sa.Column('id', sa.Integer(), nullable=False),
+                    sa.Column('kind', sa.String(length=50), nullable=False),
+                    sa.Column('key', sa.String(length=100), nullable=False),
+                    sa.Column('payload', sa.JSON(), nullable=True),
+                    sa.Column('due_at', sa.DateTime(), nullable=False),
+                    sa.Column('lease_owner', sa.String(length=64), nullable=True),
+                    sa.Column('lease_expires_at', sa.DateTime(), nullable=True),
+                    sa.Column('created_at', sa.DateTime(), nullable=True),
+                    sa.PrimaryKeyConstraint('id'),
+                    sa.UniqueConstraint('kind', 'key', name='uq_scheduled_timer_kind_key')
+                    )
+    op.create_index(op.f('ix_scheduled_timers_id'), 'scheduled_timers', ['id'], unique=False)
+    op.create_index(op.f('ix_scheduled_timers_due_at'), 'scheduled_timers', ['due_at'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index(op.f('ix_scheduled_timers_due_at'), table_name='scheduled_timers')
+    op.drop_index(op.f('ix_scheduled_timers_id'), table_name='scheduled_timers')
+    op.drop_table('scheduled_timers')
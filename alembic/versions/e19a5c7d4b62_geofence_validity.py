@@ -0,0 +1,31 @@
+"""Geofence validity windows
+
+Revision ID: e19a5c7d4b62
+Revises: d83b6f2e9c41
+Create Date: 2026-10-18 13:02:45.280914
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e19a5c7d4b62'
+down_revision: Union[str, None] = 'd83b6f2e9c41'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Existing fences stay valid indefinitely
+    op.add_column('geofences', sa.Column('valid_from', sa.DateTime(), nullable=True))
+    op.add_column('geofences', sa.Column('valid_until', sa.DateTime(), nullable=True))
+    op.create_index(op.f('ix_geofences_valid_until'), 'geofences', ['valid_until'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index(op.f('ix_geofences_valid_until'), table_name='geofences')
+    op.drop_column('geofences', 'valid_until')
+    op.drop_column('geofences', 'valid_from')
@@ -0,0 +1,28 @@
+"""Trip destination coordinates
+
+Revision ID: f2c86d1a3e57
+Revises: e19a5c7d4b62
+Create Date: 2026-10-18 13:48:21.774630
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'f2c86d1a3e57'
+down_revision: Union[str, None] = 'e19a5c7d4b62'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('trips', sa.Column('destination_lat', sa.Float(), nullable=True))
+    op.add_column('trips', sa.Column('destination_lng', sa.Float(), nullable=True))
+
+
+def downgrade() -> None:
+    op.drop_column('trips', 'destination_lng')
+    op.drop_column('trips', 'destination_lat')
@@ -0,0 +1,252 @@
+import os
+import threading
+import time
+from bisect import bisect_left
+from math import cos, radians
+import numpy as np
+from sqlalchemy.orm import Session
+from app import models
+from app.geometry import KM_PER_DEGREE_LAT, distances_outside, project_onto_polyline
+from app.spatial import geofence_index, GEOFENCE_INDEX_TTL_SECONDS
+from app.utils import calculate_distance, calculate_distances
+
+# Fences whose boundary lies within this distance of the route belong to the corridor
+TRIP_CORRIDOR_BUFFER_KM = float(os.getenv("TRIP_CORRIDOR_BUFFER_KM", "1.0"))
+# Number of upcoming corridor fences tested on every fix, besides the current one
+TRIP_CORRIDOR_LOOKAHEAD = int(os.getenv("TRIP_CORRIDOR_LOOKAHEAD", "3"))
+# Route segments searched from the driver's last position before searching the whole route
+TRIP_CORRIDOR_SEARCH_SEGMENTS = 16
+
+ACTIVE_TRIP_STATUSES = (models.TripStatus.ASSIGNED, models.TripStatus.IN_ROUTE)
+
+
+def path_coordinates(path):
+    """Turn a route path into an (n, 2) array of (lat, lng) points."""
+    points = []
+    for point in path or []:
+        if isinstance(point, dict):
+            lat = point.get("lat", point.get("latitude"))
+            lng = point.get("lng", point.get("longitude"))
+        else:
+            lat, lng = point[0], point[1]
+        points.append((float(lat), float(lng)))
+    return np.array(points, dtype=np.float64).reshape(-1, 2)
+
+
+def route_offsets(line):
+    """Distance (km) from the start of the route to each of its vertices."""
+    lengths = calculate_distances(line[:-1, 0], line[:-1, 1], line[1:, 0], line[1:, 1])
+    return np.concatenate([[0.0], np.cumsum(lengths)])
+
+
+def along_route(lats, lngs, line, offsets):
+    """Distance (km) of many points from the route and how far along the route they lie."""
+    distances, segments, fractions = project_onto_polyline(lats, lngs, line)
+    along = offsets[segments] + fractions * (offsets[segments + 1] - offsets[segments])
+    return distances, along
+
+
+def compute_corridor(path, index=geofence_index, buffer_km=TRIP_CORRIDOR_BUFFER_KM):
+    """Return the ids of the fences along a route, in the order the route reaches them."""
+    line = path_coordinates(path)
+    if len(line) < 2:
+        return []
+
+    candidates = index.fences_near_path(line[:, 0], line[:, 1], buffer_km)
+    if not candidates:
+        return []
+
+    # Bounding circles are close enough to decide corridor membership and order
+    distances, along = along_route(
+        [f.latitude for f in candidates], [f.longitude for f in candidates], line, route_offsets(line))
+    corridor = [
+        (along_km, fence.id)
+        for fence, distance, along_km in zip(candidates, distances, along)
+        if distance <= fence.radius + buffer_km
+    ]
+    return [fence_id for _, fence_id in sorted(corridor)]
+
+
+class Corridor:
+    """
+    The route of one trip and the fences along it.
+
+    A fence is passed once the driver is further along the route than the far
+    side of its buffered radius; only the first unpassed fences are tested.
+    Per-fix work is plain Python over a handful of segments and fences, which
+    is faster than numpy at these sizes.
+    """
+
+    def __init__(self, trip_id, driver_id, geofence_ids, path, index, buffer_km):
+        self.trip_id = trip_id
+        self.driver_id = driver_id
+        self.geofence_ids = list(geofence_ids)
+        self.buffer_km = buffer_km
+        self.line = path_coordinates(path)
+        offsets = route_offsets(self.line)
+
+        # Route vertices projected to kilometers, as in app.geometry.project_onto_polyline
+        self.scale_x = KM_PER_DEGREE_LAT * cos(radians(self.line[:, 0].mean()))
+        self.ys = (self.line[:, 0] * KM_PER_DEGREE_LAT).tolist()
+        self.xs = (self.line[:, 1] * self.scale_x).tolist()
+        self.offsets = offsets.tolist()
+
+        # Fence entries are copied from this version of the index, they are
+        # rebuilt once it changes so edited or expired fences are not kept
+        self.index_version = index.version
+        fences = [index.get(fence_id) for fence_id in geofence_ids]
+        self.fences = [fence for fence in fences if fence is not None]
+        passed_at = []
+        if self.fences:
+            _, along = along_route(
+                [f.latitude for f in self.fences], [f.longitude for f in self.fences], self.line, offsets)
+            passed_at = along + np.array([f.radius for f in self.fences]) + buffer_km
+        # Running maximum, so the first unpassed fence can be found with bisect
+        self.passed_by = np.maximum.accumulate(passed_at).tolist() if len(passed_at) else []
+        # Route segment of the last fix on the route
+        self.segment = 0
+
+    def progress(self, lat, lng):
+        """How far along the route (km) a fix lies, None when it is off the route."""
+        py, px = lat * KM_PER_DEGREE_LAT, lng * self.scale_x
+        ys, xs = self.ys, self.xs
+        best, best_segment, best_t = None, 0, 0.0
+        last = min(self.segment + TRIP_CORRIDOR_SEARCH_SEGMENTS, len(ys) - 1)
+        for i in range(self.segment, last):
+            ay, ax = ys[i], xs[i]
+            dy, dx = ys[i + 1] - ay, xs[i + 1] - ax
+            length_sq = dx * dx + dy * dy
+            t = ((px - ax) * dx + (py - ay) * dy) / length_sq if length_sq else 0.0
+            t = min(max(t, 0.0), 1.0)
+            distance_sq = (px - ax - t * dx) ** 2 + (py - ay - t * dy) ** 2
+            if best is None or distance_sq < best:
+                best, best_segment, best_t = distance_sq, i, t
+
+        if best is None or best > self.buffer_km ** 2:
+            # Long gap between fixes, or the driver turned back: search the whole route
+            distance, segments, fractions = project_onto_polyline([lat], [lng], self.line)
+            if distance[0] > self.buffer_km:
+                return None
+            best_segment, best_t = int(segments[0]), float(fractions[0])
+
+        self.segment = best_segment
+        offsets = self.offsets
+        return offsets[best_segment] + best_t * (offsets[best_segment + 1] - offsets[best_segment])
+
+    def window(self, progress, lookahead):
+        first = bisect_left(self.passed_by, progress)
+        return self.fences[first:first + lookahead + 1]
+
+
+class TripCorridorCache:
+    """
+    Corridors of every active trip, keyed by trip and by driver.
+
+    For a driver following their route, a fix is only tested against the next
+    few fences of the corridor. Fixes off the route are left to the full index.
+    """
+
+    def __init__(self, index=geofence_index, lookahead=TRIP_CORRIDOR_LOOKAHEAD,
+                 buffer_km=TRIP_CORRIDOR_BUFFER_KM, ttl_seconds=GEOFENCE_INDEX_TTL_SECONDS):
+        self.index = index
+        self.lookahead = lookahead
+        self.buffer_km = buffer_km
+        self.ttl_seconds = ttl_seconds
+        self._by_trip = {}
+        self._by_driver = {}
+        self._loaded_at = None
+        self._index_version = None
+        self._lock = threading.Lock()
+
+    def set(self, trip_id, driver_id, geofence_ids, path):
+        with self._lock:
+            self._set(trip_id, driver_id, geofence_ids, path)
+
+    def _set(self, trip_id, driver_id, geofence_ids, path):
+        self._discard(trip_id)
+        if driver_id is None or not geofence_ids or len(path or []) < 2:
+            return
+        corridor = Corridor(trip_id, driver_id, geofence_ids, path, self.index, self.buffer_km)
+        self._by_trip[trip_id] = corridor
+        self._by_driver[driver_id] = corridor
+
+    def discard(self, trip_id):
+        with self._lock:
+            self._discard(trip_id)
+
+    def _discard(self, trip_id):
+        corridor = self._by_trip.pop(trip_id, None)
+        if corridor and self._by_driver.get(corridor.driver_id) is corridor:
+            del self._by_driver[corridor.driver_id]
+
+    def has_driver(self, driver_id):
+        return driver_id in self._by_driver
+
+    def ensure_loaded(self, db: Session):
+        """
+        Load the corridors of active trips, again after the TTL so other
+        workers' changes show up, and whenever the geofence index was rebuilt.
+        """
+        loaded_at = self._loaded_at
+        if (loaded_at is not None and time.monotonic() - loaded_at <= self.ttl_seconds
+                and self._index_version == self.index.version):
+            return
+        index_version = self.index.version
+        trips = db.query(
+            models.Trip.id, models.Trip.driver_id,
+            models.Trip.corridor_geofence_ids, models.Trip.route_details,
+        ).filter(
+            models.Trip.status.in_(ACTIVE_TRIP_STATUSES),
+            models.Trip.corridor_geofence_ids.isnot(None),
+        ).all()
+
+        with self._lock:
+            active = {trip_id for trip_id, _, _, _ in trips}
+            for trip_id in [t for t in self._by_trip if t not in active]:
+                self._discard(trip_id)
+            for trip_id, driver_id, geofence_ids, route in trips:
+                current = self._by_trip.get(trip_id)
+                if current is None or current.driver_id != driver_id or current.geofence_ids != geofence_ids:
+                    self._set(trip_id, driver_id, geofence_ids, (route or {}).get("path"))
+                elif current.index_version != self.index.version:
+                    self._set(trip_id, driver_id, geofence_ids, (route or {}).get("path"))
+                    # Same route, so the driver's progress still applies
+                    if trip_id in self._by_trip:
+                        self._by_trip[trip_id].segment = current.segment
+            self._loaded_at = time.monotonic()
+            self._index_version = index_version
+
+    def nearby(self, driver_id, lat, lng, margin_km=0.0):
+        """
+        Same contract as GeofenceIndex.nearby, restricted to the next fences of
+        the driver's corridor. Returns None when the driver has no corridor or
+        is off the route.
+        """
+        corridor = self._by_driver.get(driver_id)
+        if corridor is None:
+            return None
+        progress = corridor.progress(lat, lng)
+        if progress is None:
+            return None
+
+        results = []
+        for fence in corridor.window(progress, self.lookahead):
+            if fence.polygon is None:
+                outside = max(calculate_distance(lat, lng, fence.latitude, fence.longitude) - fence.radius, 0.0)
+            else:
+                outside = float(distances_outside(
+                    [lat], [lng], fence.latitude, fence.longitude, fence.radius, fence.polygon)[0])
+            if outside <= margin_km:
+                results.append((fence, outside))
+        return results
+
+
+def refresh_trip_corridor(db: Session, trip: models.Trip):
+    """Recompute a trip's corridor from its route and cache it with the trip."""
+    path = (trip.route_details or {}).get("path")
+    geofence_index.ensure_fresh(db)
+    trip.corridor_geofence_ids = compute_corridor(path)
+    trip_corridors.set(trip.id, trip.driver_id, trip.corridor_geofence_ids, path)
+
+
+trip_corridors = TripCorridorCache()
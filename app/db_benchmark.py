@@ -0,0 +1,153 @@
+"""
+python -m app.db_benchmark: throughput of the hot endpoints under concurrency.
+
+Runs the app in process through an ASGI client against a scratch SQLite
+database. Every statement waits BENCH_LATENCY_SECONDS to stand in for the
+round trip to a remote database. SQLite's trace callback runs on the thread
+executing the statement: the event loop for a sync session, aiosqlite's
+connection thread for an AsyncSession, so a blocked event loop shows up as
+lost throughput like it does on Postgres.
+
+The script also runs against trees from before the async engine: check the
+older commit out into a worktree, copy this file into its app/ directory
+and run it there to get the numbers to compare against.
+"""
+import os
+import tempfile
+
+# The app reads its configuration at import time
+_scratch = tempfile.mkdtemp(prefix="drivelogix-bench-")
+os.environ["DATABASE_URL"] = f"sqlite:///{_scratch}/bench.db"
+os.environ.setdefault("FACILITY_MATRIX_DIR", os.path.join(_scratch, "facility_matrix"))
+os.environ.setdefault("REDIS_PORT", "6379")
+os.environ.setdefault("REDIS_PORT_NOTIFICATION", "6379")
+os.environ.setdefault("SECRET_KEY", "bench-secret")
+
+import asyncio  # noqa: E402
+import threading  # noqa: E402
+import time  # noqa: E402
+from datetime import datetime, timedelta  # noqa: E402
+import httpx  # noqa: E402
+from sqlalchemy import event  # noqa: E402
+from app import db as database, models  # noqa: E402
+from app.main import app  # noqa: E402
+from app.utils import create_access_token  # noqa: E402
+
+# Time every statement waits, a round trip to a database on another host
+BENCH_LATENCY_SECONDS = float(os.getenv("BENCH_LATENCY_SECONDS", "0.002"))
+# Concurrent requests per run, and requests per run
+BENCH_CONCURRENCY = [int(c) for c in os.getenv("BENCH_CONCURRENCY", "1,12,32").split(",")]
+BENCH_REQUESTS = int(os.getenv("BENCH_REQUESTS", "400"))
+# Sync sessions deadlock once concurrent requests outnumber pool connections,
+# the benchmark stops when a run takes longer than this
+BENCH_RUN_TIMEOUT_SECONDS = float(os.getenv("BENCH_RUN_TIMEOUT_SECONDS", "25"))
+
+DRIVERS = 200
+VEHICLES = 20
+ADMIN_PHONE = "+910000000000"
+
+
+def seed():
+    """Drivers with a position and an hour of history, and vehicles with trips."""
+    models.Base.metadata.create_all(database.engine)
+    db = database.SessionLocal()
+    now = datetime.utcnow()
+    db.add(models.User(id=DRIVERS + 1, name="admin", email="admin@bench", phone_number=ADMIN_PHONE,
+                       password="x", role=models.UserRole.ADMIN))
+    for i in range(1, DRIVERS + 1):
+        db.add(models.User(id=i, name=f"driver {i}", email=f"driver{i}@bench", phone_number=f"+91{i:010d}",
+                           password="x", role=models.UserRole.DRIVER))
+    for i in range(1, VEHICLES + 1):
+        db.add(models.Vehicle(id=i, vehicle_number=f"KA-{i}", total_tonnage=10, remaining_tonnage=10))
+    db.flush()
+    for i in range(1, DRIVERS + 1):
+        db.add(models.DriverLocation(driver_id=i, latitude=12.9, longitude=77.6, timestamp=now))
+        for minutes in range(20):
+            db.add(models.DriverLocationHistory(driver_id=i, latitude=12.9, longitude=77.6,
+                                                recorded_at=now - timedelta(minutes=3 * minutes)))
+    for i in range(DRIVERS):
+        db.add(models.Trip(source="Depot", destination="Customer", vehicle_id=i % VEHICLES + 1,
+                           driver_id=i + 1, tonnage=1, status=models.TripStatus.IN_ROUTE))
+    db.commit()
+    db.close()
+
+
+def wait(statement):
+    time.sleep(BENCH_LATENCY_SECONDS)
+
+
+def add_latency():
+    event.listen(database.engine, "connect", lambda conn, record: conn.set_trace_callback(wait))
+    database.engine.dispose()
+    async_engine = getattr(database, "async_engine", None)
+    if async_engine is None:
+        return
+
+    def on_connect(conn, record):
+        # The callback is set from aiosqlite's thread, which owns the sqlite3 connection
+        connection = conn._connection
+        conn.await_(connection._execute(connection._conn.set_trace_callback, wait))
+    event.listen(async_engine.sync_engine, "connect", on_connect)
+
+
+async def run(client, request, concurrency, total):
+    """Send total requests, concurrency at a time. Returns req/s and p50 and p99 latency in ms."""
+    latencies = []
+    slots = asyncio.Semaphore(concurrency)
+
+    async def one(i):
+        async with slots:
+            started = time.perf_counter()
+            response = await request(client, i)
+            assert response.status_code < 300, (response.status_code, response.text[:200])
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(total)))
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    return total / elapsed, latencies[len(latencies) // 2] * 1000, latencies[int(len(latencies) * 0.99)] * 1000
+
+
+def stalled(name, concurrency):
+    print(f"{name:36s} c={concurrency:<3d} no progress in {BENCH_RUN_TIMEOUT_SECONDS:g}s, stopping", flush=True)
+    os._exit(1)
+
+
+async def main():
+    headers = {"Authorization": f"Bearer {create_access_token({'sub': ADMIN_PHONE, 'role': 'admin'})}"}
+    start = (datetime.utcnow() - timedelta(hours=2)).isoformat()
+    end = (datetime.utcnow() + timedelta(hours=1)).isoformat()
+    endpoints = {
+        "POST /driver-location/location/": lambda client, i: client.post(
+            "/driver-location/location/", headers=headers,
+            json={"user_id": i % DRIVERS + 1, "latitude": 12.9, "longitude": 77.6}),
+        "GET  /driver-location/history/{id}/": lambda client, i: client.get(
+            f"/driver-location/history/{i % DRIVERS + 1}/", headers=headers, params={"start": start, "end": end}),
+        "GET  /trips/{vehicle_id}": lambda client, i: client.get(
+            f"/trips/{i % VEHICLES + 1}", headers=headers),
+    }
+
+    print(f"{'async' if hasattr(database, 'async_engine') else 'sync'} sessions, "
+          f"{BENCH_LATENCY_SECONDS * 1000:g} ms per statement, {BENCH_REQUESTS} requests per run", flush=True)
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench") as client:
+        for request in endpoints.values():
+            # Warm up pools and caches
+            await run(client, request, 1, 20)
+        for concurrency in BENCH_CONCURRENCY:
+            for name, request in endpoints.items():
+                # A deadlocked sync stack blocks the event loop, only another thread can notice
+                watchdog = threading.Timer(BENCH_RUN_TIMEOUT_SECONDS, stalled, (name, concurrency))
+                watchdog.start()
+                rps, p50, p99 = await run(client, request, concurrency, BENCH_REQUESTS)
+                watchdog.cancel()
+                print(f"{name:36s} c={concurrency:<3d} {rps:6.0f} req/s  p50 {p50:6.1f} ms  p99 {p99:6.1f} ms",
+                      flush=True)
+    if hasattr(database, "async_engine"):
+        await database.async_engine.dispose()
+
+
+if __name__ == "__main__":
+    seed()
+    add_latency()
+    asyncio.run(main())
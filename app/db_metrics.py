@@ -0,0 +1,281 @@
+import os
+import re
+import threading
+import time
+from collections import OrderedDict, deque
+from contextvars import ContextVar
+import numpy as np
+from sqlalchemy import event
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+
+# Queries slower than this are logged and kept in the slow-query table
+DB_SLOW_QUERY_MS = float(os.getenv("DB_SLOW_QUERY_MS", "200"))
+# Distinct slow statements kept, least recently seen evicted first
+DB_SLOW_QUERY_LOG_SIZE = int(os.getenv("DB_SLOW_QUERY_LOG_SIZE", "100"))
+# Checkouts that waited longer than this for a connection count as waits
+DB_POOL_WAIT_WARN_MS = float(os.getenv("DB_POOL_WAIT_WARN_MS", "50"))
+# Recent checkout waits kept per pool for the percentiles
+DB_POOL_WAIT_SAMPLES = 2048
+
+# Queries outside any request, e.g. the flushers and the scheduler
+BACKGROUND = "background"
+
+_IN_LIST = re.compile(r"\((?:\s*(?:\?|%s|%\(\w+\)s|\$\d+|:\w+)\s*,)+\s*(?:\?|%s|%\(\w+\)s|\$\d+|:\w+)\s*\)")
+_VALUES_ROWS = re.compile(r"(VALUES\s*\([^()]*\))(?:\s*,\s*\([^()]*\))+", re.IGNORECASE)
+_LITERALS = re.compile(r"'(?:[^']|'')*'|(?<![\w$])\d+(?:\.\d+)?\b")
+
+
+def normalize_sql(statement):
+    """The statement with whitespace collapsed, literals replaced and lists of placeholders folded."""
+    sql = " ".join(statement.split())
+    sql = _LITERALS.sub("?", sql)
+    sql = _IN_LIST.sub("(...)", sql)
+    return _VALUES_ROWS.sub(r"\1, ...", sql)
+
+
+def parameter_shape(parameters, executemany=False):
+    """The types of the bound parameters, never their values: "(int, str)" or "50 x (int, float)"."""
+    if executemany:
+        rows = list(parameters)
+        return f"{len(rows)} x {parameter_shape(rows[0])}" if rows else "0 x ()"
+    if isinstance(parameters, dict):
+        return "(" + ", ".join(f"{key}: {type(value).__name__}" for key, value in parameters.items()) + ")"
+    return "(" + ", ".join(type(value).__name__ for value in parameters or ()) + ")"
+
+
+class RequestQueries:
+    """Queries issued while serving one request."""
+
+    __slots__ = ("scope", "count", "seconds", "slowest")
+
+    def __init__(self, scope):
+        self.scope = scope
+        self.count = 0
+        self.seconds = 0.0
+        self.slowest = 0.0
+
+
+_current_request: ContextVar = ContextVar("db_metrics_request", default=None)
+
+
+def route_label(scope):
+    """The matched route template, so /trips/1 and /trips/2 share an entry."""
+    route = scope.get("route")
+    path = getattr(route, "path", None) or "unmatched"
+    return f"{scope.get('method', 'WS')} {path}"
+
+
+class PoolStats:
+    def __init__(self):
+        self.checkouts = 0
+        self.checkins = 0
+        self.waits = 0
+        self.timeouts = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self.wait_samples = deque(maxlen=DB_POOL_WAIT_SAMPLES)
+
+
+class DatabaseMetrics:
+    """
+    Query and connection pool statistics of this worker.
+
+    Engines are instrumented with instrument_engine(). Queries are timed with
+    cursor events and attributed to the route being served, taken from a
+    context variable set by QueryMetricsMiddleware, which asyncio tasks,
+    threads started with asyncio.to_thread and AsyncSession.run_sync inherit.
+    Checkout waits are measured by the Timed* pool classes.
+    """
+
+    def __init__(self, slow_query_ms=DB_SLOW_QUERY_MS, slow_query_log_size=DB_SLOW_QUERY_LOG_SIZE):
+        self.slow_query_seconds = slow_query_ms / 1000
+        self.slow_query_log_size = slow_query_log_size
+        self._pools = {}
+        self._engines = {}
+        self._routes = {}
+        self._slow = OrderedDict()
+        self._lock = threading.Lock()
+
+    def instrument_engine(self, engine, name):
+        """Time the queries of a (sync) engine and track its pool under the given name."""
+        self._engines[name] = engine
+        self._pools.setdefault(name, PoolStats())
+        event.listen(engine, "before_cursor_execute", self._before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", self._after_cursor_execute)
+        event.listen(engine.pool, "checkout", lambda *args: self._count(name, "checkouts"))
+        event.listen(engine.pool, "checkin", lambda *args: self._count(name, "checkins"))
+
+    def _count(self, name, counter):
+        stats = self._pools[name]
+        with self._lock:
+            setattr(stats, counter, getattr(stats, counter) + 1)
+
+    def record_checkout_wait(self, name, seconds, timed_out=False):
+        stats = self._pools.setdefault(name, PoolStats())
+        with self._lock:
+            stats.wait_samples.append(seconds)
+            stats.wait_seconds += seconds
+            stats.max_wait_seconds = max(stats.max_wait_seconds, seconds)
+            if seconds * 1000 >= DB_POOL_WAIT_WARN_MS:
+                stats.waits += 1
+            if timed_out:
+                stats.timeouts += 1
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        context._db_metrics_started_at = time.perf_counter()
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        seconds = time.perf_counter() - context._db_metrics_started_at
+        request = _current_request.get()
+        if request is not None:
+            request.count += 1
+            request.seconds += seconds
+            request.slowest = max(request.slowest, seconds)
+            route = None
+        else:
+            route = BACKGROUND
+            with self._lock:
+                totals = self._route_totals(BACKGROUND)
+                totals["queries"] += 1
+                totals["query_seconds"] += seconds
+                totals["max_query_seconds"] = max(totals["max_query_seconds"], seconds)
+        if seconds >= self.slow_query_seconds:
+            self._record_slow(statement, parameters, executemany, seconds,
+                              route or route_label(request.scope))
+
+    def _route_totals(self, route):
+        totals = self._routes.get(route)
+        if totals is None:
+            totals = self._routes[route] = {
+                "requests": 0, "queries": 0, "query_seconds": 0.0,
+                "max_queries_per_request": 0, "max_query_seconds": 0.0,
+            }
+        return totals
+
+    def _record_slow(self, statement, parameters, executemany, seconds, route):
+        sql = normalize_sql(statement)
+        shape = parameter_shape(parameters, executemany)
+        print(f"Slow query ({seconds * 1000:.0f} ms, {route}): {sql} {shape}")
+        with self._lock:
+            entry = self._slow.pop(sql, None) or {
+                "sql": sql, "count": 0, "total_ms": 0.0, "max_ms": 0.0, "routes": {}}
+            entry["count"] += 1
+            entry["total_ms"] += seconds * 1000
+            entry["max_ms"] = max(entry["max_ms"], seconds * 1000)
+            entry["last_parameters"] = shape
+            entry["last_seen"] = time.time()
+            entry["routes"][route] = entry["routes"].get(route, 0) + 1
+            self._slow[sql] = entry
+            while len(self._slow) > self.slow_query_log_size:
+                self._slow.popitem(last=False)
+
+    def start_request(self, scope):
+        return _current_request.set(RequestQueries(scope))
+
+    def finish_request(self, token):
+        request = _current_request.get()
+        _current_request.reset(token)
+        with self._lock:
+            totals = self._route_totals(route_label(request.scope))
+            totals["requests"] += 1
+            totals["queries"] += request.count
+            totals["query_seconds"] += request.seconds
+            totals["max_queries_per_request"] = max(totals["max_queries_per_request"], request.count)
+            totals["max_query_seconds"] = max(totals["max_query_seconds"], request.slowest)
+
+    def pool_stats(self):
+        pools = {}
+        for name, engine in self._engines.items():
+            pool, stats = engine.pool, self._pools[name]
+            entry = {
+                "class": type(pool).__name__,
+                "checked_out": stats.checkouts - stats.checkins,
+                "checkouts": stats.checkouts,
+                "waits_over_threshold": stats.waits,
+                "timeouts": stats.timeouts,
+                "max_wait_ms": stats.max_wait_seconds * 1000,
+                "wait_ms": _percentiles(stats.wait_samples),
+            }
+            if isinstance(pool, QueuePool):
+                capacity = pool.size() + max(pool._max_overflow, 0)
+                entry.update({
+                    "size": pool.size(),
+                    "max_overflow": pool._max_overflow,
+                    "idle": pool.checkedin(),
+                    "overflow": max(pool.overflow(), 0),
+                    # Share of the connections the pool may open that are in use, 1.0 means requests queue up
+                    "saturation": pool.checkedout() / capacity if capacity > 0 else 0.0,
+                })
+            pools[name] = entry
+        return pools
+
+    def stats(self):
+        with self._lock:
+            routes = {
+                route: {
+                    **totals,
+                    "query_ms": totals["query_seconds"] * 1000,
+                    "max_query_ms": totals["max_query_seconds"] * 1000,
+                    "queries_per_request": totals["queries"] / totals["requests"] if totals["requests"] else None,
+                }
+                for route, totals in self._routes.items()
+            }
+            slow = sorted(self._slow.values(), key=lambda entry: entry["max_ms"], reverse=True)
+        for totals in routes.values():
+            del totals["query_seconds"], totals["max_query_seconds"]
+        return {
+            "pools": self.pool_stats(),
+            "routes": routes,
+            "slow_query_ms": self.slow_query_seconds * 1000,
+            "slow_queries": [dict(entry, routes=dict(entry["routes"])) for entry in slow],
+        }
+
+
+def _percentiles(samples):
+    if not samples:
+        return {"p50": None, "p95": None, "p99": None}
+    p50, p95, p99 = np.percentile(np.fromiter(samples, dtype=np.float64), [50, 95, 99]) * 1000
+    return {"p50": float(p50), "p95": float(p95), "p99": float(p99)}
+
+
+db_metrics = DatabaseMetrics()
+
+
+class TimedCheckoutMixin:
+    """Measures how long checkouts wait for a free connection, and counts the ones that time out."""
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except PoolTimeoutError:
+            db_metrics.record_checkout_wait(self._orig_logging_name, time.perf_counter() - started, timed_out=True)
+            raise
+        db_metrics.record_checkout_wait(self._orig_logging_name, time.perf_counter() - started)
+        return connection
+
+
+class TimedQueuePool(TimedCheckoutMixin, QueuePool):
+    pass
+
+
+class TimedAsyncQueuePool(TimedCheckoutMixin, AsyncAdaptedQueuePool):
+    pass
+
+
+class QueryMetricsMiddleware:
+    """Attributes the queries issued while serving a request to its route."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] not in ("http", "websocket"):
+            await self.app(scope, receive, send)
+            return
+        token = db_metrics.start_request(scope)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            db_metrics.finish_request(token)
@@ -0,0 +1,208 @@
+import fcntl
+import json
+import os
+import threading
+import numpy as np
+from numpy.lib.format import open_memmap
+from scipy.sparse.csgraph import dijkstra
+from sqlalchemy.orm import Session
+from app import models
+from app.routing import get_road_graph
+from app.utils import calculate_distance_matrix
+
+# Where the matrix lives, shared by every worker on the host
+FACILITY_MATRIX_DIR = os.getenv("FACILITY_MATRIX_DIR", "facility_matrix")
+# Without a road graph: road distance over straight-line distance, and average speed
+FACILITY_DETOUR_FACTOR = float(os.getenv("FACILITY_DETOUR_FACTOR", "1.3"))
+FACILITY_SPEED_KMH = float(os.getenv("FACILITY_SPEED_KMH", "40"))
+# Facilities the matrix file has room for when it is first created
+FACILITY_MATRIX_MIN_CAPACITY = 64
+
+DISTANCE, DURATION = 0, 1
+
+
+def normalize_name(name):
+    return " ".join(str(name).split()).casefold()
+
+
+def leg_matrices(sources, targets):
+    """
+    Distances (km) and travel times (s) from every (lat, lng) in sources to
+    every one in targets, float32. Shortest paths on the road graph when one
+    is configured, straight lines with FACILITY_DETOUR_FACTOR otherwise or
+    for points off the network.
+    """
+    sources, targets = np.asarray(sources, dtype=np.float64), np.asarray(targets, dtype=np.float64)
+    distances = calculate_distance_matrix(sources[:, 0], sources[:, 1], targets[:, 0], targets[:, 1])
+    distances *= FACILITY_DETOUR_FACTOR
+    durations = distances / FACILITY_SPEED_KMH * 3600
+
+    graph = get_road_graph()
+    if graph is not None:
+        source_nodes = np.array([graph.nearest_node(lat, lng) for lat, lng in sources], dtype=object)
+        target_nodes = np.array([graph.nearest_node(lat, lng) for lat, lng in targets], dtype=object)
+        rows = np.flatnonzero(source_nodes != None)  # noqa: E711
+        columns = np.flatnonzero(target_nodes != None)  # noqa: E711
+        if len(rows) and len(columns):
+            starts = source_nodes[rows].astype(np.int64)
+            ends = target_nodes[columns].astype(np.int64)
+            for out, weight in ((distances, "length"), (durations, "time")):
+                matrix = graph.csgraph(weight)
+                # One search per point on the smaller side, backwards when that is the targets
+                if len(ends) < len(starts):
+                    out[np.ix_(rows, columns)] = dijkstra(matrix.T.tocsr(), indices=ends)[:, starts].T
+                else:
+                    out[np.ix_(rows, columns)] = dijkstra(matrix, indices=starts)[:, ends]
+    return distances.astype(np.float32), durations.astype(np.float32)
+
+
+class FacilityMatrix:
+    """
+    Pairwise road distances and travel times between facilities.
+
+    Both matrices live in one float32 .npy file of shape (2, capacity,
+    capacity), memory-mapped read-only by every worker. Row and column i
+    belong to the i-th facility id in meta.json. New facilities only add
+    their rows and columns; the file is rewritten when it runs out of room
+    (capacity doubles) or when facilities are removed or moved. Writers take
+    a file lock, and readers reopen the file when meta.json changes.
+    """
+
+    def __init__(self, directory=FACILITY_MATRIX_DIR):
+        self.directory = directory
+        self._matrix = None
+        self._ids = []
+        self._index = {}
+        self._by_name = {}
+        self._coords = {}
+        self._meta_mtime = None
+        self._lock = threading.Lock()
+
+    @property
+    def _meta_path(self):
+        return os.path.join(self.directory, "meta.json")
+
+    def _matrix_path(self, generation):
+        return os.path.join(self.directory, f"matrix-{generation}.npy")
+
+    def _read_meta(self):
+        try:
+            with open(self._meta_path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {"generation": 0, "capacity": 0, "ids": [], "names": [], "coords": []}
+
+    def _load(self):
+        mtime = os.stat(self._meta_path).st_mtime_ns
+        meta = self._read_meta()
+        matrix = np.load(self._matrix_path(meta["generation"]), mmap_mode="r") if meta["ids"] else None
+        with self._lock:
+            self._matrix = matrix
+            self._ids = meta["ids"]
+            self._index = {facility_id: i for i, facility_id in enumerate(meta["ids"])}
+            self._by_name = {normalize_name(name): facility_id for name, facility_id in zip(meta["names"], meta["ids"])}
+            self._coords = {facility_id: tuple(coords) for facility_id, coords in zip(meta["ids"], meta["coords"])}
+            self._meta_mtime = mtime
+
+    def ensure_fresh(self):
+        """Reopen the matrix when another worker has changed it."""
+        try:
+            mtime = os.stat(self._meta_path).st_mtime_ns
+        except FileNotFoundError:
+            return
+        if mtime != self._meta_mtime:
+            self._load()
+
+    def sync(self, db: Session):
+        """Bring the matrix up to date with the facilities table. Returns how many facilities were added."""
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, "lock"), "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            meta = self._read_meta()
+            facilities = db.query(
+                models.Facility.id, models.Facility.name, models.Facility.latitude, models.Facility.longitude
+            ).order_by(models.Facility.id).all()
+            current = {f.id: f for f in facilities}
+
+            # Removed or moved facilities invalidate their rows, start over
+            rebuild = any(
+                facility_id not in current
+                or [current[facility_id].latitude, current[facility_id].longitude] != list(coords)
+                for facility_id, coords in zip(meta["ids"], meta["coords"])
+            )
+            known = set() if rebuild else set(meta["ids"])
+            kept = [] if rebuild else [current[facility_id] for facility_id in meta["ids"]]
+            added = [f for f in facilities if f.id not in known]
+            if not added and not rebuild:
+                self.ensure_fresh()
+                return 0
+
+            ordered = kept + added
+            count, old_count = len(ordered), len(kept)
+            generation, capacity = meta["generation"], meta["capacity"]
+            if rebuild or count > capacity:
+                capacity = max(FACILITY_MATRIX_MIN_CAPACITY, capacity)
+                while capacity < count:
+                    capacity *= 2
+                generation += 1
+                matrix = open_memmap(self._matrix_path(generation), mode="w+", dtype=np.float32,
+                                     shape=(2, capacity, capacity))
+                if old_count:
+                    previous = np.load(self._matrix_path(meta["generation"]), mmap_mode="r")
+                    matrix[:, :old_count, :old_count] = previous[:, :old_count, :old_count]
+            else:
+                matrix = np.load(self._matrix_path(generation), mmap_mode="r+")
+
+            coords = [(f.latitude, f.longitude) for f in ordered]
+            new_coords = coords[old_count:]
+            # Rows of the new facilities to everything, and columns from the old ones to the new ones
+            distances, durations = leg_matrices(new_coords, coords)
+            matrix[DISTANCE, old_count:count, :count] = distances
+            matrix[DURATION, old_count:count, :count] = durations
+            if old_count:
+                distances, durations = leg_matrices(coords[:old_count], new_coords)
+                matrix[DISTANCE, :old_count, old_count:count] = distances
+                matrix[DURATION, :old_count, old_count:count] = durations
+            matrix.flush()
+            del matrix
+
+            new_meta = {
+                "generation": generation,
+                "capacity": capacity,
+                "ids": [f.id for f in ordered],
+                "names": [f.name for f in ordered],
+                "coords": [list(c) for c in coords],
+            }
+            tmp_path = self._meta_path + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(new_meta, f)
+            os.replace(tmp_path, self._meta_path)
+            if generation != meta["generation"] and meta["ids"]:
+                # Workers that still map the old file keep reading it until they reload
+                os.remove(self._matrix_path(meta["generation"]))
+            self._load()
+            return len(added)
+
+    def __contains__(self, facility_id):
+        return facility_id in self._index
+
+    def find(self, name):
+        """Id of the facility with this name, ignoring case and extra whitespace."""
+        return self._by_name.get(normalize_name(name))
+
+    def coordinates(self, facility_id):
+        return self._coords.get(facility_id)
+
+    def distance_km(self, source_id, destination_id):
+        return float(self._matrix[DISTANCE, self._index[source_id], self._index[destination_id]])
+
+    def duration_s(self, source_id, destination_id):
+        return float(self._matrix[DURATION, self._index[source_id], self._index[destination_id]])
+
+    def submatrix(self, facility_ids, kind=DISTANCE):
+        """Square float64 matrix between the given facilities, in the given order."""
+        positions = [self._index[facility_id] for facility_id in facility_ids]
+        return self._matrix[kind][np.ix_(positions, positions)].astype(np.float64)
+
+
+facility_matrix = FacilityMatrix()
@@ -0,0 +1,183 @@
+import asyncio
+import csv
+import os
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from app import models
+from app.facility_matrix import facility_matrix
+from app.http_client import http_client
+from app.routing import parse_coordinates
+
+# Backend for addresses that are neither coordinates nor facilities: "gazetteer" or "http"
+GEOCODER_BACKEND = os.getenv("GEOCODER_BACKEND", "gazetteer")
+# CSV file with name,latitude,longitude rows, read by the gazetteer backend
+GAZETTEER_PATH = os.getenv("GAZETTEER_PATH", "gazetteer.csv")
+# Geocoding service of the http backend, called as GET ?q=<address>
+GEOCODER_API_URL = os.getenv("GEOCODER_API_URL", "https://example-geocoding-api.com/search")
+# Resolved addresses kept per worker
+GEOCODER_CACHE_SIZE = int(os.getenv("GEOCODER_CACHE_SIZE", "50000"))
+# Addresses per cache-table query, well under the bind parameter limits
+GEOCODER_QUERY_CHUNK = 1000
+
+
+def normalize_address(address):
+    """Lowercase, single-spaced, without surrounding punctuation, so spelling variants share an entry."""
+    return " ".join(str(address).replace(",", " , ").split()).strip(" ,.;").replace(" , ", ", ").casefold()
+
+
+class GazetteerBackend:
+    """Addresses looked up in a local CSV file of name,latitude,longitude rows."""
+
+    name = "gazetteer"
+
+    def __init__(self, path=GAZETTEER_PATH):
+        self.path = path
+        self._places = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        places = {}
+        try:
+            with open(self.path, newline="") as f:
+                for row in csv.DictReader(f):
+                    places[normalize_address(row["name"])] = (float(row["latitude"]), float(row["longitude"]))
+        except FileNotFoundError:
+            print(f"Gazetteer {self.path} not found, addresses are only resolved from facilities")
+        return places
+
+    async def geocode_many(self, addresses):
+        if self._places is None:
+            with self._lock:
+                if self._places is None:
+                    self._places = self._load()
+        return {address: self._places[address] for address in addresses if address in self._places}
+
+
+class HttpBackend:
+    """Addresses looked up one by one in a geocoding service returning {"latitude", "longitude"}."""
+
+    name = "http"
+
+    def __init__(self, url=GEOCODER_API_URL):
+        self.url = url
+
+    async def _geocode(self, address):
+        try:
+            response = await http_client.get(self.url, params={"q": address})
+            response.raise_for_status()
+            data = response.json()
+            return float(data["latitude"]), float(data["longitude"])
+        except Exception as e:
+            print(f"Error geocoding {address}: {e}")
+            return None
+
+    async def geocode_many(self, addresses):
+        results = await asyncio.gather(*(self._geocode(address) for address in addresses))
+        return {address: point for address, point in zip(addresses, results) if point is not None}
+
+
+class Geocoder:
+    """
+    Resolves addresses to (lat, lng).
+
+    Addresses written as "lat,lng" need no lookup. The rest are normalized and
+    looked up in an in-process LRU, then the geocoded_addresses table, then
+    the facilities, and only then the backend. Everything the backend resolves
+    is stored, so an address is geocoded once for all workers. Unresolved
+    addresses are not stored and are retried on the next request.
+    """
+
+    def __init__(self, backend, max_entries=GEOCODER_CACHE_SIZE):
+        self.backend = backend
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _remember(self, found):
+        with self._lock:
+            for address, point in found.items():
+                self._entries[address] = point
+                self._entries.move_to_end(address)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    async def resolve_many(self, db: AsyncSession, addresses):
+        """Map each address to its (lat, lng), or None when it cannot be resolved. The caller commits."""
+        results = {}
+        pending = {}
+        for address in addresses:
+            if address in results or address is None:
+                continue
+            point = parse_coordinates(address)
+            if point is not None:
+                results[address] = point
+                continue
+            key = normalize_address(address)
+            with self._lock:
+                point = self._entries.get(key)
+                if point is not None:
+                    self._entries.move_to_end(key)
+            if point is not None:
+                results[address] = point
+            else:
+                pending.setdefault(key, []).append(address)
+
+        if not pending:
+            return {address: results.get(address) for address in addresses}
+        found = {}
+        missing = list(pending)
+        for start in range(0, len(missing), GEOCODER_QUERY_CHUNK):
+            chunk = missing[start:start + GEOCODER_QUERY_CHUNK]
+            rows = await db.execute(select(
+                models.GeocodedAddress.address, models.GeocodedAddress.latitude, models.GeocodedAddress.longitude
+            ).filter(models.GeocodedAddress.address.in_(chunk)))
+            found.update({row.address: (row.latitude, row.longitude) for row in rows})
+
+        facility_matrix.ensure_fresh()
+        for key in missing:
+            if key not in found:
+                facility_id = facility_matrix.find(key)
+                if facility_id is not None:
+                    found[key] = facility_matrix.coordinates(facility_id)
+
+        unknown = [key for key in missing if key not in found]
+        if unknown:
+            geocoded = await self.backend.geocode_many(unknown)
+            await self._store(db, geocoded)
+            found.update(geocoded)
+
+        self._remember(found)
+        for key, originals in pending.items():
+            for address in originals:
+                results[address] = found.get(key)
+        return {address: results.get(address) for address in addresses}
+
+    async def resolve(self, db: AsyncSession, address):
+        return (await self.resolve_many(db, [address]))[address]
+
+    async def _store(self, db: AsyncSession, geocoded):
+        if not geocoded:
+            return
+        if db.bind.dialect.name == "postgresql":
+            from sqlalchemy.dialects.postgresql import insert
+        else:
+            from sqlalchemy.dialects.sqlite import insert
+        # Another worker may have stored the same address meanwhile
+        stmt = insert(models.GeocodedAddress).on_conflict_do_nothing(
+            index_elements=[models.GeocodedAddress.address])
+        now = datetime.utcnow()
+        await db.execute(stmt, [
+            {"address": address, "latitude": lat, "longitude": lng, "source": self.backend.name, "created_at": now}
+            for address, (lat, lng) in geocoded.items()
+        ])
+
+
+def create_geocoder():
+    backend = HttpBackend() if GEOCODER_BACKEND == "http" else GazetteerBackend()
+    return Geocoder(backend)
+
+
+geocoder = create_geocoder()
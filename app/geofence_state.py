@@ -0,0 +1,173 @@
+import os
+import threading
+from collections import namedtuple
+from datetime import datetime
+from sqlalchemy.orm import Session
+from app import models
+from app.corridor import trip_corridors
+from app.spatial import geofence_index, GEOFENCE_HYSTERESIS_KM
+
+# Consecutive fixes beyond the hysteresis band needed before an exit is reported
+GEOFENCE_EXIT_CONFIRMATIONS = int(os.getenv("GEOFENCE_EXIT_CONFIRMATIONS", "2"))
+
+ENTER = "enter"
+EXIT = "exit"
+DWELL_EXCEEDED = "dwell_exceeded"
+
+GeofenceEvent = namedtuple(
+    "GeofenceEvent", ["kind", "driver_id", "geofence_id", "timestamp", "dwell_seconds"])
+
+
+class Membership:
+    __slots__ = ("entered_at", "time_limit_minutes", "outside_count", "dwell_reported")
+
+    def __init__(self, entered_at, time_limit_minutes):
+        self.entered_at = entered_at
+        self.time_limit_minutes = time_limit_minutes
+        self.outside_count = 0
+        self.dwell_reported = False
+
+
+class GeofenceStateMachine:
+    """
+    Tracks which fences every driver is in and reports only the transitions.
+
+    A driver enters a fence when a fix falls inside its radius. The exit is
+    reported once GEOFENCE_EXIT_CONFIRMATIONS consecutive fixes fall beyond
+    the radius plus the hysteresis band; fixes inside the band change nothing.
+    Staying longer than the fence's time limit is reported once per visit.
+
+    Drivers on a trip with a precomputed corridor are only tested against the
+    next few fences of that corridor instead of the whole index.
+    """
+
+    def __init__(self, index=geofence_index, hysteresis_km=GEOFENCE_HYSTERESIS_KM,
+                 exit_confirmations=GEOFENCE_EXIT_CONFIRMATIONS, corridors=trip_corridors):
+        self.index = index
+        self.corridors = corridors
+        self.hysteresis_km = hysteresis_km
+        self.exit_confirmations = exit_confirmations
+        self._memberships = {}
+        self._last_seen = {}
+        self._lock = threading.Lock()
+
+    def memberships(self, driver_id):
+        """Return {geofence_id: entered_at} for the fences the driver is currently in."""
+        return {fence_id: m.entered_at for fence_id, m in self._memberships.get(driver_id, {}).items()}
+
+    def update(self, driver_id, lat, lng, timestamp):
+        """Apply one fix and return the events it caused."""
+        return self._observe(driver_id, timestamp, self._nearby(driver_id, lat, lng))
+
+    def dwell_exceeded(self, driver_id, lat, lng, timestamp):
+        """
+        The fences the driver is in, within the hysteresis band of the fix,
+        whose time limit had passed at timestamp. Read only: the state only
+        changes with the fixes ingested, so a check never confirms an exit or
+        a dwell a second time.
+        """
+        in_band = {fence.id for fence, _ in self._nearby(driver_id, lat, lng)}
+        with self._lock:
+            memberships = list(self._memberships.get(driver_id, {}).items())
+        return [
+            fence_id for fence_id, membership in memberships
+            if fence_id in in_band
+            and (timestamp - membership.entered_at).total_seconds() > membership.time_limit_minutes * 60
+        ]
+
+    def _nearby(self, driver_id, lat, lng):
+        pairs = self.corridors.nearby(driver_id, lat, lng, self.hysteresis_km)
+        if pairs is None:
+            pairs = self.index.nearby(lat, lng, self.hysteresis_km)
+        return pairs
+
+    def lookup_many(self, positions):
+        """Return the (fence, outside_km) pairs within the hysteresis band of every fix."""
+        results = [
+            self.corridors.nearby(p.driver_id, p.latitude, p.longitude, self.hysteresis_km)
+            if self.corridors.has_driver(p.driver_id) else None
+            for p in positions
+        ]
+        # Drivers without a trip corridor, or off their route, go through the index in one pass
+        rest = [i for i, pairs in enumerate(results) if pairs is None]
+        if rest:
+            pairs = self.index.nearby_many(
+                [positions[i].latitude for i in rest], [positions[i].longitude for i in rest],
+                self.hysteresis_km)
+            for i, nearby in zip(rest, pairs):
+                results[i] = nearby
+        return results
+
+    def update_many(self, positions, nearby=None):
+        """
+        Apply a list of Position fixes and return the events they caused, in
+        order. nearby can pass the result of lookup_many when the caller needs it too.
+        """
+        if nearby is None:
+            nearby = self.lookup_many(positions)
+        events = []
+        for position, pairs in zip(positions, nearby):
+            events.extend(self._observe(position.driver_id, position.timestamp, pairs))
+        return events
+
+    def _observe(self, driver_id, timestamp, nearby):
+        with self._lock:
+            # Fixes older than the newest one seen are stale and must not change the state
+            last_seen = self._last_seen.get(driver_id)
+            if last_seen is not None and timestamp < last_seen:
+                return []
+            self._last_seen[driver_id] = timestamp
+
+            memberships = self._memberships.setdefault(driver_id, {})
+            events = []
+            in_band = set()
+            for fence, outside_km in nearby:
+                in_band.add(fence.id)
+                if outside_km == 0 and fence.id not in memberships:
+                    memberships[fence.id] = Membership(timestamp, fence.time_limit_minutes)
+                    events.append(GeofenceEvent(ENTER, driver_id, fence.id, timestamp, 0))
+
+            for fence_id, membership in list(memberships.items()):
+                dwell_seconds = (timestamp - membership.entered_at).total_seconds()
+                if fence_id in in_band:
+                    membership.outside_count = 0
+                else:
+                    membership.outside_count += 1
+                    if membership.outside_count >= self.exit_confirmations:
+                        del memberships[fence_id]
+                        events.append(GeofenceEvent(EXIT, driver_id, fence_id, timestamp, dwell_seconds))
+                        continue
+
+                if not membership.dwell_reported and dwell_seconds > membership.time_limit_minutes * 60:
+                    membership.dwell_reported = True
+                    events.append(GeofenceEvent(
+                        DWELL_EXCEEDED, driver_id, fence_id, timestamp, dwell_seconds))
+
+            if not memberships:
+                del self._memberships[driver_id]
+            return events
+
+
+EVENT_MESSAGES = {
+    ENTER: "You have entered geofence {geofence_id}.",
+    EXIT: "You have left geofence {geofence_id}.",
+    DWELL_EXCEEDED: "You've exceeded the time limit for geofence {geofence_id}. Please complete the required distance.",
+}
+
+
+def record_geofence_events(db: Session, events):
+    """Store one driver notification per event and commit them together."""
+    if not events:
+        return
+    db.add_all([
+        models.Notification(
+            driver_id=event.driver_id,
+            message=EVENT_MESSAGES[event.kind].format(geofence_id=event.geofence_id),
+            timestamp=datetime.utcnow(),
+        )
+        for event in events
+    ])
+    db.commit()
+
+
+geofence_states = GeofenceStateMachine()
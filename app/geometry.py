@@ -0,0 +1,104 @@
+import numpy as np
+from app.utils import calculate_distances
+
+KM_PER_DEGREE_LAT = 111.32
+
+# Polygons are arrays of shape (k, 2) holding (latitude, longitude) vertices.
+# The ring is closed implicitly, the last vertex connects back to the first.
+
+
+def as_polygon(vertices):
+    polygon = np.asarray(vertices, dtype=np.float64)
+    if polygon.ndim != 2 or polygon.shape[1] != 2 or len(polygon) < 3:
+        raise ValueError("A polygon needs at least three [lat, lng] vertices")
+    return polygon
+
+
+def points_in_polygon(lats, lngs, polygon):
+    """Even-odd ray casting test for many points against one polygon."""
+    lats = np.asarray(lats, dtype=np.float64)[:, None]
+    lngs = np.asarray(lngs, dtype=np.float64)[:, None]
+    y1, x1 = polygon[:, 0], polygon[:, 1]
+    y2, x2 = np.roll(y1, -1), np.roll(x1, -1)
+
+    crosses = (y1 > lats) != (y2 > lats)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        x_at = x1 + (lats - y1) * (x2 - x1) / (y2 - y1)
+    return np.count_nonzero(crosses & (lngs < x_at), axis=1) % 2 == 1
+
+
+def point_in_polygon(lat, lng, polygon):
+    return bool(points_in_polygon([lat], [lng], polygon)[0])
+
+
+def distances_to_polygon_edge(lats, lngs, polygon):
+    """
+    Distance in kilometers from many points to the nearest edge of a polygon,
+    using an equirectangular projection around the polygon (accurate for
+    fences up to a few tens of kilometers across).
+    """
+    lats = np.asarray(lats, dtype=np.float64)[:, None]
+    lngs = np.asarray(lngs, dtype=np.float64)[:, None]
+    scale_x = KM_PER_DEGREE_LAT * np.cos(np.radians(polygon[:, 0].mean()))
+
+    ay, ax = polygon[:, 0] * KM_PER_DEGREE_LAT, polygon[:, 1] * scale_x
+    by, bx = np.roll(ay, -1), np.roll(ax, -1)
+    py, px = lats * KM_PER_DEGREE_LAT, lngs * scale_x
+
+    dx, dy = bx - ax, by - ay
+    length_sq = dx * dx + dy * dy
+    with np.errstate(divide="ignore", invalid="ignore"):
+        t = ((px - ax) * dx + (py - ay) * dy) / length_sq
+    t = np.clip(np.nan_to_num(t), 0.0, 1.0)
+    nearest_x, nearest_y = ax + t * dx, ay + t * dy
+    return np.sqrt((px - nearest_x) ** 2 + (py - nearest_y) ** 2).min(axis=1)
+
+
+def bounding_circle(polygon):
+    """Center of the polygon's bounding box and the radius (km) reaching every vertex."""
+    center_lat = (polygon[:, 0].min() + polygon[:, 0].max()) / 2
+    center_lng = (polygon[:, 1].min() + polygon[:, 1].max()) / 2
+    radius = calculate_distances(center_lat, center_lng, polygon[:, 0], polygon[:, 1]).max()
+    return float(center_lat), float(center_lng), float(radius)
+
+
+def distances_outside(lats, lngs, center_lat, center_lng, radius, polygon=None):
+    """
+    How far (km) each point lies beyond a fence's boundary, 0 for points inside.
+
+    Circles use the exact haversine distance to the center; polygons use ray
+    casting for containment and the distance to the nearest edge otherwise.
+    """
+    if polygon is None:
+        distances = calculate_distances(center_lat, center_lng, lats, lngs)
+        return np.maximum(distances - radius, 0.0)
+
+    outside = distances_to_polygon_edge(lats, lngs, polygon)
+    outside[points_in_polygon(lats, lngs, polygon)] = 0.0
+    return outside
+
+
+def project_onto_polyline(lats, lngs, line):
+    """
+    Project many points onto an open polyline of (lat, lng) vertices. Returns
+    the distance (km) to the polyline, the index of the nearest segment and
+    how far along that segment (0 to 1) the nearest point lies.
+    """
+    lats = np.asarray(lats, dtype=np.float64)[:, None]
+    lngs = np.asarray(lngs, dtype=np.float64)[:, None]
+    scale_x = KM_PER_DEGREE_LAT * np.cos(np.radians(line[:, 0].mean()))
+
+    ys, xs = line[:, 0] * KM_PER_DEGREE_LAT, line[:, 1] * scale_x
+    ay, ax, by, bx = ys[:-1], xs[:-1], ys[1:], xs[1:]
+    py, px = lats * KM_PER_DEGREE_LAT, lngs * scale_x
+
+    dx, dy = bx - ax, by - ay
+    length_sq = dx * dx + dy * dy
+    with np.errstate(divide="ignore", invalid="ignore"):
+        t = ((px - ax) * dx + (py - ay) * dy) / length_sq
+    t = np.clip(np.nan_to_num(t), 0.0, 1.0)
+    distances = np.sqrt((px - (ax + t * dx)) ** 2 + (py - (ay + t * dy)) ** 2)
+
+    segments = distances.argmin(axis=1)
+    rows = np.arange(len(segments))
+    return distances[rows, segments], segments, t[rows, segments]
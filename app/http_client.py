@@ -0,0 +1,174 @@
+import asyncio
+import os
+import random
+import time
+from urllib.parse import urlsplit
+import httpx
+
+# Seconds to wait for a connection, and for the whole response
+HTTP_CONNECT_TIMEOUT_SECONDS = float(os.getenv("HTTP_CONNECT_TIMEOUT_SECONDS", "3"))
+HTTP_TIMEOUT_SECONDS = float(os.getenv("HTTP_TIMEOUT_SECONDS", "10"))
+# Connections pooled by the shared client, and kept open between requests
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "100"))
+HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("HTTP_MAX_KEEPALIVE_CONNECTIONS", "20"))
+# Requests in flight to one host, further requests wait their turn
+HTTP_PER_HOST_CONCURRENCY = int(os.getenv("HTTP_PER_HOST_CONCURRENCY", "10"))
+# Retries after the first attempt, with full jitter on an exponential backoff
+HTTP_RETRIES = int(os.getenv("HTTP_RETRIES", "2"))
+HTTP_BACKOFF_SECONDS = float(os.getenv("HTTP_BACKOFF_SECONDS", "0.2"))
+# Consecutive failed requests that open a host's circuit, and how long it stays open
+HTTP_BREAKER_FAILURES = int(os.getenv("HTTP_BREAKER_FAILURES", "5"))
+HTTP_BREAKER_RESET_SECONDS = float(os.getenv("HTTP_BREAKER_RESET_SECONDS", "30"))
+
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS", "PUT", "DELETE"}
+RETRY_STATUS_CODES = {429, 502, 503, 504}
+# Errors raised before the request reached the server, safe to retry for any method
+NOT_SENT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling a host whose circuit is open."""
+
+
+class CircuitBreaker:
+    """
+    Stops calling a host after HTTP_BREAKER_FAILURES failures in a row. Once
+    the reset time has passed one trial request goes through, and its
+    outcome closes the circuit or opens it again. A trial that never reports
+    back, e.g. because it was canceled, is replaced after another reset time.
+    """
+
+    def __init__(self, failure_threshold=HTTP_BREAKER_FAILURES, reset_seconds=HTTP_BREAKER_RESET_SECONDS):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at = None
+        self._trial_at = None
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if self._trial_at is not None or time.monotonic() - self.opened_at >= self.reset_seconds:
+            return "half-open"
+        return "open"
+
+    def allow(self):
+        state = self.state
+        if state == "closed":
+            return True
+        now = time.monotonic()
+        if state == "half-open" and (self._trial_at is None or now - self._trial_at >= self.reset_seconds):
+            self._trial_at = now
+            return True
+        return False
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self._trial_at = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self._trial_at is not None or self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+        self._trial_at = None
+
+
+class OutboundClient:
+    """
+    The shared client for every outbound integration.
+
+    One pooled httpx.AsyncClient keeps connections alive between requests.
+    Each host gets its own concurrency limit and circuit breaker, so a slow or
+    failing provider cannot use up the pool of the others. Failed attempts are
+    retried with jittered backoff; non-idempotent requests only when they never
+    reached the server. Pass a transport (e.g. httpx.MockTransport) to test
+    without a network, or point the integration URLs at a local fake server.
+    """
+
+    def __init__(self, transport=None, timeout_seconds=HTTP_TIMEOUT_SECONDS,
+                 connect_timeout_seconds=HTTP_CONNECT_TIMEOUT_SECONDS, per_host_concurrency=HTTP_PER_HOST_CONCURRENCY,
+                 retries=HTTP_RETRIES, backoff_seconds=HTTP_BACKOFF_SECONDS):
+        self.transport = transport
+        self.timeout = httpx.Timeout(timeout_seconds, connect=connect_timeout_seconds)
+        self.per_host_concurrency = per_host_concurrency
+        self.retries = retries
+        self.backoff_seconds = backoff_seconds
+        self._client = None
+        self._semaphores = {}
+        self._breakers = {}
+
+    def _get_client(self):
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                timeout=self.timeout,
+                limits=httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS,
+                                    max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS),
+                transport=self.transport,
+            )
+        return self._client
+
+    def breaker(self, host):
+        if host not in self._breakers:
+            self._breakers[host] = CircuitBreaker()
+        return self._breakers[host]
+
+    async def request(self, method, url, idempotent=None, **kwargs):
+        """
+        Send a request and return the httpx.Response. 429, 502, 503 and 504
+        responses are retried like errors and returned once retries run out;
+        every 5xx or 429 response counts against the host's circuit. Raises
+        CircuitOpenError while the circuit is open.
+        """
+        method = method.upper()
+        if idempotent is None:
+            idempotent = method in IDEMPOTENT_METHODS
+        host = urlsplit(url).netloc
+        breaker = self.breaker(host)
+        if not breaker.allow():
+            raise CircuitOpenError(f"Circuit open for {host}")
+        if host not in self._semaphores:
+            self._semaphores[host] = asyncio.Semaphore(self.per_host_concurrency)
+
+        async with self._semaphores[host]:
+            attempt = 0
+            while True:
+                try:
+                    response = await self._get_client().request(method, url, **kwargs)
+                except httpx.HTTPError as e:
+                    retryable = idempotent or isinstance(e, NOT_SENT_ERRORS)
+                    if not retryable or attempt >= self.retries:
+                        breaker.record_failure()
+                        raise
+                else:
+                    failed = response.status_code >= 500 or response.status_code == 429
+                    if not failed or not idempotent or attempt >= self.retries \
+                            or response.status_code not in RETRY_STATUS_CODES:
+                        if failed:
+                            breaker.record_failure()
+                        else:
+                            breaker.record_success()
+                        return response
+                    await response.aclose()
+                attempt += 1
+                await asyncio.sleep(random.uniform(0, self.backoff_seconds * 2 ** attempt))
+
+    async def get(self, url, **kwargs):
+        return await self.request("GET", url, **kwargs)
+
+    async def post(self, url, **kwargs):
+        return await self.request("POST", url, **kwargs)
+
+    def stats(self):
+        return {host: {"state": breaker.state, "failures": breaker.failures}
+                for host, breaker in self._breakers.items()}
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+        self._semaphores.clear()
+
+
+http_client = OutboundClient()
@@ -0,0 +1,116 @@
+import struct
+import numpy as np
+
+# Binary location frames sent by the driver app over the WebSocket.
+#
+# All fields are little-endian:
+#   header  <BBH   version, flags (reserved, 0), number of fixes N >= 1
+#   base    <iiI   latitude and longitude in micro-degrees, unix time in seconds
+#   N - 1 x <hhH   change in latitude and longitude (micro-degrees) and seconds
+#                  elapsed, each relative to the previous fix
+#
+# A frame with 30 fixes is 4 + 12 + 29 * 6 = 190 bytes.
+
+FRAME_VERSION = 1
+COORD_SCALE = 1_000_000
+
+HEADER = struct.Struct("<BBH")
+BASE = struct.Struct("<iiI")
+DELTA_DTYPE = np.dtype([("dlat", "<i2"), ("dlng", "<i2"), ("dt", "<u2")])
+
+INT16_MIN, INT16_MAX = -32768, 32767
+UINT16_MAX = 65535
+MAX_FIXES_PER_FRAME = 65535
+
+
+class FrameError(ValueError):
+    pass
+
+
+def encode_frames(fixes):
+    """
+    Encode (latitude, longitude, unix_seconds) tuples into as few frames as
+    possible. A new frame is started whenever a delta does not fit in 16 bits.
+    """
+    frames = []
+    base = None
+    deltas = []
+    previous = None
+
+    def close_frame():
+        frames.append(
+            HEADER.pack(FRAME_VERSION, 0, len(deltas) + 1)
+            + BASE.pack(*base)
+            + b"".join(struct.pack("<hhH", *d) for d in deltas)
+        )
+
+    for lat, lng, timestamp in fixes:
+        current = (round(lat * COORD_SCALE), round(lng * COORD_SCALE), int(timestamp))
+        if previous is not None:
+            delta = (current[0] - previous[0], current[1] - previous[1], current[2] - previous[2])
+            if (INT16_MIN <= delta[0] <= INT16_MAX and INT16_MIN <= delta[1] <= INT16_MAX
+                    and 0 <= delta[2] <= UINT16_MAX and len(deltas) + 1 < MAX_FIXES_PER_FRAME):
+                deltas.append(delta)
+                previous = current
+                continue
+            close_frame()
+        base = current
+        deltas = []
+        previous = current
+
+    if base is not None:
+        close_frame()
+    return frames
+
+
+def decode_frame(data):
+    """Decode one frame into arrays of latitudes, longitudes and unix timestamps."""
+    if len(data) < HEADER.size + BASE.size:
+        raise FrameError("Frame too short")
+    version, _, count = HEADER.unpack_from(data)
+    if version != FRAME_VERSION:
+        raise FrameError(f"Unsupported frame version {version}")
+    if count < 1:
+        raise FrameError("Frame has no fixes")
+    expected = HEADER.size + BASE.size + (count - 1) * DELTA_DTYPE.itemsize
+    if len(data) != expected:
+        raise FrameError(f"Frame length {len(data)} does not match {count} fixes")
+
+    base_lat, base_lng, base_time = BASE.unpack_from(data, HEADER.size)
+    deltas = np.frombuffer(data, dtype=DELTA_DTYPE, count=count - 1,
+                           offset=HEADER.size + BASE.size)
+
+    lats = np.empty(count, dtype=np.int64)
+    lngs = np.empty(count, dtype=np.int64)
+    times = np.empty(count, dtype=np.int64)
+    lats[0], lngs[0], times[0] = base_lat, base_lng, base_time
+    np.cumsum(deltas["dlat"], out=lats[1:], dtype=np.int64)
+    np.cumsum(deltas["dlng"], out=lngs[1:], dtype=np.int64)
+    np.cumsum(deltas["dt"], out=times[1:], dtype=np.int64)
+    lats[1:] += base_lat
+    lngs[1:] += base_lng
+    times[1:] += base_time
+
+    return lats / COORD_SCALE, lngs / COORD_SCALE, times
+
+
+if __name__ == "__main__":
+    # python -m app.location_frames: decode throughput of 30-fix frames
+    import time
+
+    rng = np.random.default_rng(0)
+    frames = []
+    for _ in range(1000):
+        # A driver reporting every 2 seconds for a minute, moving up to ~50 m per fix
+        steps = rng.uniform(-0.0005, 0.0005, (30, 2)).cumsum(axis=0)
+        start = int(time.time())
+        fixes = [(19.0 + dlat, 72.8 + dlng, start + 2 * i) for i, (dlat, dlng) in enumerate(steps)]
+        frames.extend(encode_frames(fixes))
+    print(f"{len(frames)} frames of {len(frames[0])} bytes")
+
+    for _ in range(3):
+        started = time.perf_counter()
+        for frame in frames:
+            decode_frame(frame)
+        elapsed = time.perf_counter() - started
+        print(f"{elapsed / len(frames) * 1e6:.1f} us per frame, {len(frames) * 30 / elapsed:,.0f} fixes/s")
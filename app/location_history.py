@@ -0,0 +1,218 @@
+import asyncio
+import os
+import threading
+import time
+from collections import deque
+from datetime import datetime, timedelta
+from sqlalchemy import text
+from sqlalchemy.exc import DataError, DBAPIError, IntegrityError
+from sqlalchemy.orm import Session
+from app.db import SessionLocal
+from app.models import DriverLocationHistory
+
+LOCATION_HISTORY_FLUSH_INTERVAL_SECONDS = float(
+    os.getenv("LOCATION_HISTORY_FLUSH_INTERVAL_SECONDS", "1"))
+LOCATION_HISTORY_BATCH_SIZE = int(
+    os.getenv("LOCATION_HISTORY_BATCH_SIZE", "10000"))
+# Oldest fixes are dropped once this many are waiting, so a database outage
+# cannot exhaust the worker's memory
+LOCATION_HISTORY_MAX_BUFFER = int(
+    os.getenv("LOCATION_HISTORY_MAX_BUFFER", "500000"))
+LOCATION_HISTORY_RETENTION_DAYS = int(
+    os.getenv("LOCATION_HISTORY_RETENTION_DAYS", "90"))
+LOCATION_HISTORY_PARTITIONS_AHEAD = int(
+    os.getenv("LOCATION_HISTORY_PARTITIONS_AHEAD", "3"))
+LOCATION_HISTORY_MAINTENANCE_SECONDS = 3600
+# Fixes stamped further ahead of the server clock than this are rejected at ingest
+LOCATION_MAX_CLOCK_SKEW_SECONDS = float(
+    os.getenv("LOCATION_MAX_CLOCK_SKEW_SECONDS", "300"))
+
+TABLE = DriverLocationHistory.__tablename__
+# Holds the fixes of days without a daily partition, e.g. late gateway uploads
+DEFAULT_PARTITION = f"{TABLE}_default"
+
+
+def partition_name(day):
+    return f"{TABLE}_p{day:%Y%m%d}"
+
+
+def timestamp_window(now=None):
+    """
+    The oldest and newest fix timestamps accepted at ingest: the retention
+    window up to the allowed clock skew. Anything else is a bad client clock.
+    """
+    now = now or datetime.utcnow()
+    return (now - timedelta(days=LOCATION_HISTORY_RETENTION_DAYS),
+            now + timedelta(seconds=LOCATION_MAX_CLOCK_SKEW_SECONDS))
+
+
+def ensure_partitions(db: Session, start_day, days_ahead=LOCATION_HISTORY_PARTITIONS_AHEAD):
+    """
+    Create the daily partitions from start_day up to days_ahead days later,
+    and the default partition.
+    """
+    db.execute(text(f"CREATE TABLE IF NOT EXISTS {DEFAULT_PARTITION} PARTITION OF {TABLE} DEFAULT"))
+    for offset in range(days_ahead + 1):
+        day = start_day + timedelta(days=offset)
+        # Fails when the default partition already holds fixes of that day,
+        # which then stay there, the other days are still created
+        try:
+            with db.begin_nested():
+                db.execute(text(
+                    f"CREATE TABLE IF NOT EXISTS {partition_name(day)} PARTITION OF {TABLE} "
+                    f"FOR VALUES FROM ('{day:%Y-%m-%d}') TO ('{day + timedelta(days=1):%Y-%m-%d}')"
+                ))
+        except DBAPIError as e:
+            print(f"Could not create location history partition for {day}: {e.orig}")
+
+
+def drop_expired_partitions(db: Session, today, retention_days=LOCATION_HISTORY_RETENTION_DAYS):
+    """
+    Drop whole daily partitions older than the retention window and return
+    their names. Expired fixes in the default partition are deleted.
+    """
+    cutoff_day = today - timedelta(days=retention_days)
+    cutoff = partition_name(cutoff_day)
+    rows = db.execute(text(
+        "SELECT child.relname FROM pg_inherits "
+        "JOIN pg_class parent ON pg_inherits.inhparent = parent.oid "
+        "JOIN pg_class child ON pg_inherits.inhrelid = child.oid "
+        "WHERE parent.relname = :table"
+    ), {"table": TABLE}).scalars().all()
+
+    # Partition names sort in date order, so a string comparison is enough
+    expired = sorted(name for name in rows if name.startswith(f"{TABLE}_p") and name < cutoff)
+    for name in expired:
+        db.execute(text(f"DROP TABLE IF EXISTS {name}"))
+    db.execute(text(f"DELETE FROM {DEFAULT_PARTITION} WHERE recorded_at < :cutoff"),
+               {"cutoff": datetime.combine(cutoff_day, datetime.min.time())})
+    return expired
+
+
+def insert_history(db: Session, positions):
+    """
+    Append positions with one multi-row INSERT, skipping fixes already stored,
+    i.e. any with the timestamp of a stored fix of the same driver.
+    """
+    if not positions:
+        return
+    if db.bind.dialect.name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+
+    stmt = insert(DriverLocationHistory).on_conflict_do_nothing()
+    db.execute(stmt, [
+        {"driver_id": p.driver_id, "recorded_at": p.timestamp,
+            "latitude": p.latitude, "longitude": p.longitude}
+        for p in positions
+    ])
+
+
+class LocationHistoryWriter:
+    """
+    Buffers fixes from the ingest endpoints and appends them in bulk.
+
+    Appending only touches an in-memory deque, so recording history adds no
+    database work to the request that updates the latest position.
+    """
+
+    def __init__(self, flush_interval=LOCATION_HISTORY_FLUSH_INTERVAL_SECONDS,
+                 batch_size=LOCATION_HISTORY_BATCH_SIZE, max_buffer=LOCATION_HISTORY_MAX_BUFFER):
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self._buffer = deque(maxlen=max_buffer)
+        self._lock = threading.Lock()
+        self._task = None
+        self._maintained_at = None
+
+    def append(self, positions):
+        with self._lock:
+            if len(self._buffer) + len(positions) > self._buffer.maxlen:
+                print("Location history buffer full, dropping oldest fixes")
+            self._buffer.extend(positions)
+
+    def pending_count(self):
+        return len(self._buffer)
+
+    def flush(self, db: Session):
+        """Write everything buffered so far in batches and return the number of fixes written."""
+        written = 0
+        while True:
+            with self._lock:
+                count = min(self.batch_size, len(self._buffer))
+                batch = [self._buffer.popleft() for _ in range(count)]
+            if not batch:
+                return written
+
+            try:
+                written += self._write(db, batch)
+            except Exception:
+                db.rollback()
+                # Rows already written are skipped as duplicates on the retry
+                with self._lock:
+                    self._buffer.extendleft(reversed(batch))
+                raise
+
+    def _write(self, db: Session, batch):
+        """
+        Insert a batch and return how many fixes were written. A batch the
+        database rejects is split in halves until the rows that can never be
+        stored are found and dropped, so one bad row does not hold back the
+        rest. Other errors, e.g. a lost connection, are raised.
+        """
+        try:
+            insert_history(db, batch)
+            db.commit()
+            return len(batch)
+        except (DataError, IntegrityError) as e:
+            db.rollback()
+            if len(batch) == 1:
+                print(f"Dropping location history fix {batch[0]}: {e.orig}")
+                return 0
+        middle = len(batch) // 2
+        return self._write(db, batch[:middle]) + self._write(db, batch[middle:])
+
+    def maintain(self, db: Session):
+        """Create upcoming partitions and drop expired ones (Postgres only)."""
+        if db.bind.dialect.name != "postgresql":
+            return
+        today = datetime.utcnow().date()
+        # Start a day back so late fixes near midnight still have a partition
+        ensure_partitions(db, today - timedelta(days=1))
+        dropped = drop_expired_partitions(db, today)
+        db.commit()
+        if dropped:
+            print(f"Dropped expired location history partitions: {dropped}")
+
+    def _run_once(self):
+        db = SessionLocal()
+        try:
+            now = time.monotonic()
+            if self._maintained_at is None or now - self._maintained_at > LOCATION_HISTORY_MAINTENANCE_SECONDS:
+                self.maintain(db)
+                self._maintained_at = now
+            return self.flush(db)
+        finally:
+            db.close()
+
+    async def run_flusher(self):
+        while True:
+            try:
+                await asyncio.to_thread(self._run_once)
+            except Exception as e:
+                print(f"Error writing location history: {e}")
+            await asyncio.sleep(self.flush_interval)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_event_loop().create_task(self.run_flusher())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await asyncio.to_thread(self._run_once)
+
+
+location_history = LocationHistoryWriter()
@@ -0,0 +1,212 @@
+import asyncio
+import os
+import threading
+from collections import namedtuple
+from datetime import datetime
+import redis
+from sqlalchemy import or_
+from sqlalchemy.orm import Session
+from app.db import SessionLocal
+from app.models import DriverLocation
+from app.spatial import driver_index
+
+# Where the latest positions live: "memory" (per worker) or "redis" (shared by all workers)
+LOCATION_STORE_BACKEND = os.getenv("LOCATION_STORE_BACKEND", "memory")
+LOCATION_REDIS_URL = os.getenv("LOCATION_REDIS_URL", "redis://localhost:6379/0")
+LOCATION_FLUSH_INTERVAL_SECONDS = float(
+    os.getenv("LOCATION_FLUSH_INTERVAL_SECONDS", "5"))
+# "write-behind" acknowledges a fix before it reaches Postgres, so a crash can
+# lose up to one flush interval of positions. "write-through" commits every fix.
+LOCATION_WRITE_MODE = os.getenv("LOCATION_WRITE_MODE", "write-behind")
+# Rows per upsert statement, keeps each statement under Postgres' 65535 bind parameter limit
+UPSERT_CHUNK_SIZE = 10000
+
+Position = namedtuple(
+    "Position", ["driver_id", "latitude", "longitude", "timestamp"])
+
+
+def upsert_positions(db: Session, positions):
+    """
+    Insert or update the driver_locations rows for the given positions with a
+    multi-row upsert. Each driver must appear at most once.
+    """
+    if not positions:
+        return
+    if db.bind.dialect.name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+
+    stmt = insert(DriverLocation)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[DriverLocation.driver_id],
+        set_={
+            "latitude": stmt.excluded.latitude,
+            "longitude": stmt.excluded.longitude,
+            "timestamp": stmt.excluded.timestamp,
+        },
+        # A flush of queued fixes never replaces a newer position written by another path
+        where=or_(DriverLocation.timestamp.is_(None), DriverLocation.timestamp <= stmt.excluded.timestamp),
+    )
+    # SQLAlchemy renders the parameter list as multi-row VALUES, one statement
+    # per UPSERT_CHUNK_SIZE rows, and caches the compiled statement.
+    db.execute(
+        stmt,
+        [{"driver_id": p.driver_id, "latitude": p.latitude,
+          "longitude": p.longitude, "timestamp": p.timestamp} for p in positions],
+        execution_options={"insertmanyvalues_page_size": UPSERT_CHUNK_SIZE},
+    )
+
+
+class MemoryPositionBackend:
+    blocking = False
+
+    def __init__(self):
+        self._positions = {}
+
+    def get(self, driver_id):
+        return self._positions.get(driver_id)
+
+    def put_many(self, positions):
+        for position in positions:
+            self._positions[position.driver_id] = position
+
+
+class RedisPositionBackend:
+    key = "driver_positions"
+    # Every call is a network round trip
+    blocking = True
+
+    def __init__(self, url):
+        self._client = redis.Redis.from_url(url)
+
+    def get(self, driver_id):
+        value = self._client.hget(self.key, driver_id)
+        if value is None:
+            return None
+        lat, lng, timestamp = value.decode().split(",")
+        return Position(driver_id, float(lat), float(lng), datetime.fromisoformat(timestamp))
+
+    def put_many(self, positions):
+        if positions:
+            self._client.hset(self.key, mapping={
+                p.driver_id: f"{p.latitude},{p.longitude},{p.timestamp.isoformat()}"
+                for p in positions
+            })
+
+
+class LatestPositionStore:
+    """
+    Serves the latest position of every driver and absorbs location writes.
+
+    Fixes are kept in the backend for reads and queued per driver, so only the
+    newest fix of each driver is written when the queue is flushed to Postgres.
+    """
+
+    def __init__(self, backend, flush_interval=LOCATION_FLUSH_INTERVAL_SECONDS, write_mode=LOCATION_WRITE_MODE):
+        self.backend = backend
+        self.flush_interval = flush_interval
+        self.write_through = write_mode == "write-through"
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._task = None
+
+    def get(self, driver_id):
+        return self.backend.get(driver_id)
+
+    async def _offload(self, method, *args):
+        # A blocking backend would stall the event loop, it is called from a worker thread
+        if self.backend.blocking:
+            return await asyncio.to_thread(method, *args)
+        return method(*args)
+
+    async def get_async(self, driver_id):
+        return await self._offload(self.get, driver_id)
+
+    async def put_async(self, driver_id, latitude, longitude, timestamp=None):
+        return await self._offload(self.put, driver_id, latitude, longitude, timestamp)
+
+    async def prime_async(self, positions):
+        await self._offload(self.prime, positions)
+
+    def prime(self, positions):
+        """Cache positions already stored in the database without queueing a write."""
+        self.backend.put_many(positions)
+        driver_index.update_many(positions)
+        with self._lock:
+            for position in positions:
+                queued = self._pending.get(position.driver_id)
+                if queued is not None and queued.timestamp <= position.timestamp:
+                    del self._pending[position.driver_id]
+
+    def put(self, driver_id, latitude, longitude, timestamp=None):
+        position = Position(driver_id, latitude, longitude,
+                            timestamp or datetime.utcnow())
+        self.put_many([position])
+        return position
+
+    def put_many(self, positions):
+        self.backend.put_many(positions)
+        driver_index.update_many(positions)
+        with self._lock:
+            for position in positions:
+                queued = self._pending.get(position.driver_id)
+                if queued is None or queued.timestamp <= position.timestamp:
+                    self._pending[position.driver_id] = position
+
+    def pending_count(self):
+        return len(self._pending)
+
+    def flush(self, db: Session):
+        """Write the queued positions with a single upsert and return how many were written."""
+        with self._lock:
+            batch, self._pending = self._pending, {}
+        if not batch:
+            return 0
+
+        try:
+            upsert_positions(db, list(batch.values()))
+            db.commit()
+        except Exception:
+            db.rollback()
+            # Put the batch back unless a newer fix arrived while flushing
+            with self._lock:
+                for driver_id, position in batch.items():
+                    self._pending.setdefault(driver_id, position)
+            raise
+        return len(batch)
+
+    def _flush_with_new_session(self):
+        db = SessionLocal()
+        try:
+            return self.flush(db)
+        finally:
+            db.close()
+
+    async def run_flusher(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await asyncio.to_thread(self._flush_with_new_session)
+            except Exception as e:
+                print(f"Error flushing driver locations: {e}")
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_event_loop().create_task(self.run_flusher())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        # Final flush so a clean shutdown does not drop queued fixes
+        await asyncio.to_thread(self._flush_with_new_session)
+
+
+def _make_backend():
+    if LOCATION_STORE_BACKEND == "redis":
+        return RedisPositionBackend(LOCATION_REDIS_URL)
+    return MemoryPositionBackend()
+
+
+location_store = LatestPositionStore(_make_backend())
@@ -1,6 +1,6 @@
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
-from app.db import get_db  
+from app.db import async_engine, replicas
 from app.routes.auth import router as auth_router
 from app.routes.geofence import router as geofence_router
 from app.routes.notification import router as notification_router
@@ -9,6 +9,14 @@ from app.routes.user import router as user_router
 from app.routes.trips import router as trips_router
 from app.routes.driver_location import router as driver_location_router
 from app.routes.reports import router as reports_router
+from app.routes.metrics import router as metrics_router
+from app.routes.facility import router as facility_router
+from app.location_store import location_store
+from app.location_history import location_history
+from app.scheduler import scheduler
+from app.http_client import http_client
+from app.facility_matrix import facility_matrix
+from app.db_metrics import QueryMetricsMiddleware
 
 app = FastAPI(
     title="Driver Logistics App Backend",
@@ -25,7 +33,11 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    # Lets browsers read the cursor of the next page of list endpoints
+    expose_headers=["X-Next-Cursor"],
 )
+# Attributes database queries to the route being served, see /metrics/db
+app.add_middleware(QueryMetricsMiddleware)
 
 # Include routers
 app.include_router(auth_router, prefix="/auth", tags=["Authentication"])
@@ -39,6 +51,27 @@ app.include_router(driver_location_router,
                    prefix="/driver-location", tags=["Driver Location"])
 app.include_router(user_router, prefix="/users", tags=["Users"])
 app.include_router(reports_router, prefix="/reports", tags=["Reports"])
+app.include_router(metrics_router, prefix="/metrics", tags=["Metrics"])
+app.include_router(facility_router, prefix="/facilities", tags=["Facilities"])
+
+
+@app.on_event("startup")
+async def start_background_workers():
+    location_store.start()
+    location_history.start()
+    scheduler.start()
+    facility_matrix.ensure_fresh()
+    replicas.start()
+
+
+@app.on_event("shutdown")
+async def stop_background_workers():
+    await location_store.stop()
+    await location_history.stop()
+    await scheduler.stop()
+    await http_client.close()
+    await replicas.stop()
+    await async_engine.dispose()
 
 
 @app.get("/")
@@ -0,0 +1,147 @@
+import os
+from collections import namedtuple
+from datetime import datetime
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+from sqlalchemy import bindparam
+from sqlalchemy.orm import Session
+from app import models
+from app.corridor import ACTIVE_TRIP_STATUSES
+from app.utils import calculate_distance_matrix
+
+# Drivers further than this from a trip are never matched to it
+MATCHING_MAX_DISTANCE_KM = float(os.getenv("MATCHING_MAX_DISTANCE_KM", "200"))
+# Cost of one tonne of unused vehicle capacity, in kilometers of driving
+MATCHING_TONNAGE_WEIGHT = float(os.getenv("MATCHING_TONNAGE_WEIGHT", "1.0"))
+# Routes of batch-assigned trips planned at the same time
+MATCHING_ROUTE_CONCURRENCY = int(os.getenv("MATCHING_ROUTE_CONCURRENCY", "8"))
+# Finite stand-in for forbidden pairs, the solver needs a complete matrix
+INFEASIBLE_COST = 1e9
+
+FreeDriver = namedtuple(
+    "FreeDriver", ["driver_id", "vehicle_id", "latitude", "longitude", "remaining_tonnage"])
+Assignment = namedtuple(
+    "Assignment", ["trip_id", "driver_id", "vehicle_id", "distance_km"])
+
+
+def load_pending_trips(db: Session):
+    """Pending trips with destination coordinates, locked so concurrent dispatches skip them."""
+    return db.query(
+        models.Trip.id, models.Trip.destination_lat, models.Trip.destination_lng, models.Trip.tonnage,
+    ).filter(
+        models.Trip.status == models.TripStatus.PENDING,
+        models.Trip.destination_lat.isnot(None),
+        models.Trip.destination_lng.isnot(None),
+    ).order_by(models.Trip.id).with_for_update(skip_locked=True).all()
+
+
+def load_free_drivers(db: Session):
+    """
+    Active drivers with a known position and a vehicle who are not on an
+    assigned or in-route trip. Drivers with several vehicles are matched
+    with the one with the most remaining tonnage. The drivers are locked
+    until the caller commits, so a concurrent dispatch skips them instead
+    of giving them a second trip.
+    """
+    busy = db.query(models.Trip.driver_id).filter(
+        models.Trip.status.in_(ACTIVE_TRIP_STATUSES), models.Trip.driver_id.isnot(None))
+    rows = db.query(
+        models.User.id, models.Vehicle.id,
+        models.DriverLocation.latitude, models.DriverLocation.longitude,
+        models.Vehicle.remaining_tonnage,
+    ).join(models.DriverLocation, models.DriverLocation.driver_id == models.User.id).join(
+        models.Vehicle, models.Vehicle.driver_id == models.User.id
+    ).filter(
+        models.User.role == models.UserRole.DRIVER,
+        models.User.is_active == True,
+        models.User.id.notin_(busy),
+    ).with_for_update(of=models.User, skip_locked=True).all()
+
+    drivers = {}
+    for row in rows:
+        driver = FreeDriver(*row)
+        current = drivers.get(driver.driver_id)
+        if current is None or driver.remaining_tonnage > current.remaining_tonnage:
+            drivers[driver.driver_id] = driver
+    return list(drivers.values())
+
+
+def build_cost_matrix(trip_lats, trip_lngs, trip_tonnage, driver_lats, driver_lngs, driver_capacity,
+                      max_distance_km=MATCHING_MAX_DISTANCE_KM, tonnage_weight=MATCHING_TONNAGE_WEIGHT):
+    """
+    Trips x drivers cost of every pairing: the distance to the trip plus the
+    weighted capacity the trip would leave unused, so small loads prefer
+    small vehicles. Returns the cost, the feasibility mask and the distances.
+    """
+    distances = calculate_distance_matrix(trip_lats, trip_lngs, driver_lats, driver_lngs)
+    slack = np.asarray(driver_capacity, dtype=np.float64)[None, :] - \
+        np.asarray(trip_tonnage, dtype=np.float64)[:, None]
+    feasible = (slack >= 0) & (distances <= max_distance_km)
+
+    # Built in place, 5k x 5k float64 matrices are 200 MB each
+    cost = slack
+    cost *= tonnage_weight
+    cost += distances
+    cost[~feasible] = INFEASIBLE_COST
+    return cost, feasible, distances
+
+
+def solve_assignment(cost, feasible):
+    """Minimum-cost assignment, returns the matched (row, column) pairs that are feasible."""
+    rows, columns = linear_sum_assignment(cost)
+    keep = feasible[rows, columns]
+    return rows[keep], columns[keep]
+
+
+def match_trips(trips, drivers, max_distance_km=MATCHING_MAX_DISTANCE_KM,
+                tonnage_weight=MATCHING_TONNAGE_WEIGHT):
+    """Return the Assignment list minimizing the total cost over all trips and drivers."""
+    if not trips or not drivers:
+        return []
+    cost, feasible, distances = build_cost_matrix(
+        [trip.destination_lat for trip in trips], [trip.destination_lng for trip in trips],
+        [trip.tonnage for trip in trips],
+        [driver.latitude for driver in drivers], [driver.longitude for driver in drivers],
+        [driver.remaining_tonnage for driver in drivers],
+        max_distance_km, tonnage_weight,
+    )
+    rows, columns = solve_assignment(cost, feasible)
+    return [
+        Assignment(trips[row].id, drivers[column].driver_id, drivers[column].vehicle_id,
+                   float(distances[row, column]))
+        for row, column in zip(rows, columns)
+    ]
+
+
+def assign_pending_trips(db: Session):
+    """
+    Match every pending trip with a free driver and store all assignments in
+    one transaction. Returns the assignments and the ids of unmatched trips.
+    """
+    trips = load_pending_trips(db)
+    assignments = match_trips(trips, load_free_drivers(db))
+
+    if assignments:
+        db.execute(
+            models.Trip.__table__.update().where(
+                models.Trip.id == bindparam("trip_id")
+            ).values(
+                driver_id=bindparam("driver_id"),
+                vehicle_id=bindparam("vehicle_id"),
+                status=models.TripStatus.ASSIGNED,
+            ),
+            [{"trip_id": a.trip_id, "driver_id": a.driver_id, "vehicle_id": a.vehicle_id}
+             for a in assignments],
+        )
+        db.add_all([
+            models.Notification(
+                driver_id=a.driver_id,
+                message=f"You have been assigned to trip {a.trip_id}. Check the app for route details.",
+                timestamp=datetime.utcnow(),
+            )
+            for a in assignments
+        ])
+    db.commit()
+
+    assigned = {a.trip_id for a in assignments}
+    return assignments, [trip.id for trip in trips if trip.id not in assigned]
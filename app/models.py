@@ -1,5 +1,5 @@
 from sqlalchemy import (
-    Column, Integer, String, Float, Boolean, ForeignKey, DateTime, Text, Enum, UniqueConstraint
+    Column, Integer, String, Float, Boolean, ForeignKey, DateTime, Text, Enum, JSON, Index, UniqueConstraint
 )
 from sqlalchemy.orm import relationship, validates
 from datetime import datetime
@@ -39,7 +39,8 @@ class User(Base):
     location = relationship(
         "DriverLocation", uselist=False, back_populates="driver")
     delay_reports = relationship("DelayReport", back_populates="driver")
-    notifications = relationship("Notification", back_populates="driver")
+    notifications = relationship(
+        "Notification", back_populates="driver", foreign_keys="Notification.driver_id")
     trips_as_driver = relationship(
         "Trip", back_populates="driver", foreign_keys="Trip.driver_id")
     trips_as_admin = relationship(
@@ -88,6 +89,37 @@ class DriverLocation(Base):
     driver = relationship("User", back_populates="location")
 
 
+# DriverLocationHistory model: every fix, append-only. In Postgres the table is
+# range partitioned by day on recorded_at (see app.location_history). Fixes are
+# keyed by driver and timestamp, so a fix with the same timestamp as a stored
+# one is dropped as a duplicate. WebSocket frames carry whole seconds, so at
+# most one fix per driver and second is kept from them.
+class DriverLocationHistory(Base):
+    __tablename__ = "driver_location_history"
+    __table_args__ = {"postgresql_partition_by": "RANGE (recorded_at)"}
+
+    driver_id = Column(Integer, primary_key=True)
+    recorded_at = Column(DateTime, primary_key=True)
+    latitude = Column(Float(precision=24), nullable=False)
+    longitude = Column(Float(precision=24), nullable=False)
+
+
+# ScheduledTimer model: durable timers shared by all workers (see app.scheduler)
+class ScheduledTimer(Base):
+    __tablename__ = "scheduled_timers"
+    __table_args__ = (UniqueConstraint("kind", "key", name="uq_scheduled_timer_kind_key"),)
+
+    id = Column(Integer, primary_key=True, index=True)
+    kind = Column(String(50), nullable=False)
+    key = Column(String(100), nullable=False)
+    payload = Column(JSON, nullable=True)
+    due_at = Column(DateTime, nullable=False, index=True)
+    # Worker holding the timer and until when; expired leases can be claimed again
+    lease_owner = Column(String(64), nullable=True)
+    lease_expires_at = Column(DateTime, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+
 # Geofence model
 class Geofence(Base):
     __tablename__ = "geofences"
@@ -97,15 +129,50 @@ class Geofence(Base):
     longitude = Column(Float, nullable=False)
     radius = Column(Float, nullable=False)
     time_limit_minutes = Column(Integer, nullable=False)
+    # "circle" or "polygon". For polygons latitude, longitude and radius hold
+    # the bounding circle and polygon the JSON list of [lat, lng] vertices.
+    shape = Column(String(20), default="circle",
+                   server_default="circle", nullable=False)
+    polygon = Column(Text, nullable=True)
+    # Validity window, open ended when null. Fences outside it are ignored by
+    # lookups, so a fence that changes over time is one row per version.
+    valid_from = Column(DateTime, nullable=True)
+    valid_until = Column(DateTime, nullable=True, index=True)
 
 
 # Trip model
+class Facility(Base):
+    """A depot or post office that trips start, stop and end at."""
+    __tablename__ = "facilities"
+
+    id = Column(Integer, primary_key=True, index=True)
+    name = Column(String(100), unique=True, nullable=False, index=True)
+    latitude = Column(Float, nullable=False)
+    longitude = Column(Float, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+
+class GeocodedAddress(Base):
+    """Coordinates of a normalized address, so each address is geocoded once."""
+    __tablename__ = "geocoded_addresses"
+
+    id = Column(Integer, primary_key=True, index=True)
+    address = Column(String(255), unique=True, nullable=False, index=True)
+    latitude = Column(Float, nullable=False)
+    longitude = Column(Float, nullable=False)
+    # Backend that resolved the address
+    source = Column(String(50), nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+
 class Trip(Base):
     __tablename__ = "trips"
+    # The pages of a vehicle's trips, in id order
+    __table_args__ = (Index("ix_trips_vehicle_id_id", "vehicle_id", "id"),)
 
     id = Column(Integer, primary_key=True, index=True)
     vehicle_id = Column(Integer, ForeignKey(
-        "vehicles.id", ondelete="SET NULL"), nullable=True, index=True)
+        "vehicles.id", ondelete="SET NULL"), nullable=True)
     driver_id = Column(Integer, ForeignKey(
         "users.id", ondelete="SET NULL"), nullable=True, index=True)
     admin_id = Column(Integer, ForeignKey(
@@ -118,16 +185,27 @@ class Trip(Base):
     next_halt = Column(String, nullable=True)
     safety_info = Column(String, nullable=True)
     tonnage = Column(Float, nullable=False)
+    source_lat = Column(Float, nullable=True)
+    source_lng = Column(Float, nullable=True)
+    destination_lat = Column(Float, nullable=True)
+    destination_lng = Column(Float, nullable=True)
     upvotes = Column(Integer, default=0)
     downvotes = Column(Integer, default=0)
-
-    vehicle = relationship("Vehicle", back_populates="trips")
+    # Best route as returned by the routing API: distance, duration and path
+    route_details = Column(JSON, nullable=True)
+    # Ids of the geofences along the route, in the order the route reaches them
+    corridor_geofence_ids = Column(JSON, nullable=True)
+
+    # The vehicle and users are never lazy-loaded, routes join or project what
+    # they need, so a forgotten load raises instead of querying once per trip
+    vehicle = relationship("Vehicle", back_populates="trips", lazy="raise_on_sql")
     driver = relationship(
-        "User", back_populates="trips_as_driver", foreign_keys=[driver_id])
+        "User", back_populates="trips_as_driver", foreign_keys=[driver_id], lazy="raise_on_sql")
     admin = relationship(
-        "User", back_populates="trips_as_admin", foreign_keys=[admin_id])
+        "User", back_populates="trips_as_admin", foreign_keys=[admin_id], lazy="raise_on_sql")
     intermediate_destinations = relationship(
-        "IntermediateDestination", back_populates="trip", cascade="all, delete")
+        "IntermediateDestination", back_populates="trip", cascade="all, delete",
+        order_by="IntermediateDestination.sequence")
     delay_reports = relationship(
         "DelayReport", back_populates="trip", cascade="all, delete")
 
@@ -141,6 +219,8 @@ class IntermediateDestination(Base):
         "trips.id", ondelete="CASCADE"), nullable=False, index=True)
     destination = Column(String(100), nullable=False)
     sequence = Column(Integer, nullable=False)
+    latitude = Column(Float, nullable=True)
+    longitude = Column(Float, nullable=True)
 
     trip = relationship("Trip", back_populates="intermediate_destinations")
 
@@ -162,8 +242,9 @@ class Notification(Base):
     timestamp = Column(DateTime, default=datetime.utcnow)
     is_read = Column(Boolean, default=False)
 
-    driver = relationship("User", back_populates="notifications")
-    admin = relationship("User")
+    driver = relationship("User", back_populates="notifications",
+                          foreign_keys=[driver_id])
+    admin = relationship("User", foreign_keys=[admin_id])
 
 
 # DelayReport model
@@ -172,7 +253,7 @@ class DelayReport(Base):
 
     id = Column(Integer, primary_key=True, index=True)
     driver_id = Column(Integer, ForeignKey(
-        "users.id", ondelete="CASCADE"), nullable=False, index=True)
+        "users.id", ondelete="CASCADE"), nullable=False)
     trip_id = Column(Integer, ForeignKey(
         "trips.id", ondelete="CASCADE"), nullable=False, index=True)
     reason = Column(String(255), nullable=False)
@@ -185,4 +266,6 @@ class DelayReport(Base):
     __table_args__ = (
         UniqueConstraint("driver_id", "trip_id",
                          name="unique_driver_trip_report"),
+        # The pages of a driver's reports, in id order
+        Index("ix_delay_reports_driver_id_id", "driver_id", "id"),
     )
@@ -0,0 +1,96 @@
+import base64
+import json
+import os
+from typing import Optional
+from fastapi import HTTPException, Query
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from sqlalchemy import tuple_
+
+# Rows per page when the client does not ask for a page size, and the largest page it may ask for
+PAGE_SIZE = int(os.getenv("PAGE_SIZE", "100"))
+MAX_PAGE_SIZE = int(os.getenv("MAX_PAGE_SIZE", "1000"))
+# Response header carrying the cursor of the next page, absent on the last page
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+
+
+def encode_cursor(values):
+    """An opaque cursor holding the sort key of the last row of a page, a list of integers."""
+    return base64.urlsafe_b64encode(json.dumps(list(values)).encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor, size):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except (ValueError, TypeError):
+        values = None
+    if not isinstance(values, list) or len(values) != size or \
+            not all(isinstance(value, int) and not isinstance(value, bool) for value in values):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return values
+
+
+class PageParams:
+    """
+    Query parameters of a paginated list: the cursor returned in X-Next-Cursor
+    by the previous page, the page size, and optionally a comma-separated list
+    of the fields to return.
+    """
+
+    def __init__(
+        self,
+        cursor: Optional[str] = None,
+        limit: int = Query(PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+        fields: Optional[str] = None,
+    ):
+        self.cursor = cursor
+        self.limit = limit
+        self.fields = fields
+
+    def after(self, size):
+        """Sort key values the page starts after, None on the first page."""
+        return None if self.cursor is None else decode_cursor(self.cursor, size)
+
+    def selected_fields(self, allowed):
+        """The fields asked for, in the order given, or None for every field."""
+        if self.fields is None:
+            return None
+        fields = list(dict.fromkeys(field.strip() for field in self.fields.split(",") if field.strip()))
+        unknown = [field for field in fields if field not in allowed]
+        if unknown or not fields:
+            raise HTTPException(
+                status_code=400, detail=f"Unknown fields: {', '.join(unknown)}" if unknown else "No fields selected")
+        return fields
+
+
+def keyset(stmt, page: PageParams, *columns):
+    """
+    Order the statement by the key columns and keep the rows after the
+    page's cursor. One row more than the page is fetched, to tell whether
+    another page follows. The columns must be unique together, and should
+    lead with the statement's equality filters in an index.
+    """
+    after = page.after(len(columns))
+    if after is not None:
+        if len(columns) == 1:
+            stmt = stmt.filter(columns[0] > after[0])
+        else:
+            stmt = stmt.filter(tuple_(*columns) > tuple_(*after))
+    return stmt.order_by(*columns).limit(page.limit + 1)
+
+
+def page_response(rows, page: PageParams, key, render=None, fields=None):
+    """
+    The JSON response of a page of rows fetched with one extra row, with the
+    cursor of the next page in the X-Next-Cursor header. key(row) gives the
+    sort key values of a row, render(row) what is sent for it, of which only
+    the selected fields are kept.
+    """
+    headers = {}
+    if len(rows) > page.limit:
+        rows = rows[:page.limit]
+        headers[NEXT_CURSOR_HEADER] = encode_cursor(key(rows[-1]))
+    content = jsonable_encoder([render(row) for row in rows] if render else rows)
+    if fields is not None:
+        content = [{field: item.get(field) for field in fields} for item in content]
+    return JSONResponse(content=content, headers=headers)
@@ -0,0 +1,159 @@
+import asyncio
+import os
+import threading
+import time
+from sqlalchemy import event, text
+from sqlalchemy.exc import InterfaceError, OperationalError
+from sqlalchemy.orm import Session
+from sqlalchemy.sql.dml import UpdateBase
+
+# How long a failing replica is left out before it is tried again
+DB_REPLICA_EJECT_SECONDS = float(os.getenv("DB_REPLICA_EJECT_SECONDS", "30"))
+# Seconds between health checks of every replica
+DB_REPLICA_HEALTH_INTERVAL_SECONDS = float(os.getenv("DB_REPLICA_HEALTH_INTERVAL_SECONDS", "10"))
+# Postgres replicas further behind the primary than this are left out until they catch up
+DB_REPLICA_MAX_LAG_SECONDS = float(os.getenv("DB_REPLICA_MAX_LAG_SECONDS", "5"))
+
+# Seconds since the last transaction the replica replayed, 0 when it is fully caught up
+REPLICATION_LAG_SQL = text(
+    "SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+    "ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END"
+)
+
+
+class Replica:
+    def __init__(self, name, engine):
+        self.name = name
+        self.engine = engine
+        self.ejected_until = 0.0
+        self.picks = 0
+        self.ejections = 0
+        self.lag_seconds = None
+        self.last_error = None
+
+    @property
+    def healthy(self):
+        return time.monotonic() >= self.ejected_until
+
+
+class ReplicaSet:
+    """
+    Read replicas taken in turn, skipping the ones that failed recently.
+
+    A replica is ejected for DB_REPLICA_EJECT_SECONDS when a query on it
+    fails to connect, or when the health check finds it unreachable or more
+    than DB_REPLICA_MAX_LAG_SECONDS behind. With every replica ejected, reads
+    go to the primary.
+    """
+
+    def __init__(self, replicas=(), eject_seconds=DB_REPLICA_EJECT_SECONDS,
+                 health_interval=DB_REPLICA_HEALTH_INTERVAL_SECONDS, max_lag_seconds=DB_REPLICA_MAX_LAG_SECONDS):
+        self.replicas = list(replicas)
+        self.eject_seconds = eject_seconds
+        self.health_interval = health_interval
+        self.max_lag_seconds = max_lag_seconds
+        self._next = 0
+        self._lock = threading.Lock()
+        self._task = None
+        for replica in self.replicas:
+            event.listen(replica.engine.sync_engine, "handle_error", self._on_error(replica))
+
+    def __len__(self):
+        return len(self.replicas)
+
+    def pick(self):
+        """The next healthy replica, or None when there is none."""
+        with self._lock:
+            for _ in range(len(self.replicas)):
+                replica = self.replicas[self._next]
+                self._next = (self._next + 1) % len(self.replicas)
+                if replica.healthy:
+                    replica.picks += 1
+                    return replica
+        return None
+
+    def eject(self, replica, reason):
+        if replica.healthy:
+            replica.ejections += 1
+            print(f"Replica {replica.name} ejected: {reason}")
+        replica.ejected_until = time.monotonic() + self.eject_seconds
+        replica.last_error = str(reason)
+
+    def _on_error(self, replica):
+        def handle_error(context):
+            # Connection failures, not errors in the statement itself
+            if context.is_disconnect or isinstance(context.sqlalchemy_exception, (OperationalError, InterfaceError)):
+                self.eject(replica, context.original_exception)
+        return handle_error
+
+    async def check(self, replica):
+        """Query the replica, and its replication lag on Postgres, and eject or readmit it."""
+        try:
+            async with replica.engine.connect() as conn:
+                if replica.engine.dialect.name == "postgresql":
+                    lag = await conn.scalar(REPLICATION_LAG_SQL)
+                    replica.lag_seconds = float(lag) if lag is not None else None
+                else:
+                    await conn.execute(text("SELECT 1"))
+                    replica.lag_seconds = 0.0
+        except Exception as e:
+            self.eject(replica, e)
+            return
+        if replica.lag_seconds is not None and replica.lag_seconds > self.max_lag_seconds:
+            self.eject(replica, f"replication lag {replica.lag_seconds:.1f}s")
+        elif not replica.healthy:
+            print(f"Replica {replica.name} readmitted")
+            replica.ejected_until = 0.0
+
+    async def run_health_checks(self):
+        while True:
+            await asyncio.gather(*(self.check(replica) for replica in self.replicas))
+            await asyncio.sleep(self.health_interval)
+
+    def start(self):
+        if self.replicas and self._task is None:
+            self._task = asyncio.get_event_loop().create_task(self.run_health_checks())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        for replica in self.replicas:
+            await replica.engine.dispose()
+
+    def stats(self):
+        return {
+            replica.name: {
+                "healthy": replica.healthy,
+                "picks": replica.picks,
+                "ejections": replica.ejections,
+                "lag_seconds": replica.lag_seconds,
+                "last_error": replica.last_error,
+            }
+            for replica in self.replicas
+        }
+
+
+class RoutingSession(Session):
+    """
+    Sends the reads of a session to one replica and its writes to the primary.
+
+    The replica is chosen on the first read and kept for the whole session,
+    so a request sees one consistent snapshot. Once the session has written,
+    its later reads go to the primary too and see those writes.
+    """
+
+    def __init__(self, replicas=None, **kwargs):
+        super().__init__(**kwargs)
+        self.replicas = replicas
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if self._flushing or isinstance(clause, UpdateBase):
+            self.info["read_primary"] = True
+        if not self.info.get("read_primary"):
+            if "replica" not in self.info:
+                self.info["replica"] = self.replicas.pick() if self.replicas else None
+            replica = self.info["replica"]
+            if replica is not None and replica.healthy:
+                return replica.engine.sync_engine
+        return super().get_bind(mapper, clause=clause, **kwargs)
@@ -0,0 +1,198 @@
+import asyncio
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict, deque
+import numpy as np
+import redis
+from app.utils import get_best_route_from_api
+
+# "memory" keeps routes per worker, "redis" also shares them between workers
+ROUTE_CACHE_BACKEND = os.getenv("ROUTE_CACHE_BACKEND", "memory")
+ROUTE_CACHE_REDIS_URL = os.getenv("ROUTE_CACHE_REDIS_URL", "redis://localhost:6379/0")
+# Routes per worker kept in the in-process tier
+ROUTE_CACHE_MAX_ENTRIES = int(os.getenv("ROUTE_CACHE_MAX_ENTRIES", "10000"))
+# Routes younger than this are served as they are
+ROUTE_CACHE_TTL_SECONDS = float(os.getenv("ROUTE_CACHE_TTL_SECONDS", "3600"))
+# For this long after the TTL a route is still served, while a fresh one is fetched
+ROUTE_CACHE_STALE_SECONDS = float(os.getenv("ROUTE_CACHE_STALE_SECONDS", "21600"))
+# Latencies kept for the percentiles reported by stats()
+ROUTE_CACHE_LATENCY_SAMPLES = 1000
+
+
+def _normalize(place):
+    return " ".join(str(place).split()).casefold()
+
+
+def route_key(source, destination, waypoints=None):
+    """Cache key of a route, insensitive to case and whitespace in place names."""
+    parts = [_normalize(source), _normalize(destination)] + [_normalize(w) for w in waypoints or []]
+    return hashlib.sha1(json.dumps(parts).encode()).hexdigest()
+
+
+class RedisRouteTier:
+    prefix = "route_cache:"
+
+    def __init__(self, url, expire_seconds):
+        self._client = redis.Redis.from_url(url)
+        self.expire_seconds = int(expire_seconds)
+
+    def get(self, key):
+        value = self._client.get(self.prefix + key)
+        if value is None:
+            return None
+        entry = json.loads(value)
+        return entry["route"], entry["fetched_at"]
+
+    def set(self, key, route, fetched_at):
+        self._client.set(self.prefix + key, json.dumps({"route": route, "fetched_at": fetched_at}),
+                         ex=self.expire_seconds)
+
+
+class RouteCache:
+    """
+    Routes by (source, destination, waypoints).
+
+    Lookups try the in-process LRU, then the shared tier, then the routing API.
+    A route older than the TTL is served stale for ROUTE_CACHE_STALE_SECONDS
+    while one refresh runs in the background. Concurrent lookups of the same
+    missing route share one upstream call. Failed lookups are not cached.
+    Meant to be used from the event loop only.
+    """
+
+    def __init__(self, fetch=get_best_route_from_api, shared=None, max_entries=ROUTE_CACHE_MAX_ENTRIES,
+                 ttl_seconds=ROUTE_CACHE_TTL_SECONDS, stale_seconds=ROUTE_CACHE_STALE_SECONDS):
+        self.fetch = fetch
+        self.shared = shared
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.stale_seconds = stale_seconds
+        # key -> (route, fetched_at), least recently used first
+        self._entries = OrderedDict()
+        # key -> future of the lookup in progress
+        self._inflight = {}
+        self._counts = dict.fromkeys(
+            ["hits", "stale_hits", "shared_hits", "misses", "coalesced", "refreshes", "errors"], 0)
+        self._lookup_ms = deque(maxlen=ROUTE_CACHE_LATENCY_SAMPLES)
+        self._upstream_ms = deque(maxlen=ROUTE_CACHE_LATENCY_SAMPLES)
+
+    async def get_route(self, source, destination, waypoints=None):
+        started = time.perf_counter()
+        try:
+            return await self._get_route(source, destination, list(waypoints or []))
+        finally:
+            self._lookup_ms.append((time.perf_counter() - started) * 1000)
+
+    async def _get_route(self, source, destination, waypoints):
+        key = route_key(source, destination, waypoints)
+        entry = self._entries.get(key)
+        if entry is not None:
+            route, fetched_at = entry
+            age = time.time() - fetched_at
+            if age <= self.ttl_seconds:
+                self._entries.move_to_end(key)
+                self._counts["hits"] += 1
+                return route
+            if age <= self.ttl_seconds + self.stale_seconds:
+                self._entries.move_to_end(key)
+                self._counts["stale_hits"] += 1
+                if key not in self._inflight:
+                    self._counts["refreshes"] += 1
+                    self._start_lookup(key, source, destination, waypoints, refresh=True)
+                return route
+            del self._entries[key]
+
+        future = self._inflight.get(key)
+        if future is not None:
+            self._counts["coalesced"] += 1
+            return await asyncio.shield(future)
+        self._counts["misses"] += 1
+        return await asyncio.shield(self._start_lookup(key, source, destination, waypoints))
+
+    def _start_lookup(self, key, source, destination, waypoints, refresh=False):
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        asyncio.create_task(self._lookup(key, future, source, destination, waypoints, refresh))
+        return future
+
+    async def _lookup(self, key, future, source, destination, waypoints, refresh):
+        try:
+            route = None
+            # A refresh skips the shared tier, which holds the same stale route or older
+            if self.shared is not None and not refresh:
+                cached = await asyncio.to_thread(self._shared_get, key)
+                if cached is not None and time.time() - cached[1] <= self.ttl_seconds:
+                    self._counts["shared_hits"] += 1
+                    route = cached[0]
+                    self._store(key, *cached)
+            if route is None:
+                started = time.perf_counter()
+                route = await self.fetch(source, destination, waypoints)
+                self._upstream_ms.append((time.perf_counter() - started) * 1000)
+                if route:
+                    fetched_at = time.time()
+                    self._store(key, route, fetched_at)
+                    if self.shared is not None:
+                        await asyncio.to_thread(self._shared_set, key, route, fetched_at)
+                else:
+                    self._counts["errors"] += 1
+            future.set_result(route)
+        except Exception as e:
+            print(f"Error looking up route {source} -> {destination}: {e}")
+            self._counts["errors"] += 1
+            future.set_result(None)
+        finally:
+            self._inflight.pop(key, None)
+
+    def _shared_get(self, key):
+        try:
+            return self.shared.get(key)
+        except Exception as e:
+            print(f"Error reading the shared route cache: {e}")
+            return None
+
+    def _shared_set(self, key, route, fetched_at):
+        try:
+            self.shared.set(key, route, fetched_at)
+        except Exception as e:
+            print(f"Error writing the shared route cache: {e}")
+
+    def _store(self, key, route, fetched_at):
+        self._entries[key] = (route, fetched_at)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self):
+        counts = dict(self._counts)
+        lookups = counts["hits"] + counts["stale_hits"] + counts["misses"] + counts["coalesced"]
+        # Coalesced lookups count as hits, they did not call the routing API themselves
+        served_from_cache = lookups - counts["misses"] + counts["shared_hits"]
+        return {
+            **counts,
+            "entries": len(self._entries),
+            "hit_rate": served_from_cache / lookups if lookups else 0.0,
+            "lookup_ms": _percentiles(self._lookup_ms),
+            "upstream_ms": _percentiles(self._upstream_ms),
+        }
+
+
+def _percentiles(samples):
+    if not samples:
+        return {"p50": None, "p95": None, "p99": None}
+    p50, p95, p99 = np.percentile(np.fromiter(samples, dtype=np.float64), [50, 95, 99])
+    return {"p50": float(p50), "p95": float(p95), "p99": float(p99)}
+
+
+def create_route_cache():
+    shared = None
+    if ROUTE_CACHE_BACKEND == "redis":
+        shared = RedisRouteTier(ROUTE_CACHE_REDIS_URL, ROUTE_CACHE_TTL_SECONDS + ROUTE_CACHE_STALE_SECONDS)
+    return RouteCache(shared=shared)
+
+
+route_cache = create_route_cache()
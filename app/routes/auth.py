@@ -1,11 +1,11 @@
-from app.utils import verify_password, create_access_token
-from twilio.rest import Client
+from app.utils import verify_password, create_access_token, send_sms
 import redis
 from jose import JWTError, jwt
 from app.models import User, UserRole
-from app.db import get_db
+from app.db import get_async_db
 from app import models
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
@@ -27,12 +27,6 @@ oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 redis_client = redis.Redis(
     host=REDIS_HOST, port=REDIS_PORT, password=REDIS_PASSWORD)
 
-TWILIO_ACCOUNT_SID = os.getenv("TWILIO_ACCOUNT_SID")
-TWILIO_AUTH_TOKEN = os.getenv("TWILIO_AUTH_TOKEN")
-TWILIO_PHONE_NUMBER = os.getenv("TWILIO_PHONE_NUMBER")
-
-client = Client(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN)
-
 CLIENT_ID = os.getenv("CLIENT_ID")
 CLIENT_SECRET = os.getenv("CLIENT_SECRET")
 
@@ -54,7 +48,7 @@ class Token(BaseModel):
 
 
 @router.post("/token")
-async def login(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
+async def login(form_data: OAuth2PasswordRequestForm = Depends(), db: AsyncSession = Depends(get_async_db)):
     # Check client_id and client_secret
     if form_data.client_id != CLIENT_ID or form_data.client_secret != CLIENT_SECRET:
         raise HTTPException(
@@ -64,7 +58,7 @@ async def login(form_data: OAuth2PasswordRequestForm = Depends(), db: Session =
         )
 
     # Authenticate user by email instead of username
-    user = db.query(User).filter(User.email == form_data.username).first()
+    user = await db.scalar(select(User).filter(User.email == form_data.username))
     if not user or not verify_password(form_data.password, user.hashed_password):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -78,9 +72,9 @@ async def login(form_data: OAuth2PasswordRequestForm = Depends(), db: Session =
 
 
 @router.post("/send-otp/")
-async def send_otp(request: OTPRequest, db: Session = Depends(get_db)):
-    user = db.query(User).filter(User.phone_number ==
-                                 request.phone_number).first()
+async def send_otp(request: OTPRequest, db: AsyncSession = Depends(get_async_db)):
+    user = await db.scalar(select(User).filter(User.phone_number ==
+                                               request.phone_number))
     if not user:
         raise HTTPException(status_code=404, detail="User  not found")
 
@@ -109,8 +103,7 @@ async def send_otp(request: OTPRequest, db: Session = Depends(get_db)):
         return {"message": "OTP sent successfully (test mode)", "phone_number": request.phone_number}
     else:
         message = f"Your OTP is {otp}"
-        client.messages.create(
-            body=message, from_=TWILIO_PHONE_NUMBER, to=request.phone_number)
+        await send_sms(request.phone_number, message)
 
         return {"message": "OTP sent successfully", "phone_number": request.phone_number}
 
@@ -137,25 +130,27 @@ async def verify_otp(request: OTPVerificationRequest):
     return {"access_token": access_token, "token_type": "bearer"}
 
 
-def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
-    credentials_exception = HTTPException(
-        status_code=401,
-        detail="Could not validate credentials",
-        headers={"WWW-Authenticate": "Bearer"},
-    )
+async def user_from_token(token: str, db: AsyncSession):
+    """The user an access token was issued to, or None when the token is invalid or expired."""
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        phone_number: str = payload.get("sub")
-        role: str = payload.get("role")
-        if phone_number is None or role is None:
-            raise credentials_exception
-
-        user = db.query(User).filter(User.phone_number == phone_number).first()
-        if user is None:
-            raise credentials_exception
     except JWTError:
-        raise credentials_exception
+        return None
+    phone_number: str = payload.get("sub")
+    role: str = payload.get("role")
+    if phone_number is None or role is None:
+        return None
+    return await db.scalar(select(User).filter(User.phone_number == phone_number))
+
 
+async def get_current_user(token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(get_async_db)):
+    user = await user_from_token(token, db)
+    if user is None:
+        raise HTTPException(
+            status_code=401,
+            detail="Could not validate credentials",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
     return user
 
 
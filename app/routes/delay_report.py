@@ -1,9 +1,13 @@
+from typing import List
 from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
-from app.db import get_db
-from app.models import DelayReport, Trip, User
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import load_only
+from app.db import get_async_db, get_read_db
+from app.models import DelayReport, Trip, TripStatus, User, UserRole
 from app.schemas import DelayReportCreate, DelayReportResponse
 from app.routes.auth import role_required
+from app.pagination import PageParams, keyset, page_response
 from app.utils import send_flash_notification
 
 router = APIRouter()
@@ -13,8 +17,8 @@ router = APIRouter()
 @router.post("/create", response_model=DelayReportResponse)
 async def create_delay_report(
     delay_report: DelayReportCreate,
-    db: Session = Depends(get_db),
-    user: User = Depends(role_required("driver"))
+    db: AsyncSession = Depends(get_async_db),
+    user: User = Depends(role_required(UserRole.DRIVER))
 ):
     """
     Create a delay report filled out by the driver.
@@ -22,9 +26,9 @@ async def create_delay_report(
     """
     try:
         # Check if the driver has an active trip
-        active_trip = db.query(Trip).filter(
-            Trip.driver_id == user.id, Trip.status == "In-Route"
-        ).first()
+        active_trip = await db.scalar(select(Trip).filter(
+            Trip.driver_id == user.id, Trip.status == TripStatus.IN_ROUTE
+        ))
 
         if not active_trip:
             raise HTTPException(
@@ -41,30 +45,32 @@ async def create_delay_report(
         )
 
         db.add(report)
-        db.commit()
-        db.refresh(report)
+        await db.commit()
+        await db.refresh(report)
 
         # Send flash notifications
-        send_flash_notification(
+        await send_flash_notification(
             user.id,
             f"Delay Report submitted: {delay_report.reason}",
             db
         )
 
         # Optionally notify admins
-        admin_users = db.query(User).filter(User.role == "admin").all()
-        for admin in admin_users:
-            send_flash_notification(
-                admin.id,
+        admin_ids = (await db.scalars(select(User.id).filter(User.role == UserRole.ADMIN))).all()
+        for admin_id in admin_ids:
+            await send_flash_notification(
+                admin_id,
                 f"Driver {user.name} submitted a Delay Report: {
                     delay_report.reason}",
                 db
             )
+        # Notifications stored for users who are not connected
+        await db.commit()
 
         return report
 
     except Exception as e:
-        db.rollback()  # Ensure transaction rollback on error
+        await db.rollback()  # Ensure transaction rollback on error
         raise HTTPException(
             status_code=500,
             detail=f"An error occurred while creating the delay report: {
@@ -73,16 +79,26 @@ async def create_delay_report(
 # Route to get delay reports by driver ID
 
 
-@router.get("/delay_reports/{driver_id}")
-def get_delay_reports(driver_id: int, db: Session = Depends(get_db)):
+@router.get("/delay_reports/{driver_id}", response_model=List[DelayReportResponse])
+async def get_delay_reports(driver_id: int, page: PageParams = Depends(), db: AsyncSession = Depends(get_read_db)):
     """
-    Retrieve all delay reports for a specific driver.
+    Retrieve the delay reports of a specific driver, a page at a time in id order.
     """
-    delay_reports = db.query(DelayReport).filter(
-        DelayReport.driver_id == driver_id).all()
+    fields = page.selected_fields(DelayReportResponse.__fields__)
+    columns = [getattr(DelayReport, field) for field in fields or DelayReportResponse.__fields__]
+    # Served by ix_delay_reports_driver_id_id
+    delay_reports = (await db.scalars(keyset(
+        select(DelayReport).options(load_only(DelayReport.id, *columns, raiseload=True))
+        .filter(DelayReport.driver_id == driver_id),
+        page, DelayReport.id,
+    ))).all()
 
-    if not delay_reports:
+    if not delay_reports and page.cursor is None:
         raise HTTPException(
             status_code=404, detail="No delay reports found for this driver")
 
-    return delay_reports
+    if fields is None:
+        return page_response(delay_reports, page, lambda report: [report.id], DelayReportResponse.from_orm)
+    return page_response(
+        delay_reports, page, lambda report: [report.id],
+        lambda report: {field: getattr(report, field) for field in fields}, fields)
@@ -1,123 +1,260 @@
 from fastapi import APIRouter, HTTPException, Depends, WebSocket, WebSocketDisconnect
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
-from datetime import datetime
-from app.db import get_db
-from app.models import DriverLocation, User, Geofence, Trip
-from app.schemas import DriverLocationCreate, DriverLocationResponse
-from app.utils import calculate_distance, send_flash_notification
-from fastapi.security import OAuth2PasswordBearer
+from datetime import datetime, timezone
+from typing import List
+import numpy as np
+from app.db import AsyncSessionLocal, get_async_db, get_read_db
+from app.models import DriverLocation, DriverLocationHistory, User, UserRole
+from app.location_store import location_store, upsert_positions, Position
+from app.location_history import location_history, timestamp_window
+from app.location_frames import decode_frame, FrameError
+from app.routes.auth import get_current_user, user_from_token
+from app.schemas import (
+    DriverLocationCreate, DriverLocationResponse, DriverLocationBatch, DriverLocationFixResult
+)
+from app.spatial import geofence_index
+from app.corridor import trip_corridors
+from app.geofence_state import geofence_states, record_geofence_events
+from fastapi.responses import JSONResponse
 
 router = APIRouter()
 
-oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
-
 active_connections = []  # WebSocket connection pool
 
 
+def ingest_positions(db: Session, positions):
+    """
+    Store validated fixes. Returns the newest fix of every driver, for the
+    caller to cache in the latest-position store, and the geofences
+    containing each fix.
+
+    Shared by the batch endpoint and the driver WebSocket: the newest fix of
+    every driver is written with one multi-row upsert, every fix is appended
+    to the history and geofences are checked in one pass. Only enter, exit and
+    dwell transitions are written to the database.
+    """
+    latest = {}
+    for position in positions:
+        current = latest.get(position.driver_id)
+        if current is None or current.timestamp <= position.timestamp:
+            latest[position.driver_id] = position
+    latest = list(latest.values())
+    upsert_positions(db, latest)
+    db.commit()
+    location_history.append(positions)
+
+    geofence_index.ensure_fresh(db)
+    trip_corridors.ensure_loaded(db)
+    nearby = geofence_states.lookup_many(positions)
+    record_geofence_events(db, geofence_states.update_many(positions, nearby))
+    return latest, [[fence for fence, outside_km in pairs if outside_km == 0] for pairs in nearby]
+
+
+def track_position(db: Session, position):
+    """Apply one fix to the geofence state and store the transitions it caused."""
+    # Geofence state only changes on enter, exit and dwell-exceeded
+    # transitions, see app.geofence_state.GeofenceStateMachine.
+    geofence_index.ensure_fresh(db)
+    trip_corridors.ensure_loaded(db)
+    events = geofence_states.update(
+        position.driver_id, position.latitude, position.longitude, position.timestamp)
+    record_geofence_events(db, events)
+
+
+def websocket_token(websocket: WebSocket):
+    """
+    The bearer token of a WebSocket handshake, from the Authorization header
+    or, for browsers, which cannot set headers on a WebSocket, the token
+    query parameter.
+    """
+    scheme, _, token = websocket.headers.get("authorization", "").partition(" ")
+    if scheme.lower() == "bearer" and token:
+        return token
+    return websocket.query_params.get("token")
+
+
 @router.websocket("/ws/driver/{user_id}")
 async def websocket_driver(websocket: WebSocket, user_id: int):
     """
     WebSocket connection for real-time updates of the driver's location.
+
+    The driver authenticates with the same access token as the REST
+    endpoints, and only sends their own fixes. Binary messages are location
+    frames (see app.location_frames). Every frame is acknowledged with the
+    number of fixes stored.
     """
+    token = websocket_token(websocket)
+    # Sessions are opened per frame, an idle socket holds no connection
+    async with AsyncSessionLocal() as db:
+        driver = await user_from_token(token, db) if token else None
+    if not driver or driver.id != user_id or driver.role != UserRole.DRIVER:
+        await websocket.close(code=1008)
+        return
+
     await websocket.accept()
     active_connections.append(websocket)
-
     try:
         while True:
-            # Keep the connection alive and handle incoming messages
-            data = await websocket.receive_text()
-            print(f"Message from driver {user_id}: {data}")
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(message.get("code", 1000))
+
+            data = message.get("bytes")
+            if data is None:
+                # Text messages only keep the connection alive
+                continue
+
+            try:
+                lats, lngs, times = decode_frame(data)
+            except FrameError as e:
+                await websocket.send_json({"error": str(e)})
+                continue
+
+            oldest, newest = timestamp_window()
+            valid = (np.abs(lats) <= 90) & (np.abs(lngs) <= 180) & \
+                (times >= oldest.replace(tzinfo=timezone.utc).timestamp()) & \
+                (times <= newest.replace(tzinfo=timezone.utc).timestamp())
+            positions = [
+                Position(driver.id, float(lat), float(lng),
+                         datetime.utcfromtimestamp(int(timestamp)))
+                for lat, lng, timestamp in zip(lats[valid], lngs[valid], times[valid])
+            ]
+            containing = []
+            if positions:
+                async with AsyncSessionLocal() as db:
+                    latest, containing = await db.run_sync(ingest_positions, positions)
+                await location_store.prime_async(latest)
+            await websocket.send_json({
+                "accepted": len(positions),
+                "rejected": int(len(lats) - len(positions)),
+                "geofence_ids": [fence.id for fence in containing[-1]] if containing else [],
+            })
     except WebSocketDisconnect:
-        # Remove disconnected driver from active connections
-        active_connections.remove(websocket)
         print(f"Driver {user_id} disconnected.")
+    finally:
+        # Any error closes the socket too, it must not stay in the pool
+        active_connections.remove(websocket)
 
 
 @router.post("/location/", response_model=DriverLocationResponse)
 async def update_driver_location(
-    location_data: DriverLocationCreate, db: Session = Depends(get_db), token: str = Depends(oauth2_scheme)
+    location_data: DriverLocationCreate, db: AsyncSession = Depends(get_async_db),
+    current_user: User = Depends(get_current_user)
 ):
     """
-    Update or create the current location for a driver and check for geofence violations and time limits.
+    Update the current location for a driver and track geofence entries, exits and time limits.
+    Drivers may only update their own location, admins any driver's.
     """
+    if current_user.id != location_data.user_id and current_user.role != UserRole.ADMIN:
+        raise HTTPException(status_code=403, detail="Operation not permitted")
     # Fetch the user and ensure they are a driver
-    user = db.query(User).filter(User.id == location_data.user_id).first()
+    user = await db.scalar(select(User).filter(User.id == location_data.user_id))
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
-    if not user.is_driver:
+    if user.role != UserRole.DRIVER:
         raise HTTPException(status_code=403, detail="User is not a driver")
 
-    # Update the driver's location or create a new record
-    location = db.query(DriverLocation).filter(
-        DriverLocation.user_id == location_data.user_id).first()
-    if location:
-        location.latitude = location_data.latitude
-        location.longitude = location_data.longitude
-        location.updated_at = datetime.utcnow()
-    else:
-        location = DriverLocation(
-            user_id=location_data.user_id,
-            latitude=location_data.latitude,
-            longitude=location_data.longitude,
-        )
-        db.add(location)
-
-    # Check for geofence violations and time-based limits
-    geofences = db.query(Geofence).all()
-    for geofence in geofences:
-        distance_to_geofence = calculate_distance(
-            location.latitude, location.longitude, geofence.latitude, geofence.longitude
-        )
-
-        if distance_to_geofence > geofence.radius:
-            # Geofence violation: outside the allowed radius
-            send_flash_notification(
-                user.player_id,  # Assuming the user has a `player_id` for notifications
-                "Geofence Violation",
-                "You are out of the geofence area. Please return within the allowed radius."
-            )
-            raise HTTPException(
-                status_code=400,
-                detail=f"Driver is out of the geofence radius: {
-                    geofence.name}",
-            )
-
-        # Time-based geofence check (if applicable)
-        trip = db.query(Trip).filter(
-            Trip.driver_id == location_data.user_id, Trip.status == "In-Route").first()
-        if trip:
-            geofence_time_limit = geofence.time_limit_minutes
-            time_elapsed = (datetime.utcnow() -
-                            trip.start_time).total_seconds() / 60  # in minutes
-
-            if time_elapsed > geofence_time_limit:
-                # Time limit exceeded for geofence
-                send_flash_notification(
-                    user.player_id,
-                    "Geofence Time Limit Exceeded",
-                    f"You've exceeded the time limit for the geofence: {
-                        geofence.name}. Please complete the required distance."
-                )
-                raise HTTPException(
-                    status_code=400,
-                    detail=f"Driver exceeded time limit for geofence {
-                        geofence.name}.",
-                )
+    # Record the fix in the latest-position store. It reaches the
+    # driver_locations table on the next flush unless write-through is enabled.
+    location = await location_store.put_async(
+        location_data.user_id, location_data.latitude, location_data.longitude)
+    if location_store.write_through:
+        await db.run_sync(location_store.flush)
+    location_history.append([location])
+    await db.run_sync(track_position, location)
 
-    db.commit()
-    db.refresh(location)
-    return location
+    return location._asdict()
+
+
+@router.post("/locations/batch/", response_model=List[DriverLocationFixResult])
+async def ingest_driver_locations(
+    batch: DriverLocationBatch, db: AsyncSession = Depends(get_async_db),
+    user: User = Depends(get_current_user)
+):
+    """
+    Ingest a batch of fixes from a telematics gateway and return one result per fix.
+
+    Gateways authenticate as an admin and may send any driver's fixes, a
+    driver only their own. Drivers are looked up with one query and the
+    accepted fixes go through ingest_positions together.
+    """
+    fixes = batch.fixes
+    now = datetime.utcnow()
+    results = [
+        {"index": i, "driver_id": fix.driver_id, "status": "accepted", "detail": None}
+        for i, fix in enumerate(fixes)
+    ]
+
+    driver_ids = {fix.driver_id for fix in fixes}
+    known_drivers = set(await db.scalars(select(User.id).filter(
+        User.id.in_(driver_ids), User.role == UserRole.DRIVER)))
+
+    oldest, newest = timestamp_window(now)
+    accepted = []
+    for result, fix in zip(results, fixes):
+        if user.role != UserRole.ADMIN and fix.driver_id != user.id:
+            result.update(status="rejected", detail="Not permitted")
+        elif fix.driver_id not in known_drivers:
+            result.update(status="rejected", detail="Unknown driver")
+        elif not (-90 <= fix.latitude <= 90 and -180 <= fix.longitude <= 180):
+            result.update(status="rejected", detail="Invalid coordinates")
+        elif fix.timestamp is not None and not oldest <= fix.timestamp <= newest:
+            result.update(status="rejected", detail="Timestamp out of range")
+        else:
+            accepted.append((result, Position(
+                fix.driver_id, fix.latitude, fix.longitude, fix.timestamp or now)))
+
+    latest, containing = await db.run_sync(ingest_positions, [position for _, position in accepted])
+    await location_store.prime_async(latest)
+    for (result, _), fences in zip(accepted, containing):
+        result["geofence_ids"] = [fence.id for fence in fences]
+        result["outside_geofence"] = bool(len(geofence_index)) and not fences
+
+    # The results are plain JSON already, skip per-item response validation
+    return JSONResponse(content=results)
 
 
 @router.get("/location/{user_id}/", response_model=DriverLocationResponse)
-async def get_driver_location(user_id: int, db: Session = Depends(get_db)):
+async def get_driver_location(user_id: int, db: AsyncSession = Depends(get_read_db)):
     """
     Retrieve the current location of a driver.
     """
-    location = db.query(DriverLocation).filter(
-        DriverLocation.user_id == user_id).first()
+    position = await location_store.get_async(user_id)
+    if position:
+        return position._asdict()
+
+    location = await db.scalar(select(DriverLocation).filter(
+        DriverLocation.driver_id == user_id))
     if not location:
         raise HTTPException(
             status_code=404, detail="Driver location not found")
 
+    await location_store.prime_async([Position(
+        location.driver_id, location.latitude, location.longitude, location.timestamp)])
     return location
+
+
+@router.get("/history/{user_id}/")
+async def get_driver_location_history(
+    user_id: int, start: datetime, end: datetime, db: AsyncSession = Depends(get_async_db),
+    user: User = Depends(get_current_user)
+):
+    """
+    Retrieve the recorded fixes of a driver between two timestamps, oldest
+    first. Drivers may only read their own history, admins any driver's.
+    """
+    if user.id != user_id and user.role != UserRole.ADMIN:
+        raise HTTPException(status_code=403, detail="Operation not permitted")
+    fixes = (await db.scalars(select(DriverLocationHistory).filter(
+        DriverLocationHistory.driver_id == user_id,
+        DriverLocationHistory.recorded_at >= start,
+        DriverLocationHistory.recorded_at < end,
+    ).order_by(DriverLocationHistory.recorded_at))).all()
+
+    return [
+        {"latitude": fix.latitude, "longitude": fix.longitude,
+            "timestamp": fix.recorded_at}
+        for fix in fixes
+    ]
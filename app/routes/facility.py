@@ -0,0 +1,50 @@
+import asyncio
+from fastapi import APIRouter, Depends, HTTPException
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from app import models, schemas
+from app.db import get_async_db, run_in_session
+from app.facility_matrix import facility_matrix
+from app.models import UserRole
+from app.routes.auth import role_required
+
+router = APIRouter()
+
+
+@router.post("/", response_model=schemas.FacilityResponse)
+async def create_facility(
+    facility: schemas.FacilityCreate,
+    db: AsyncSession = Depends(get_async_db),
+    user: models.User = Depends(role_required(UserRole.ADMIN))
+):
+    """Add a depot or post office and its rows to the distance matrix."""
+    if await db.scalar(select(models.Facility.id).filter(models.Facility.name == facility.name)):
+        raise HTTPException(status_code=400, detail="Facility already exists")
+
+    new_facility = models.Facility(**facility.dict())
+    db.add(new_facility)
+    await db.commit()
+    await db.refresh(new_facility)
+
+    # Only the new facility's rows and columns are computed
+    await asyncio.to_thread(run_in_session, facility_matrix.sync)
+    return new_facility
+
+
+@router.get("/", response_model=list[schemas.FacilityResponse])
+async def get_facilities(db: AsyncSession = Depends(get_async_db)):
+    return (await db.scalars(select(models.Facility).order_by(models.Facility.name))).all()
+
+
+@router.get("/{source_id}/to/{destination_id}", response_model=schemas.FacilityLegResponse)
+async def get_facility_leg(source_id: int, destination_id: int):
+    """Precomputed road distance and travel time between two facilities."""
+    facility_matrix.ensure_fresh()
+    if source_id not in facility_matrix or destination_id not in facility_matrix:
+        raise HTTPException(status_code=404, detail="Facility not found")
+    return {
+        "source_id": source_id,
+        "destination_id": destination_id,
+        "distance_km": facility_matrix.distance_km(source_id, destination_id),
+        "duration_s": facility_matrix.duration_s(source_id, destination_id),
+    }
@@ -1,64 +1,156 @@
-import asyncio
-from fastapi import APIRouter, Depends, HTTPException
+import bisect
+import json
+from fastapi import APIRouter, Depends, HTTPException, Response
+from fastapi.encoders import jsonable_encoder
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 from app import models
 from app.models import UserRole, Geofence
 from app import schemas
 from app.schemas import GeofenceCreate, GeofenceResponse
-from app.routes.auth import get_current_user
-from app.db import get_db
+from app.db import get_async_db, get_read_db
+from app.spatial import geofence_index
+from app.geometry import as_polygon, bounding_circle
+from app.utils import sync_geofence_to_mapmyindia, MAPMYINDIA_SYNC_ENABLED
 from app.routes.auth import role_required
-from datetime import datetime
+from app.pagination import PageParams, keyset, page_response
 
 router = APIRouter()
 
 
+def geofence_to_response(geofence: models.Geofence):
+    return {
+        "id": geofence.id,
+        "lat": geofence.latitude,
+        "lng": geofence.longitude,
+        "radius": geofence.radius,
+        "time_limit_minutes": geofence.time_limit_minutes,
+        "shape": geofence.shape,
+        "polygon": json.loads(geofence.polygon) if geofence.polygon else None,
+        "valid_from": geofence.valid_from,
+        "valid_until": geofence.valid_until,
+    }
+
+
+def fence_entry_to_response(entry):
+    return {
+        "id": entry.id,
+        "lat": entry.latitude,
+        "lng": entry.longitude,
+        "radius": entry.radius,
+        "time_limit_minutes": entry.time_limit_minutes,
+        "shape": "circle" if entry.polygon is None else "polygon",
+        "polygon": None if entry.polygon is None else entry.polygon.tolist(),
+        "valid_from": entry.valid_from,
+        "valid_until": entry.valid_until,
+    }
+
+
+# Active geofences in id order, their ids, their JSON body, and the index version they were built from
+_active_geofences_cache = (None, [], [], b"[]")
+
+
+def active_geofences(db: Session):
+    """Active geofences from the in-memory index, listed and encoded once per index rebuild."""
+    global _active_geofences_cache
+    geofence_index.ensure_fresh(db)
+    if _active_geofences_cache[0] != geofence_index.version:
+        version = geofence_index.version
+        fences = jsonable_encoder(sorted(
+            (fence_entry_to_response(entry) for entry in geofence_index.entries()), key=lambda fence: fence["id"]))
+        _active_geofences_cache = (version, [fence["id"] for fence in fences], fences, json.dumps(fences).encode())
+    return _active_geofences_cache[1:]
+
+
 @router.post("/create-geofence/", response_model=GeofenceResponse, dependencies=[Depends(role_required(UserRole.ADMIN))])
-async def create_geofence(geofence_data: GeofenceCreate, db: Session = Depends(get_db)):
-    if geofence_data.radius <= 0:
-        raise HTTPException(
-            status_code=400, detail="Radius must be greater than 0.")
+async def create_geofence(geofence_data: GeofenceCreate, db: AsyncSession = Depends(get_async_db)):
     if geofence_data.time_limit_minutes <= 0:
         raise HTTPException(
             status_code=400, detail="Time limit must be greater than 0.")
 
+    if geofence_data.shape == "polygon":
+        try:
+            polygon = as_polygon(geofence_data.polygon or [])
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        # The bounding circle lets the spatial index treat polygons like circles
+        lat, lng, radius = bounding_circle(polygon)
+        polygon_json = json.dumps(polygon.tolist())
+    elif geofence_data.shape == "circle":
+        if geofence_data.lat is None or geofence_data.lng is None or geofence_data.radius is None:
+            raise HTTPException(
+                status_code=400, detail="Circle geofences need lat, lng and radius.")
+        if geofence_data.radius <= 0:
+            raise HTTPException(
+                status_code=400, detail="Radius must be greater than 0.")
+        lat, lng, radius = geofence_data.lat, geofence_data.lng, geofence_data.radius
+        polygon_json = None
+    else:
+        raise HTTPException(
+            status_code=400, detail="Shape must be 'circle' or 'polygon'.")
+
+    if (geofence_data.valid_from and geofence_data.valid_until
+            and geofence_data.valid_until <= geofence_data.valid_from):
+        raise HTTPException(
+            status_code=400, detail="valid_until must be after valid_from.")
+
     new_geofence = Geofence(
-        latitude=geofence_data.latitude,
-        longitude=geofence_data.longitude,
-        radius=geofence_data.radius,
+        latitude=lat,
+        longitude=lng,
+        radius=radius,
         time_limit_minutes=geofence_data.time_limit_minutes,
-        name=f"Geofence_{geofence_data.latitude}_{
-            geofence_data.longitude}_{datetime.now().isoformat()}",
+        shape=geofence_data.shape,
+        polygon=polygon_json,
+        valid_from=geofence_data.valid_from,
+        valid_until=geofence_data.valid_until,
     )
     db.add(new_geofence)
+    await db.commit()
+    await db.refresh(new_geofence)
+
+    # Rebuild the in-memory index so location updates see the new fence
+    await db.run_sync(geofence_index.refresh)
+
+    # MapMyIndia is only a mirror, a failed sync does not fail the request
+    if MAPMYINDIA_SYNC_ENABLED:
+        try:
+            await sync_geofence_to_mapmyindia(new_geofence)
+        except Exception as e:
+            print(f"Error syncing geofence {new_geofence.id} to MapMyIndia: {e}")
+
+    return geofence_to_response(new_geofence)
 
 
 @router.get("/get-geofences/", response_model=list[schemas.GeofenceResponse])
-async def get_geofences(db: Session = Depends(get_db)):
-    geofences = db.query(models.Geofence).all()
-    if not geofences:
+async def get_geofences(
+    include_inactive: bool = False, page: PageParams = Depends(), db: AsyncSession = Depends(get_read_db)
+):
+    """
+    Return the geofences valid now, a page at a time in id order, served from
+    the in-memory index. With include_inactive, expired and future fences are
+    read from the database too.
+    """
+    fields = page.selected_fields(GeofenceResponse.__fields__)
+    if include_inactive:
+        geofences = (await db.scalars(keyset(select(models.Geofence), page, models.Geofence.id))).all()
+        if not geofences and page.cursor is None:
+            raise HTTPException(status_code=404, detail="No geofences found")
+        return page_response(geofences, page, lambda geofence: [geofence.id], geofence_to_response, fields)
+
+    ids, fences, body = await db.run_sync(active_geofences)
+    if not fences:
         raise HTTPException(status_code=404, detail="No geofences found")
-    return geofences
-
-
-async def schedule_geofence_regeneration(geofence_id: int, time_limit_minutes: int, db: Session):
-    await asyncio.sleep(time_limit_minutes * 60)
-    existing_geofence = db.query(models.Geofence).filter(
-        models.Geofence.id == geofence_id).first()
-    if not existing_geofence:
-        return
-
-    new_geofence = models.Geofence(
-        latitude=existing_geofence.latitude,
-        longitude=existing_geofence.longitude,
-        radius=existing_geofence.radius,
-        time_limit_minutes=existing_geofence.time_limit_minutes,
-        name=f"Geofence_{existing_geofence.latitude}_{
-            existing_geofence.longitude}_{datetime.now().isoformat()}",
-    )
-    db.add(new_geofence)
-    db.commit()
-    db.refresh(new_geofence)
+    # A single full page is the cached body, which skips per-request validation and encoding
+    if page.cursor is None and fields is None and len(fences) <= page.limit:
+        return Response(content=body, media_type="application/json")
+    after = page.after(1)
+    start = 0 if after is None else bisect.bisect_right(ids, after[0])
+    return page_response(fences[start:start + page.limit + 1], page, lambda fence: [fence["id"]], fields=fields)
+
 
-    asyncio.create_task(schedule_geofence_regeneration(
-        new_geofence.id, new_geofence.time_limit_minutes, db))
+@router.get("/check/")
+async def check_point(lat: float, lng: float, db: AsyncSession = Depends(get_async_db)):
+    """Return the geofences containing a point, evaluated in-process."""
+    await db.run_sync(geofence_index.ensure_fresh)
+    return {"geofence_ids": [fence.id for fence in geofence_index.containing(lat, lng)]}
@@ -0,0 +1,25 @@
+from fastapi import APIRouter, Depends
+from app import models
+from app.models import UserRole
+from app.routes.auth import role_required
+from app.route_cache import route_cache
+from app.db import replicas
+from app.db_metrics import db_metrics
+
+router = APIRouter()
+
+
+@router.get("/route-cache")
+async def get_route_cache_metrics(user: models.User = Depends(role_required(UserRole.ADMIN))):
+    """Hit counts, hit rate and lookup and upstream latency percentiles (ms) of this worker's route cache."""
+    return route_cache.stats()
+
+
+@router.get("/db")
+async def get_db_metrics(user: models.User = Depends(role_required(UserRole.ADMIN))):
+    """
+    Connection pool gauges and checkout waits, query count and time per
+    route, the slowest statements with the types of their parameters, and
+    the health of the read replicas.
+    """
+    return {**db_metrics.stats(), "replicas": replicas.stats()}
@@ -1,7 +1,7 @@
 from fastapi import APIRouter, Depends
-from sqlalchemy.orm import Session
-from sqlalchemy import func
-from app.db import get_db
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.db import get_read_db
 from app import models, schemas
 from app.models import UserRole  
 from app.routes.auth import role_required
@@ -11,24 +11,25 @@ router = APIRouter()
 
 @router.get("/driver-reports", response_model=list[schemas.DriverReportSummary])
 async def get_driver_reports(
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_read_db),
     user: models.User = Depends(role_required(UserRole.ADMIN))
 ):
     """
     Fetch a list of all drivers sorted by their number of delay reports (desc).
     """
     drivers_with_reports = (
-        db.query(
-            models.User.id.label("driver_id"),
-            models.User.name.label("driver_name"),
-            func.count(models.DelayReport.id).label("total_reports")
+        await db.execute(
+            select(
+                models.User.id.label("driver_id"),
+                models.User.name.label("driver_name"),
+                func.count(models.DelayReport.id).label("total_reports")
+            )
+            .join(models.DelayReport, models.User.id == models.DelayReport.driver_id, isouter=True)
+            .filter(models.User.role == UserRole.DRIVER)  # Use UserRole enum
+            .group_by(models.User.id)
+            .order_by(func.count(models.DelayReport.id).desc())
         )
-        .join(models.DelayReport, models.User.id == models.DelayReport.driver_id, isouter=True)
-        .filter(models.User.role == UserRole.DRIVER)  # Use UserRole enum
-        .group_by(models.User.id)
-        .order_by(func.count(models.DelayReport.id).desc())
-        .all()
-    )
+    ).all()
 
     return [
         {"driver_id": row.driver_id, "driver_name": row.driver_name,
@@ -1,84 +1,429 @@
-from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
-from datetime import datetime
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, Request
+from pydantic import ValidationError
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session, joinedload, load_only, selectinload
+from datetime import datetime, timedelta
 from app import models, schemas
-from app.db import get_db
+from app.db import get_async_db, get_read_db, AsyncSessionLocal, run_in_session
 from app.routes.auth import role_required
-from app.utils import (
-    check_geofence, calculate_distance, send_flash_notification,
-    get_best_route_from_api
-)
-from app.models import DelayReport, Geofence, Trip, UserRole
-from typing import List
+from app.utils import send_flash_notification
+from app.models import DelayReport, Geofence, Trip, TripStatus, UserRole
+from app.spatial import driver_index, geofence_index
+from app.corridor import refresh_trip_corridor, trip_corridors
+from app.matching import assign_pending_trips, MATCHING_ROUTE_CONCURRENCY
+from app.geofence_state import geofence_states
+from app.location_store import location_store
+from app.scheduler import scheduler
+from app.route_cache import route_cache
+from app import sequencing
+from app.facility_matrix import facility_matrix
+from app.geocoding import geocoder
+from app.pagination import PageParams, keyset, page_response
+from app import trip_import
+from typing import List, Optional
 import asyncio
 
 router = APIRouter()
 
+GEOFENCE_TIMER = "geofence_timer"
+
+
+async def trip_stops(db: AsyncSession, trip_id: int):
+    """The trip's intermediate destinations in visiting order."""
+    return (await db.scalars(
+        select(models.IntermediateDestination)
+        .filter(models.IntermediateDestination.trip_id == trip_id)
+        .order_by(models.IntermediateDestination.sequence)
+    )).all()
+
+
+def route_location(name, lat, lng):
+    """
+    A stop as the router takes it: "lat,lng" once it has been geocoded, so
+    the local road graph can route it without another lookup, else its name.
+    """
+    if lat is None or lng is None:
+        return name
+    return f"{lat},{lng}"
+
+
+async def plan_trip_route(db: AsyncSession, trip: models.Trip, stops=None):
+    """
+    Fetch the best route through the trip's stops and precompute the ordered
+    geofences along it. Returns the route, or None when it could not be determined.
+    The stops are queried unless the caller has them loaded already.
+    """
+    if stops is None:
+        stops = await trip_stops(db, trip.id)
+    waypoints = [
+        route_location(stop.destination, stop.latitude, stop.longitude)
+        for stop in sorted(stops, key=lambda stop: stop.sequence)
+    ]
+    best_route = await route_cache.get_route(
+        route_location(trip.source, trip.source_lat, trip.source_lng),
+        route_location(trip.destination, trip.destination_lat, trip.destination_lng),
+        waypoints,
+    )
+    if best_route:
+        trip.route_details = best_route
+        await db.run_sync(refresh_trip_corridor, trip)
+    return best_route
+
+
+def stop_coordinates(stops):
+    """
+    (lat, lng) of every stop, taken from the facility of the same name when
+    the stop has none. None when a stop cannot be placed.
+    """
+    facility_matrix.ensure_fresh()
+    points = []
+    for stop in stops:
+        if stop.latitude is not None and stop.longitude is not None:
+            points.append((stop.latitude, stop.longitude))
+            continue
+        facility_id = facility_matrix.find(stop.destination)
+        if facility_id is None:
+            return None
+        points.append(facility_matrix.coordinates(facility_id))
+    return points
+
+
+async def geocode_trips(db: AsyncSession, trips):
+    """
+    Fill in the coordinates the requests left out, for the source, the
+    destination and every stop of each (trip, stops) pair, with one geocoder
+    lookup. Places that cannot be resolved stay without coordinates.
+    """
+    wanted = []
+    for trip, stops in trips:
+        if trip.source_lat is None or trip.source_lng is None:
+            wanted.append(trip.source)
+        if trip.destination_lat is None or trip.destination_lng is None:
+            wanted.append(trip.destination)
+        wanted += [stop.destination for stop in stops if stop.latitude is None or stop.longitude is None]
+    if not wanted:
+        return
+    points = await geocoder.resolve_many(db, wanted)
+
+    for trip, stops in trips:
+        if (trip.source_lat is None or trip.source_lng is None) and points.get(trip.source):
+            trip.source_lat, trip.source_lng = points[trip.source]
+        if (trip.destination_lat is None or trip.destination_lng is None) and points.get(trip.destination):
+            trip.destination_lat, trip.destination_lng = points[trip.destination]
+        for stop in stops:
+            if (stop.latitude is None or stop.longitude is None) and points.get(stop.destination):
+                stop.latitude, stop.longitude = points[stop.destination]
+
+
+async def geocode_trip(db: AsyncSession, trip: schemas.TripCreate, stops):
+    """Fill in the coordinates of one trip, see geocode_trips."""
+    await geocode_trips(db, [(trip, stops)])
+
+
+def order_trip_stops(trip, stops):
+    """
+    The order of the trip's stops, given in visiting order, that makes the
+    shortest path from source to destination, as indexes into stops. Uses the
+    road distances of the facility matrix when every stop is a facility,
+    great-circle distances otherwise. Returns the order and the path length
+    (km) before and after.
+    """
+    points = stop_coordinates(stops)
+    if points is None:
+        raise HTTPException(
+            status_code=400, detail="Every intermediate destination needs coordinates to optimize the stop order")
+
+    stop_ids = [facility_matrix.find(stop.destination) for stop in stops]
+    if len(stops) > 1 and None not in stop_ids:
+        source_id = facility_matrix.find(trip.source)
+        destination_id = facility_matrix.find(trip.destination)
+        ids = [source_id or stop_ids[0]] + stop_ids + [destination_id or stop_ids[0]]
+        order, before, after = sequencing.optimize_order(
+            facility_matrix.submatrix(ids), source_id is not None, destination_id is not None)
+    else:
+        start = end = None
+        if trip.source_lat is not None and trip.source_lng is not None:
+            start = (trip.source_lat, trip.source_lng)
+        if trip.destination_lat is not None and trip.destination_lng is not None:
+            end = (trip.destination_lat, trip.destination_lng)
+        order, before, after = sequencing.optimize_stop_order(points, start, end)
+    return order, before, after
+
+
+def sequence_trip_stops(db: Session, trip: models.Trip, stops):
+    """
+    Renumber the trip's intermediate destinations (stops) in the shortest
+    order, see order_trip_stops. Returns the path length (km) before and after.
+    """
+    stops = sorted(stops, key=lambda stop: stop.sequence)
+    order, before, after = order_trip_stops(trip, stops)
+
+    # Negative sequences first, so the renumbering never collides with unique_trip_sequence
+    for stop in stops:
+        stop.sequence = -stop.sequence
+    db.flush()
+    for sequence, index in enumerate(order, start=1):
+        stops[index].sequence = sequence
+    db.flush()
+    return before, after
+
+
+def trip_dwell_violations(db: Session, driver_id, lat, lng, timestamp):
+    """The fences whose time limit the trip's driver has exceeded, see GeofenceStateMachine.dwell_exceeded."""
+    geofence_index.ensure_fresh(db)
+    trip_corridors.ensure_loaded(db)
+    return geofence_states.dwell_exceeded(driver_id, lat, lng, timestamp)
+
+
+def release_trip_corridor(trip: models.Trip, status: str):
+    """Stop using the trip's corridor once the trip is over."""
+    if status in (TripStatus.COMPLETED.value, TripStatus.CANCELED.value):
+        trip_corridors.discard(trip.id)
+
+
+def initial_status(trip: schemas.TripCreate):
+    """Trips created with a driver start in route, the others wait for dispatch."""
+    return TripStatus.PENDING if trip.driver_id is None else TripStatus.IN_ROUTE
+
 
 @router.post("/")
 async def create_trip(
     trip: schemas.TripCreate,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     user: models.User = Depends(role_required(UserRole.ADMIN))
 ):
     """Create a new trip and assign it to a vehicle."""
-    vehicle = db.query(models.Vehicle).filter(
-        models.Vehicle.id == trip.vehicle_id).first()
+    vehicle = await db.get(models.Vehicle, trip.vehicle_id)
     if not vehicle:
         raise HTTPException(status_code=404, detail="Vehicle not found")
 
-    new_trip = models.Trip(**trip.dict(), status="In-Route")
+    stops = [
+        stop if isinstance(stop, schemas.IntermediateStop) else schemas.IntermediateStop(destination=stop)
+        for stop in trip.intermediate_destinations or []
+    ]
+    # Resolved once here, so routing, matching and geofencing never geocode
+    await geocode_trip(db, trip, stops)
+    if trip.optimize_stop_order and stop_coordinates(stops) is None:
+        raise HTTPException(
+            status_code=400, detail="Every intermediate destination needs coordinates to optimize the stop order")
+
+    new_trip = models.Trip(
+        **trip.dict(exclude={"intermediate_destinations", "optimize_stop_order", "status"}), status=initial_status(trip))
     db.add(new_trip)
-    db.commit()
-    db.refresh(new_trip)
+    await db.flush()
 
     # Add intermediate destinations if provided
-    if trip.intermediate_destinations:
-        for sequence, destination in enumerate(trip.intermediate_destinations, start=1):
-            intermediate = models.IntermediateDestination(
-                trip_id=new_trip.id, destination=destination, sequence=sequence
-            )
-            db.add(intermediate)
-        db.commit()
+    intermediates = [
+        models.IntermediateDestination(trip_id=new_trip.id, sequence=sequence, **stop.dict())
+        for sequence, stop in enumerate(stops, start=1)
+    ]
+    db.add_all(intermediates)
+    await db.commit()
+    if intermediates and trip.optimize_stop_order:
+        await db.run_sync(sequence_trip_stops, new_trip, intermediates)
+        await db.commit()
+
+    # The trip is created even when no route can be found, the corridor is
+    # then computed on assignment
+    await plan_trip_route(db, new_trip, intermediates)
+    await db.commit()
 
     return {"message": "Trip created successfully", "trip_id": new_trip.id}
 
 
-@router.get("/{vehicle_id}")
-async def get_trips(vehicle_id: int, db: Session = Depends(get_db)):
-    """Retrieve all trips assigned to a specific vehicle."""
-    trips = db.query(models.Trip).filter(
-        models.Trip.vehicle_id == vehicle_id).all()
+class TripImport:
+    """Outcome of a bulk import: rows imported, and the rows that failed with their errors."""
+
+    def __init__(self):
+        self.imported = 0
+        self.failed = 0
+        self.errors = []
+
+    def fail(self, row, *errors):
+        self.failed += 1
+        if len(self.errors) < trip_import.TRIP_IMPORT_MAX_ERRORS:
+            self.errors.append({"row": row, "errors": list(errors)})
+
+
+def validate_trip_rows(rows, report: TripImport):
+    """Parse the rows of a chunk as TripCreate, with their stops in visiting order."""
+    valid = []
+    for row, data in rows:
+        if isinstance(data, trip_import.RowError):
+            report.fail(row, str(data))
+            continue
+        try:
+            trip = schemas.TripCreate(**data)
+        except ValidationError as e:
+            report.fail(row, *(f"{'.'.join(map(str, error['loc']))}: {error['msg']}" for error in e.errors()))
+            continue
+        stops = [
+            stop if isinstance(stop, schemas.IntermediateStop) else schemas.IntermediateStop(destination=stop)
+            for stop in trip.intermediate_destinations or []
+        ]
+        valid.append((row, trip, stops))
+    return valid
+
+
+def optimize_trip_rows(trips, report: TripImport):
+    """Reorder the stops of the trips that ask for it, dropping the trips whose stops cannot be ordered."""
+    optimized = []
+    for row, trip, stops in trips:
+        if trip.optimize_stop_order and stops:
+            try:
+                order, _, _ = order_trip_stops(trip, stops)
+            except HTTPException as e:
+                report.fail(row, e.detail)
+                continue
+            stops = [stops[index] for index in order]
+        optimized.append((row, trip, stops))
+    return optimized
+
+
+async def import_trip_chunk(db: AsyncSession, rows, report: TripImport):
+    """Validate, geocode and insert one chunk of uploaded rows, in a transaction of its own."""
+    trips = await asyncio.to_thread(validate_trip_rows, rows, report)
     if not trips:
+        return
+    found = trips
+    try:
+        vehicle_ids = set((await db.scalars(select(models.Vehicle.id).filter(
+            models.Vehicle.id.in_({trip.vehicle_id for _, trip, _ in trips})))).all())
+        driver_ids = set((await db.scalars(select(models.User.id).filter(
+            models.User.id.in_({trip.driver_id for _, trip, _ in trips if trip.driver_id is not None})))).all())
+        found = []
+        for row, trip, stops in trips:
+            if trip.vehicle_id not in vehicle_ids:
+                report.fail(row, "Vehicle not found")
+            elif trip.driver_id is not None and trip.driver_id not in driver_ids:
+                report.fail(row, "Driver not found")
+            else:
+                found.append((row, trip, stops))
+
+        await geocode_trips(db, [(trip, stops) for _, trip, stops in found])
+        found = await asyncio.to_thread(optimize_trip_rows, found, report)
+        if found:
+            await trip_import.insert_trips(
+                db,
+                [dict(trip.dict(exclude={"intermediate_destinations", "optimize_stop_order", "status"}),
+                      status=initial_status(trip)) for _, trip, _ in found],
+                [[dict(stop.dict(), sequence=sequence) for sequence, stop in enumerate(stops, start=1)]
+                 for _, _, stops in found],
+            )
+        await db.commit()
+        report.imported += len(found)
+    except Exception as e:
+        # The whole chunk is rolled back, its rows are reported and the import goes on
+        await db.rollback()
+        print(f"Error importing trips from line {rows[0][0]}: {e}")
+        for row, _, _ in found:
+            report.fail(row, f"Not imported, the rows of its chunk failed to save: {e}")
+
+
+@router.post("/import", response_model=schemas.TripImportResponse)
+async def import_trips(
+    request: Request,
+    format: Optional[str] = None,
+    db: AsyncSession = Depends(get_async_db),
+    user: models.User = Depends(role_required(UserRole.ADMIN))
+):
+    """
+    Create trips in bulk from a CSV file (text/csv) or newline-delimited JSON
+    (application/x-ndjson) sent as the request body, or with ?format=csv|ndjson.
+    Rows have the fields of a trip creation request. In CSV the first row
+    names the columns and the stops are separated by semicolons. The upload
+    is read as a stream and written TRIP_IMPORT_CHUNK rows per transaction.
+    Invalid rows are skipped and reported with their line. Routes are planned
+    on assignment.
+    """
+    content_type = request.headers.get("content-type", "").split(";")[0].strip()
+    format = format or ("csv" if content_type in ("text/csv", "application/csv") else
+                        "ndjson" if content_type in ("application/x-ndjson", "application/jsonl") else None)
+    if format not in ("csv", "ndjson"):
+        raise HTTPException(
+            status_code=415, detail="Send text/csv or application/x-ndjson, or pass ?format=csv|ndjson")
+
+    lines = trip_import.iter_lines(request.stream())
+    rows = trip_import.csv_rows(lines) if format == "csv" else trip_import.ndjson_rows(lines)
+    report = TripImport()
+    chunk = []
+    async for row in rows:
+        chunk.append(row)
+        if len(chunk) >= trip_import.TRIP_IMPORT_CHUNK:
+            await import_trip_chunk(db, chunk, report)
+            chunk = []
+    if chunk:
+        await import_trip_chunk(db, chunk, report)
+    report.errors.sort(key=lambda error: error["row"])
+
+    print(f"Trip import by user {user.id}: {report.imported} imported, {report.failed} failed")
+    return {"imported": report.imported, "failed": report.failed, "errors": report.errors}
+
+
+def trip_fields(trip: models.Trip, fields):
+    """The selected TripSummary fields of a trip loaded with only their columns."""
+    selected = {field: getattr(trip, field) for field in fields if field != "intermediate_destinations"}
+    if "intermediate_destinations" in fields:
+        selected["intermediate_destinations"] = [
+            schemas.IntermediateDestinationResponse.from_orm(stop) for stop in trip.intermediate_destinations]
+    return selected
+
+
+# Fields of TripSummary, the route and corridor JSON are left in the database
+TRIP_SUMMARY_FIELDS = list(schemas.TripSummary.__fields__)
+
+
+@router.get("/{vehicle_id}", response_model=List[schemas.TripSummary])
+async def get_trips(vehicle_id: int, page: PageParams = Depends(), db: AsyncSession = Depends(get_read_db)):
+    """
+    Retrieve the trips assigned to a specific vehicle, with their stops, a page
+    at a time in id order. Only the selected fields are read from the database.
+    """
+    fields = page.selected_fields(TRIP_SUMMARY_FIELDS)
+    columns = [getattr(models.Trip, field) for field in fields or TRIP_SUMMARY_FIELDS
+               if field != "intermediate_destinations"]
+    options = [load_only(models.Trip.id, *columns, raiseload=True)]
+    if fields is None or "intermediate_destinations" in fields:
+        # One query for the stops of the whole page
+        options.append(selectinload(models.Trip.intermediate_destinations))
+    trips = (await db.scalars(keyset(
+        select(models.Trip).options(*options).filter(models.Trip.vehicle_id == vehicle_id),
+        page, models.Trip.id,
+    ))).all()
+    if not trips and page.cursor is None:
         raise HTTPException(
             status_code=404, detail="No trips found for this vehicle")
-    return trips
+    if fields is None:
+        return page_response(trips, page, lambda trip: [trip.id], schemas.TripSummary.from_orm)
+    return page_response(trips, page, lambda trip: [trip.id], lambda trip: trip_fields(trip, fields), fields)
 
 
 @router.patch("/{trip_id}/status")
 async def update_trip_status(
-    trip_id: int, status: str, db: Session = Depends(get_db),
+    trip_id: int, status: str, db: AsyncSession = Depends(get_async_db),
     user: models.User = Depends(role_required(UserRole.DRIVER))
 ):
     """Update the status of a trip (e.g., In-Route, Delivered, Delayed)."""
-    trip = db.query(models.Trip).filter(models.Trip.id == trip_id).first()
+    trip = await db.get(models.Trip, trip_id)
     if not trip:
         raise HTTPException(status_code=404, detail="Trip not found")
 
     trip.status = status
     trip.updated_at = datetime.utcnow()
-    db.commit()
+    await db.commit()
+    release_trip_corridor(trip, status)
 
     return {"message": f"Trip status updated to {status}"}
 
 
 @router.post("/{trip_id}/vote")
 async def vote_trip(
-    trip_id: int, vote: str, db: Session = Depends(get_db),
+    trip_id: int, vote: str, db: AsyncSession = Depends(get_async_db),
     user: models.User = Depends(role_required(UserRole.DRIVER))
 ):
     """Allow drivers to upvote or downvote trip performance."""
-    trip = db.query(models.Trip).filter(models.Trip.id == trip_id).first()
+    trip = await db.get(models.Trip, trip_id)
     if not trip:
         raise HTTPException(status_code=404, detail="Trip not found")
 
@@ -89,212 +434,296 @@ async def vote_trip(
     else:
         raise HTTPException(status_code=400, detail="Invalid vote type")
 
-    db.commit()
+    await db.commit()
     return {"message": f"Trip {vote}d successfully"}
 
 
 @router.put("/{trip_id}/add-intermediate-destination/")
 async def add_intermediate_destination(
     trip_id: int, destination: str, sequence: int,
-    db: Session = Depends(get_db), user: models.User = Depends(role_required(UserRole.ADMIN))
+    latitude: Optional[float] = None, longitude: Optional[float] = None, optimize_stop_order: bool = False,
+    db: AsyncSession = Depends(get_async_db), user: models.User = Depends(role_required(UserRole.ADMIN))
 ):
-    """Admin can add an intermediate destination to an existing trip."""
-    trip = db.query(models.Trip).filter(models.Trip.id == trip_id).first()
+    """
+    Admin can add an intermediate destination to an existing trip, and
+    optionally reorder all of its stops for the shortest path.
+    """
+    trip = await db.get(models.Trip, trip_id)
     if not trip:
         raise HTTPException(status_code=404, detail="Trip not found")
 
+    if latitude is None or longitude is None:
+        point = await geocoder.resolve(db, destination)
+        if point is not None:
+            latitude, longitude = point
     intermediate = models.IntermediateDestination(
-        trip_id=trip_id, destination=destination, sequence=sequence
+        trip_id=trip_id, destination=destination, sequence=sequence,
+        latitude=latitude, longitude=longitude
     )
     db.add(intermediate)
-    db.commit()
-    db.refresh(intermediate)
+    await db.flush()
+    stops = await trip_stops(db, trip_id)
+    if optimize_stop_order:
+        await db.run_sync(sequence_trip_stops, trip, stops)
+    await db.commit()
+
+    # The new stop changes the route, and with it the fences along the way
+    await plan_trip_route(db, trip, stops)
+    await db.commit()
 
     return {"message": "Intermediate destination added successfully", "destination": intermediate}
 
 
-@router.get("/{trip_id}/intermediate_destinations")
+@router.put("/{trip_id}/optimize-stop-order", response_model=schemas.StopOrderResponse)
+async def optimize_trip_stop_order(
+    trip_id: int, db: AsyncSession = Depends(get_async_db), user: models.User = Depends(role_required(UserRole.ADMIN))
+):
+    """Reorder a trip's intermediate destinations for the shortest path and replan its route."""
+    trip = await db.get(models.Trip, trip_id)
+    if not trip:
+        raise HTTPException(status_code=404, detail="Trip not found")
+
+    stops = await trip_stops(db, trip_id)
+    before, after = await db.run_sync(sequence_trip_stops, trip, stops)
+    await db.commit()
+    await plan_trip_route(db, trip, stops)
+    await db.commit()
+
+    return {
+        "message": "Stop order optimized",
+        "stops": sorted(stops, key=lambda stop: stop.sequence),
+        "distance_before_km": before,
+        "distance_after_km": after,
+    }
+
+
+@router.get("/{trip_id}/intermediate_destinations", response_model=List[schemas.IntermediateDestinationResponse])
 async def get_intermediate_destinations(
-    trip_id: int, db: Session = Depends(get_db), user: models.User = Depends(role_required(UserRole.ADMIN))
+    trip_id: int, page: PageParams = Depends(), db: AsyncSession = Depends(get_async_db),
+    user: models.User = Depends(role_required(UserRole.ADMIN))
 ):
-    """Get intermediate destinations for a specific trip."""
-    trip = db.query(models.Trip).filter(models.Trip.id == trip_id).first()
+    """Get intermediate destinations for a specific trip, a page at a time in visiting order."""
+    fields = page.selected_fields(schemas.IntermediateDestinationResponse.__fields__)
+    trip = await db.scalar(select(models.Trip.id).filter(models.Trip.id == trip_id))
     if not trip:
         raise HTTPException(status_code=404, detail="Trip not found")
 
-    intermediate_destinations = db.query(models.IntermediateDestination).filter(
-        models.IntermediateDestination.trip_id == trip_id
-    ).order_by(models.IntermediateDestination.sequence).all()
+    # The unique_trip_sequence constraint indexes (trip_id, sequence)
+    intermediate_destinations = (await db.scalars(keyset(
+        select(models.IntermediateDestination).filter(models.IntermediateDestination.trip_id == trip_id),
+        page, models.IntermediateDestination.sequence,
+    ))).all()
 
-    if not intermediate_destinations:
+    if not intermediate_destinations and page.cursor is None:
         raise HTTPException(
             status_code=404, detail="No intermediate destinations found for this trip")
 
-    return intermediate_destinations
+    return page_response(
+        intermediate_destinations, page, lambda stop: [stop.sequence],
+        schemas.IntermediateDestinationResponse.from_orm, fields)
 
 
 @router.put("/{trip_id}/update-vehicle-tonnage/")
 async def update_vehicle_tonnage(
-    trip_id: int, tonnage: float, db: Session = Depends(get_db),
+    trip_id: int, tonnage: float, db: AsyncSession = Depends(get_async_db),
     user: models.User = Depends(role_required(UserRole.DRIVER))
 ):
     """Admin and driver can update the vehicle's tonnage for the trip."""
-    trip = db.query(models.Trip).filter(models.Trip.id == trip_id).first()
+    trip = await db.get(models.Trip, trip_id)
     if not trip:
         raise HTTPException(status_code=404, detail="Trip not found")
 
-    vehicle = db.query(models.Vehicle).filter(
-        models.Vehicle.id == trip.vehicle_id).first()
+    vehicle = await db.get(models.Vehicle, trip.vehicle_id)
     if not vehicle:
         raise HTTPException(status_code=404, detail="Vehicle not found")
 
     vehicle.remaining_tonnage -= tonnage
     trip.tonnage = tonnage
-    db.commit()
+    await db.commit()
+    if vehicle.driver_id is not None:
+        await db.run_sync(driver_index.refresh_capacity, vehicle.driver_id)
 
     return {"message": f"Vehicle tonnage updated, remaining tonnage: {vehicle.remaining_tonnage}"}
 
 
 @router.post("/{trip_id}/check-geofence/")
 async def check_trip_geofence(
-    trip_id: int, driver_location: schemas.DriverLocationUpdate, db: Session = Depends(get_db)
+    trip_id: int, driver_location: schemas.DriverLocationUpdate, db: AsyncSession = Depends(get_async_db)
 ):
     """Check if the driver has crossed the geofence boundary and notify the relevant admin to review the delay report."""
-    trip = db.query(models.Trip).filter(models.Trip.id == trip_id).first()
+    # The driver's name comes with the trip, for the admin notification
+    trip = (await db.execute(
+        select(models.Trip.id, models.Trip.driver_id, models.Trip.admin_id, models.User.name.label("driver_name"))
+        .outerjoin(models.User, models.User.id == models.Trip.driver_id)
+        .filter(models.Trip.id == trip_id)
+    )).first()
     if not trip:
         raise HTTPException(status_code=404, detail="Trip not found")
-
-    geofences = db.query(models.Geofence).all()
-    violation_found = False
-    relevant_admins = set()
-
-    for geofence in geofences:
-        if check_geofence(driver_location.lat, driver_location.lng, geofence):
-            elapsed_time = datetime.utcnow() - driver_location.timestamp
-            if elapsed_time.total_seconds() > geofence.allowed_time_to_cross * 60:
-                violation_found = True
-
-                send_flash_notification(
-                    trip.driver_id,
-                    f"Geofence violation detected. Please fill out a delay report for 'Route Deviation'.",
-                    db
-                )
-
-                delay_report = DelayReport(
-                    driver_id=trip.driver_id,
-                    trip_id=trip.id,
-                    reason="Route Deviation",
-                    custom_message="This is an auto-generated message. Please fill out the report with more details."
-                )
-                db.add(delay_report)
-                db.commit()
-
-                if geofence.created_by:
-                    relevant_admins.add(geofence.created_by)
-
-                if trip.admin_id:
-                    relevant_admins.add(trip.admin_id)
-
-                break
-
-    if violation_found:
-        for admin_id in relevant_admins:
-            send_flash_notification(
-                admin_id,
-                f"Driver {trip.driver.name} has crossed a geofence boundary and missed the crossing time limit for Trip {
+    if driver_location.latitude is None or driver_location.longitude is None:
+        raise HTTPException(
+            status_code=400, detail="Latitude and longitude are required")
+
+    if trip.driver_id is None:
+        return {"message": "No driver is assigned to this trip."}
+
+    # The check only reads the driver's fence memberships, which the location
+    # ingest keeps, as of the driver's last stored fix
+    position = await location_store.get_async(trip.driver_id)
+    timestamp = position.timestamp if position else await db.scalar(
+        select(models.DriverLocation.timestamp).filter(models.DriverLocation.driver_id == trip.driver_id))
+    if timestamp is None:
+        return {"message": "No geofence violations detected."}
+    violations = await db.run_sync(
+        trip_dwell_violations, trip.driver_id, driver_location.latitude, driver_location.longitude, timestamp)
+    if not violations:
+        return {"message": "No geofence violations detected."}
+
+    existing_report = await db.scalar(select(DelayReport.id).filter(
+        DelayReport.driver_id == trip.driver_id, DelayReport.trip_id == trip.id))
+    # Reported once per trip, the violation stays visible until the driver leaves the fence
+    if not existing_report:
+        db.add(DelayReport(
+            driver_id=trip.driver_id,
+            trip_id=trip.id,
+            reason="Route Deviation",
+            custom_message="This is an auto-generated message. Please fill out the report with more details."
+        ))
+        if trip.admin_id:
+            db.add(models.Notification(
+                driver_id=trip.driver_id,
+                admin_id=trip.admin_id,
+                message=f"Driver {trip.driver_name} has crossed a geofence boundary and missed the crossing time limit for Trip {
                     trip_id}. Please review the delay report.",
-                db
-            )
+                timestamp=datetime.utcnow(),
+            ))
+        await db.commit()
 
-        return {"message": "Geofence check completed. Driver notified to fill the delay report and admins notified."}
+    return {"message": "Geofence check completed. Driver notified to fill the delay report and admins notified."}
 
-    return {"message": "No geofence violations detected."}
 
-
-@router.get("/find-nearby-drivers/{trip_id}", response_model=List[schemas.DriverLocationResponse])
+@router.get("/find-nearby-drivers/{trip_id}", response_model=List[schemas.NearbyDriverResponse])
 async def find_nearby_drivers(
-    trip_id: int, db: Session = Depends(get_db), user: models.User = Depends(role_required(UserRole.ADMIN))
+    trip_id: int, limit: int = 10, max_distance_km: Optional[float] = None,
+    db: AsyncSession = Depends(get_async_db), user: models.User = Depends(role_required(UserRole.ADMIN))
 ):
-    """Find drivers within a given radius of the trip destination and sort them by distance."""
-    trip = db.query(models.Trip).filter(models.Trip.id == trip_id).first()
+    """Find the drivers closest to the trip destination whose vehicle can carry the trip's tonnage."""
+    trip = await db.get(models.Trip, trip_id)
     if not trip:
         raise HTTPException(status_code=404, detail="Trip not found")
+    if trip.destination_lat is None or trip.destination_lng is None:
+        raise HTTPException(
+            status_code=400, detail="Trip destination has no coordinates")
 
-    destination_lat, destination_lng = trip.destination_lat, trip.destination_lng
-    required_capacity = trip.required_capacity
-
-    available_drivers = db.query(models.User, models.DriverLocation).join(
-        models.DriverLocation, models.DriverLocation.user_id == models.User.id
-    ).filter(
-        models.User.is_driver == True,
-        models.User.vehicle_capacity >= required_capacity
-    ).all()
+    # Answered from the live driver grid, see app.spatial.DriverIndex
+    await db.run_sync(driver_index.ensure_loaded)
+    nearest = driver_index.nearest(
+        trip.destination_lat, trip.destination_lng, limit, trip.tonnage, max_distance_km)
+    if not nearest:
+        raise HTTPException(
+            status_code=404, detail="No drivers found with sufficient capacity")
 
-    driver_list = [
+    names = dict((await db.execute(select(models.User.id, models.User.name).filter(
+        models.User.id.in_([driver.driver_id for driver in nearest])))).all())
+    return [
         {
-            "driver_id": user.id,
-            "driver_name": user.name,
-            "vehicle_capacity": user.vehicle_capacity,
-            "vehicle_type": user.vehicle_type,
-            "distance_to_trip": calculate_distance(location.latitude, location.longitude, destination_lat, destination_lng)
+            "driver_id": driver.driver_id,
+            "driver_name": names.get(driver.driver_id, ""),
+            "latitude": driver.latitude,
+            "longitude": driver.longitude,
+            "remaining_tonnage": driver.remaining_tonnage,
+            "distance_to_trip": driver.distance_km,
         }
-        for user, location in available_drivers
+        for driver in nearest
     ]
 
-    sorted_drivers = sorted(driver_list, key=lambda d: d["distance_to_trip"])
 
-    if not sorted_drivers:
-        raise HTTPException(
-            status_code=404, detail="No drivers found with sufficient capacity")
+async def plan_assigned_routes(trip_ids):
+    """Plan the routes of batch-assigned trips, a few at a time, each in its own session."""
+    semaphore = asyncio.Semaphore(MATCHING_ROUTE_CONCURRENCY)
+
+    async def plan(trip_id):
+        async with semaphore, AsyncSessionLocal() as db:
+            try:
+                trip = await db.get(models.Trip, trip_id)
+                if trip and await plan_trip_route(db, trip):
+                    await db.commit()
+            except Exception as e:
+                await db.rollback()
+                print(f"Error planning route of trip {trip_id}: {e}")
+
+    await asyncio.gather(*(plan(trip_id) for trip_id in trip_ids))
 
-    return sorted_drivers
+
+@router.post("/assign-batch", response_model=schemas.BatchAssignResponse)
+async def assign_pending_trips_batch(
+    background_tasks: BackgroundTasks,
+    user: models.User = Depends(role_required(UserRole.ADMIN))
+):
+    """
+    Assign every pending trip to a free driver at once, minimizing the total
+    distance and unused capacity. Routes are planned once the response is sent.
+    """
+    # The solver is CPU-bound, it runs in a thread with a session of its own
+    assignments, unassigned = await asyncio.to_thread(run_in_session, assign_pending_trips)
+    if assignments:
+        background_tasks.add_task(plan_assigned_routes, [a.trip_id for a in assignments])
+    return {
+        "assignments": [a._asdict() for a in assignments],
+        "unassigned_trip_ids": unassigned,
+    }
 
 
 @router.post("/assign-trip/{driver_id}/{trip_id}", response_model=schemas.TripAssignResponse)
 async def assign_trip_to_driver(
-    driver_id: int, trip_id: int, db: Session = Depends(get_db), user: models.User = Depends(role_required(UserRole.ADMIN))
+    driver_id: int, trip_id: int, db: AsyncSession = Depends(get_async_db), user: models.User = Depends(role_required(UserRole.ADMIN))
 ):
     """Assign a trip to a driver, including best route suggestions."""
-    trip = db.query(models.Trip).filter(models.Trip.id == trip_id).first()
+    # The stops come with the trip in one query, they are the route's waypoints
+    trip = (await db.scalars(
+        select(models.Trip).options(joinedload(models.Trip.intermediate_destinations))
+        .filter(models.Trip.id == trip_id)
+    )).unique().first()
     if not trip:
         raise HTTPException(status_code=404, detail="Trip not found")
 
-    driver = db.query(models.User).filter(models.User.id ==
-                      driver_id, models.User.is_driver == True).first()
+    # The driver's capacity is the largest remaining tonnage among their vehicles
+    driver = (await db.execute(
+        select(models.User.id, func.max(models.Vehicle.remaining_tonnage).label("capacity"))
+        .outerjoin(models.Vehicle, models.Vehicle.driver_id == models.User.id)
+        .filter(models.User.id == driver_id, models.User.role == UserRole.DRIVER)
+        .group_by(models.User.id)
+    )).first()
     if not driver:
         raise HTTPException(status_code=404, detail="Driver not found")
 
-    if driver.vehicle_capacity < trip.required_capacity:
+    if driver.capacity is None or driver.capacity < trip.tonnage:
         raise HTTPException(
             status_code=400, detail="Driver's vehicle capacity is insufficient for this trip")
 
-    existing_trip = db.query(models.Trip).filter(
-        models.Trip.driver_id == driver_id, models.Trip.status == "In-Route"
-    ).first()
+    existing_trip = await db.scalar(select(models.Trip.id).filter(
+        models.Trip.driver_id == driver_id, models.Trip.status == TripStatus.IN_ROUTE
+    ).limit(1))
     if existing_trip:
         raise HTTPException(
             status_code=400, detail="Driver already assigned to another trip")
 
-    best_route = get_best_route_from_api(
-        start_location=trip.source,
-        end_location=trip.destination,
-        waypoints=trip.intermediate_destinations
-    )
+    trip.driver_id = driver_id
+    best_route = await plan_trip_route(db, trip, trip.intermediate_destinations)
     if not best_route:
+        await db.rollback()
         raise HTTPException(
             status_code=404, detail="Best route could not be determined")
 
-    trip.driver_id = driver_id
-    trip.route_details = best_route
-    trip.status = "Assigned"
-    db.commit()
+    trip.status = TripStatus.ASSIGNED
+    await db.commit()
 
-    send_flash_notification(
+    await send_flash_notification(
         driver.id,
         f"You have been assigned to trip {
             trip_id}. Check the app for route details.",
         db
     )
+    await db.commit()
 
     return {"message": f"Trip {trip_id} successfully assigned to driver {driver_id}", "route_details": best_route}
 
@@ -302,14 +731,14 @@ async def assign_trip_to_driver(
 @router.get("/route/{trip_id}")
 async def get_trip_route(
     trip_id: int,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     user: models.User = Depends(role_required(UserRole.DRIVER)),
 ):
     """
     Retrieve the route details for a specific trip.
     """
-    trip = db.query(models.Trip).filter(models.Trip.id ==
-                    trip_id, models.Trip.driver_id == user.id).first()
+    trip = await db.scalar(select(models.Trip).filter(models.Trip.id ==
+                                                      trip_id, models.Trip.driver_id == user.id))
     if not trip:
         raise HTTPException(
             status_code=404, detail="Trip not found or not assigned to the driver")
@@ -325,12 +754,12 @@ async def get_trip_route(
 
 
 @router.put("/update_trip_status/{trip_id}")
-def update_trip_status(
+async def update_trip_status(
     trip_id: int,
     status: str,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
-    trip = db.query(models.Trip).filter(models.Trip.id == trip_id).first()
+    trip = await db.get(models.Trip, trip_id)
 
     if not trip:
         raise HTTPException(status_code=404, detail="Trip not found")
@@ -343,10 +772,11 @@ def update_trip_status(
             custom_message="Trip status marked as delayed"
         )
         db.add(delay_report)
-        db.commit()
+        await db.commit()
 
     trip.status = status
-    db.commit()
+    await db.commit()
+    release_trip_corridor(trip, status)
 
     return {"msg": "Trip status updated"}
 
@@ -355,67 +785,55 @@ def update_trip_status(
 async def start_geofence_timer(
     trip_id: int,
     geofence_id: int,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
 ):
     """
     Start a geofence timer for a trip and notify the admin once it stops.
     """
-    trip = db.query(models.Trip).filter(models.Trip.id == trip_id).first()
+    trip = await db.get(models.Trip, trip_id)
     if not trip:
         raise HTTPException(status_code=404, detail="Trip not found")
 
-    geofence = db.query(models.Geofence).filter(
-        models.Geofence.id == geofence_id).first()
+    geofence = await db.get(models.Geofence, geofence_id)
     if not geofence:
         raise HTTPException(status_code=404, detail="Geofence not found")
 
-    if trip.geofence_id != geofence.id:
+    if geofence.id not in (trip.corridor_geofence_ids or []):
         raise HTTPException(
             status_code=400,
             detail="The specified geofence is not linked to this trip."
         )
 
-    asyncio.create_task(geofence_timer(trip_id, geofence_id, db))
+    # The timer survives restarts and fires on whichever worker holds it, see app.scheduler
+    await db.run_sync(
+        scheduler.schedule, GEOFENCE_TIMER, f"{trip_id}:{geofence_id}",
+        datetime.utcnow() + timedelta(minutes=geofence.time_limit_minutes),
+        {"trip_id": trip_id, "geofence_id": geofence_id},
+    )
 
     return {"message": f"Geofence timer started for trip ID {trip_id} and geofence ID {geofence_id} ."}
 
 
-async def geofence_timer(trip_id: int, geofence_id: int, db: Session):
-    """
-    Start a timer for the geofence during a trip and notify admin once the timer stops.
-    """
-    trip = db.query(models.Trip).filter(models.Trip.id == trip_id).first()
-    if not trip:
-        raise HTTPException(status_code=404, detail="Trip not found")
-
-    geofence = db.query(models.Geofence).filter(
-        models.Geofence.id == geofence_id).first()
-    if not geofence:
-        raise HTTPException(status_code=404, detail="Geofence not found")
-
-    await asyncio.sleep(geofence.time_limit_minutes * 60)
-
-    notify_admin_timer_stopped(trip_id, geofence_id, db)
-
-    await check_geofence(trip_id, db)
-
-
-def notify_admin_timer_stopped(trip_id: int, geofence_id: int, db: Session):
+def notify_admins_timers_stopped(db: Session, timers):
     """
-    Notify the admin that the geofence timer has stopped for a specific trip and geofence.
+    Notify the admins that the geofence timers of their trips have stopped.
+    Called by the scheduler with every timer that fell due together.
     """
-    trip = db.query(models.Trip).filter(models.Trip.id == trip_id).first()
-    geofence = db.query(models.Geofence).filter(
-        models.Geofence.id == geofence_id).first()
-
-    if not trip or not geofence:
-        return
+    trip_ids = {timer.payload["trip_id"] for timer in timers}
+    trips = {
+        trip.id: trip
+        for trip in db.query(models.Trip).filter(models.Trip.id.in_(trip_ids))
+    }
+    for timer in timers:
+        trip = trips.get(timer.payload["trip_id"])
+        if not trip or not trip.admin_id or trip.driver_id is None:
+            continue
+        db.add(models.Notification(
+            driver_id=trip.driver_id,
+            admin_id=trip.admin_id,
+            message=f"Geofence timer for trip '{trip.id}' has ended. Please check the geofence status.",
+            timestamp=datetime.utcnow(),
+        ))
 
-    admin_id = trip.admin_id
-    if not admin_id:
-        return
 
-    send_flash_notification(
-        admin_id,
-        f"Geofence timer for trip '{trip.id}' has ended. Please check the geofence status."
-    )
+scheduler.register(GEOFENCE_TIMER, notify_admins_timers_stopped)
@@ -1,6 +1,7 @@
 from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
-from app.db import get_db
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.db import get_async_db
 from app.models import User
 from app.schemas import UserResponse, UserUpdate
 from app.routes.auth import role_required
@@ -9,8 +10,8 @@ router = APIRouter()
 
 
 @router.get("/user/{user_id}", response_model=UserResponse)
-async def get_user_info(user_id: int, db: Session = Depends(get_db), current_user: User = Depends(role_required("admin"))):
-    user = db.query(User).filter(User.id == user_id).first()
+async def get_user_info(user_id: int, db: AsyncSession = Depends(get_async_db), current_user: User = Depends(role_required("admin"))):
+    user = await db.scalar(select(User).filter(User.id == user_id))
     if not user:
         raise HTTPException(status_code=404, detail="User  not found")
 
@@ -22,14 +23,14 @@ async def get_user_info(user_id: int, db: Session = Depends(get_db), current_use
 
 
 @router.patch("/user/{user_id}", response_model=UserResponse)
-def update_user(user_id: int, user_update: UserUpdate, db: Session = Depends(get_db)):
-    user = db.query(User).filter(User.id == user_id).first()
+async def update_user(user_id: int, user_update: UserUpdate, db: AsyncSession = Depends(get_async_db)):
+    user = await db.scalar(select(User).filter(User.id == user_id))
     if not user:
         raise HTTPException(status_code=404, detail="User  not found")
 
     for key, value in user_update.dict(exclude_unset=True).items():
         setattr(user, key, value)
 
-    db.commit()
-    db.refresh(user)
+    await db.commit()
+    await db.refresh(user)
     return user
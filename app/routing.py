@@ -0,0 +1,330 @@
+import heapq
+import os
+import threading
+from array import array
+from math import asin, cos, radians, sin, sqrt
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+from scipy.spatial import cKDTree
+from app.geometry import KM_PER_DEGREE_LAT
+
+# Road network (.npz, see RoadGraph.save) used to route locally instead of calling the routing API
+ROAD_GRAPH_PATH = os.getenv("ROAD_GRAPH_PATH")
+# Points further than this from the nearest road node are not routed locally
+ROAD_GRAPH_MAX_SNAP_KM = float(os.getenv("ROAD_GRAPH_MAX_SNAP_KM", "5"))
+# Landmarks whose travel times tighten the A* heuristic, 0 disables them
+ROAD_GRAPH_LANDMARKS = int(os.getenv("ROAD_GRAPH_LANDMARKS", "8"))
+# Landmarks consulted by each query, the ones giving the best bound at its source
+ROAD_GRAPH_QUERY_LANDMARKS = 4
+
+EARTH_RADIUS_KM = 6371.0
+
+
+def parse_coordinates(location):
+    """(lat, lng) of a "lat,lng" string or a pair, None for anything else (e.g. a place name)."""
+    if isinstance(location, (list, tuple)) and len(location) == 2:
+        parts = location
+    elif isinstance(location, str) and location.count(",") == 1:
+        parts = location.split(",")
+    else:
+        return None
+    try:
+        lat, lng = float(parts[0]), float(parts[1])
+    except (TypeError, ValueError):
+        return None
+    if not (-90 <= lat <= 90 and -180 <= lng <= 180):
+        return None
+    return lat, lng
+
+
+class RoadGraph:
+    """
+    A directed road network in compressed sparse row form.
+
+    The edges leaving node n are indices[indptr[n]:indptr[n + 1]], with their
+    lengths (km) and travel times (s) at the same positions. Searches read
+    the adjacency from array.array buffers, which take 4 or 8 bytes per value
+    like numpy but index into plain Python numbers much faster.
+
+    Fastest-path searches are A* with landmarks (ALT): travel times from and
+    to a few far apart nodes bound the remaining time through the triangle
+    inequality far more tightly than the straight line at top speed.
+    """
+
+    def __init__(self, lats, lngs, indptr, indices, lengths, times, landmarks=ROAD_GRAPH_LANDMARKS):
+        self.lats = np.asarray(lats, dtype=np.float64)
+        self.lngs = np.asarray(lngs, dtype=np.float64)
+        self.node_count = len(self.lats)
+        self.edge_count = len(indices)
+        self.indptr = array("q", np.asarray(indptr, dtype=np.int64).tobytes())
+        self.indices = array("i", np.asarray(indices, dtype=np.int32).tobytes())
+        self.lengths = array("f", np.asarray(lengths, dtype=np.float32).tobytes())
+        self.times = array("f", np.asarray(times, dtype=np.float32).tobytes())
+        self._lat_rad = array("d", np.radians(self.lats).tobytes())
+        self._lng_rad = array("d", np.radians(self.lngs).tobytes())
+        self._cos_lat = array("d", np.cos(np.radians(self.lats)).tobytes())
+
+        # Fastest speed on the network, keeps the travel-time heuristic admissible
+        lengths = np.asarray(lengths, dtype=np.float64)
+        times = np.asarray(times, dtype=np.float64)
+        moving = times > 0
+        self.max_speed_kmh = float((lengths[moving] / times[moving]).max() * 3600) if moving.any() else 1.0
+
+        self._scale_x = KM_PER_DEGREE_LAT * cos(radians(float(self.lats.mean()))) if self.node_count else 0.0
+        self._tree = cKDTree(np.column_stack([self.lats * KM_PER_DEGREE_LAT, self.lngs * self._scale_x]))
+
+        self._landmarks_from = []
+        self._landmarks_to = []
+        if landmarks and self.node_count > landmarks:
+            self._compute_landmarks(landmarks)
+
+    def csgraph(self, weight="time"):
+        """
+        The graph as a scipy sparse matrix of travel times or lengths, for
+        scipy.sparse.csgraph. Uses the float32 weights the A* search adds up.
+        """
+        indptr = np.frombuffer(self.indptr, dtype=np.int64)
+        sources = np.repeat(np.arange(self.node_count), np.diff(indptr))
+        targets = np.frombuffer(self.indices, dtype=np.int32)
+        weights = self.times if weight == "time" else self.lengths
+        # scipy sums parallel edges and skips zero weights, so keep the best of
+        # parallel edges and make free edges nearly free
+        weights = np.maximum(np.frombuffer(weights, dtype=np.float32).astype(np.float64), 1e-9)
+        order = np.lexsort((weights, targets, sources))
+        sources, targets, weights = sources[order], targets[order], weights[order]
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = (sources[1:] != sources[:-1]) | (targets[1:] != targets[:-1])
+        return csr_matrix((weights[first], (sources[first], targets[first])),
+                          shape=(self.node_count, self.node_count))
+
+    def _compute_landmarks(self, count):
+        """Travel times from and to `count` landmarks spread around the edge of the network."""
+        matrix = self.csgraph("time")
+        # Farthest-point selection on the map, starting from the node farthest from the center
+        points = np.column_stack([self.lats * KM_PER_DEGREE_LAT, self.lngs * self._scale_x])
+        spread = np.linalg.norm(points - points.mean(axis=0), axis=1)
+        chosen = [int(spread.argmax())]
+        spread = np.linalg.norm(points - points[chosen[0]], axis=1)
+        while len(chosen) < count:
+            chosen.append(int(spread.argmax()))
+            spread = np.minimum(spread, np.linalg.norm(points - points[chosen[-1]], axis=1))
+
+        from_landmarks = dijkstra(matrix, indices=chosen)
+        to_landmarks = dijkstra(matrix.T.tocsr(), indices=chosen)
+        for forward, backward in zip(from_landmarks, to_landmarks):
+            # Unreachable nodes get no bound from this landmark
+            forward[np.isinf(forward)] = np.nan
+            backward[np.isinf(backward)] = np.nan
+            self._landmarks_from.append(array("d", forward.tobytes()))
+            self._landmarks_to.append(array("d", backward.tobytes()))
+
+    def _landmark_bounds(self, source, target):
+        """(from_landmark, to_landmark, time from landmark to target, time from target to landmark) of the best landmarks."""
+        scored = []
+        for forward, backward in zip(self._landmarks_from, self._landmarks_to):
+            bounds = [forward[target] - forward[source], backward[source] - backward[target]]
+            bounds = [bound for bound in bounds if bound == bound]
+            if bounds:
+                scored.append((max(bounds), forward, backward, forward[target], backward[target]))
+        scored.sort(key=lambda entry: entry[0], reverse=True)
+        return [entry[1:] for entry in scored[:ROAD_GRAPH_QUERY_LANDMARKS]]
+
+    @classmethod
+    def from_edges(cls, lats, lngs, sources, targets, lengths, times):
+        """Build the graph from parallel edge arrays, lengths in km and times in seconds."""
+        sources = np.asarray(sources, dtype=np.int64)
+        order = np.argsort(sources, kind="stable")
+        indptr = np.zeros(len(lats) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(sources, minlength=len(lats)), out=indptr[1:])
+        return cls(lats, lngs, indptr, np.asarray(targets)[order],
+                   np.asarray(lengths)[order], np.asarray(times)[order])
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            if "indptr" in data:
+                return cls(data["lats"], data["lngs"], data["indptr"], data["indices"],
+                           data["lengths"], data["times"])
+            return cls.from_edges(data["lats"], data["lngs"], data["sources"], data["targets"],
+                                  data["lengths"], data["times"])
+
+    def save(self, path):
+        np.savez(path, lats=self.lats, lngs=self.lngs,
+                 indptr=np.frombuffer(self.indptr, dtype=np.int64),
+                 indices=np.frombuffer(self.indices, dtype=np.int32),
+                 lengths=np.frombuffer(self.lengths, dtype=np.float32),
+                 times=np.frombuffer(self.times, dtype=np.float32))
+
+    def nearest_node(self, lat, lng, max_distance_km=ROAD_GRAPH_MAX_SNAP_KM):
+        """Closest node to a point, None when it is further than max_distance_km."""
+        distance, node = self._tree.query([lat * KM_PER_DEGREE_LAT, lng * self._scale_x],
+                                          distance_upper_bound=max_distance_km)
+        return None if np.isinf(distance) else int(node)
+
+    def _straight_km(self, a, b):
+        lat_rad, lng_rad = self._lat_rad, self._lng_rad
+        h = sin((lat_rad[b] - lat_rad[a]) / 2) ** 2 + \
+            self._cos_lat[a] * self._cos_lat[b] * sin((lng_rad[b] - lng_rad[a]) / 2) ** 2
+        return 2 * EARTH_RADIUS_KM * asin(min(1.0, sqrt(h)))
+
+    def shortest_path(self, source, target, weight="time"):
+        """
+        A* search for the fastest (weight="time") or shortest (weight="distance")
+        path. Returns (nodes, distance_km, duration_s), or None when the target
+        cannot be reached. The heuristic is the great-circle distance, divided
+        by the top speed of the network when searching by time, and the
+        landmark bounds when they are tighter.
+        """
+        indptr, indices = self.indptr, self.indices
+        lengths, times = self.lengths, self.times
+        weights = times if weight == "time" else lengths
+        factor = 3600.0 / self.max_speed_kmh if weight == "time" else 1.0
+        straight_km = self._straight_km
+        landmarks = self._landmark_bounds(source, target) if weight == "time" else []
+
+        def estimate_of(node):
+            estimate = straight_km(node, target) * factor
+            for forward, backward, forward_target, backward_target in landmarks:
+                # NaN when a landmark does not reach both nodes, then the comparisons are false
+                bound = forward_target - forward[node]
+                if bound > estimate:
+                    estimate = bound
+                bound = backward[node] - backward_target
+                if bound > estimate:
+                    estimate = bound
+            return estimate
+
+        best = {source: 0.0}
+        previous = {source: -1}
+        # Edge used to reach each node, to add up the other metric afterwards
+        via = {}
+        heuristic = {}
+        closed = set()
+        queue = [(estimate_of(source), 0.0, source)]
+        while queue:
+            _, cost, node = heapq.heappop(queue)
+            if node == target:
+                break
+            if node in closed:
+                continue
+            closed.add(node)
+            for edge in range(indptr[node], indptr[node + 1]):
+                neighbor = indices[edge]
+                new_cost = cost + weights[edge]
+                if new_cost < best.get(neighbor, float("inf")):
+                    best[neighbor] = new_cost
+                    previous[neighbor] = node
+                    via[neighbor] = edge
+                    estimate = heuristic.get(neighbor)
+                    if estimate is None:
+                        estimate = heuristic[neighbor] = estimate_of(neighbor)
+                    heapq.heappush(queue, (new_cost + estimate, new_cost, neighbor))
+        else:
+            return None
+
+        nodes, distance_km, duration_s = [target], 0.0, 0.0
+        node = target
+        while node != source:
+            edge = via[node]
+            distance_km += lengths[edge]
+            duration_s += times[edge]
+            node = previous[node]
+            nodes.append(node)
+        nodes.reverse()
+        return nodes, distance_km, duration_s
+
+    def route(self, points, weight="time"):
+        """
+        Route through a list of (lat, lng) points in order, in the shape of the
+        routing API: {"distance": km, "duration": seconds, "path": [[lat, lng], ...]}.
+        Returns None when a point is off the network or a leg has no path.
+        """
+        nodes = [self.nearest_node(lat, lng) for lat, lng in points]
+        if any(node is None for node in nodes):
+            return None
+        path, distance_km, duration_s = [nodes[0]], 0.0, 0.0
+        for start, end in zip(nodes, nodes[1:]):
+            leg = self.shortest_path(start, end, weight)
+            if leg is None:
+                return None
+            leg_nodes, leg_km, leg_s = leg
+            path.extend(leg_nodes[1:])
+            distance_km += leg_km
+            duration_s += leg_s
+        return {
+            "distance": round(distance_km, 3),
+            "duration": round(duration_s),
+            "path": [[float(self.lats[n]), float(self.lngs[n])] for n in path],
+        }
+
+
+_road_graph = None
+_road_graph_lock = threading.Lock()
+
+
+def get_road_graph():
+    """The graph at ROAD_GRAPH_PATH, loaded on first use. None when no graph is configured."""
+    global _road_graph
+    if ROAD_GRAPH_PATH is None:
+        return None
+    if _road_graph is None:
+        with _road_graph_lock:
+            if _road_graph is None:
+                _road_graph = RoadGraph.load(ROAD_GRAPH_PATH)
+    return _road_graph
+
+
+def route_locally(start_location, end_location, waypoints=None):
+    """
+    Route on the local road graph when one is configured and every stop is
+    given as coordinates. Returns None otherwise, so callers fall back to the API.
+    """
+    graph = get_road_graph()
+    if graph is None:
+        return None
+    points = [parse_coordinates(location) for location in [start_location, *(waypoints or []), end_location]]
+    if any(point is None for point in points):
+        return None
+    return graph.route(points)
+
+
+def synthetic_grid_graph(rows, columns, spacing_km=0.5, lat=19.0, lng=72.8, seed=0):
+    """
+    A rows x columns street grid with two-way edges and random speeds, for
+    benchmarks. Roads are 0 to 30% longer than the grid spacing.
+    """
+    rng = np.random.default_rng(seed)
+    ids = np.arange(rows * columns).reshape(rows, columns)
+    lats = lat + np.repeat(np.arange(rows), columns) * spacing_km / KM_PER_DEGREE_LAT
+    lngs = lng + np.tile(np.arange(columns), rows) * spacing_km / (KM_PER_DEGREE_LAT * cos(radians(lat)))
+    pairs = np.concatenate([
+        np.column_stack([ids[:, :-1].ravel(), ids[:, 1:].ravel()]),
+        np.column_stack([ids[:-1, :].ravel(), ids[1:, :].ravel()]),
+    ])
+    sources = np.concatenate([pairs[:, 0], pairs[:, 1]])
+    targets = np.concatenate([pairs[:, 1], pairs[:, 0]])
+    lengths = spacing_km * rng.uniform(1.0, 1.3, len(sources))
+    speeds = rng.choice([30.0, 50.0, 80.0], len(sources), p=[0.6, 0.3, 0.1])
+    return RoadGraph.from_edges(lats, lngs, sources, targets, lengths, lengths / speeds * 3600)
+
+
+if __name__ == "__main__":
+    # python -m app.routing: query times on a synthetic grid of a million edges
+    import time
+
+    size = 500
+    started = time.perf_counter()
+    graph = synthetic_grid_graph(size, size)
+    print(f"{graph.node_count} nodes, {graph.edge_count} edges, built in {time.perf_counter() - started:.2f}s")
+
+    rng = np.random.default_rng(1)
+    for span in (10, 50, 200, size - 1):
+        timings = []
+        for _ in range(20):
+            row, column = rng.integers(0, size - span, 2)
+            started = time.perf_counter()
+            graph.shortest_path(int(row * size + column), int((row + span) * size + column + span))
+            timings.append((time.perf_counter() - started) * 1000)
+        print(f"{span} x {span} blocks: p50 {np.percentile(timings, 50):.1f} ms, "
+              f"p95 {np.percentile(timings, 95):.1f} ms")
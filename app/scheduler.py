@@ -0,0 +1,265 @@
+import asyncio
+import heapq
+import os
+import socket
+import uuid
+from datetime import datetime, timedelta
+from sqlalchemy import null, or_
+from sqlalchemy.orm import Session
+from app.db import SessionLocal
+from app.models import ScheduledTimer
+
+# How often every worker looks for timers that are about to fall due
+SCHEDULER_POLL_SECONDS = float(os.getenv("SCHEDULER_POLL_SECONDS", "5"))
+# Timers due within this window are claimed into the worker's heap ahead of time
+SCHEDULER_LOOKAHEAD_SECONDS = float(os.getenv("SCHEDULER_LOOKAHEAD_SECONDS", "30"))
+# How long a claimed timer belongs to a worker, must exceed the lookahead.
+# Timers of a worker that dies are claimed by another one once this runs out.
+SCHEDULER_LEASE_SECONDS = float(os.getenv("SCHEDULER_LEASE_SECONDS", "120"))
+# Timers claimed, and fired, per statement
+SCHEDULER_BATCH_SIZE = int(os.getenv("SCHEDULER_BATCH_SIZE", "1000"))
+
+
+def _insert_for(db: Session):
+    if db.bind.dialect.name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    return insert
+
+
+def schedule_timers(db: Session, timers):
+    """
+    Create or move many timers, given as (kind, key, due_at, payload) tuples,
+    with a multi-row upsert. The caller commits.
+    """
+    # Postgres rejects a statement that upserts the same row twice, the last one wins
+    rows = {}
+    for kind, key, due_at, payload in timers:
+        rows[(kind, key)] = {"kind": kind, "key": key, "due_at": due_at,
+                             "payload": payload, "created_at": datetime.utcnow()}
+    if not rows:
+        return
+
+    stmt = _insert_for(db)(ScheduledTimer)
+    # Rescheduling drops the lease, so a worker holding the old due time skips it
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[ScheduledTimer.kind, ScheduledTimer.key],
+        set_={
+            "due_at": stmt.excluded.due_at,
+            "payload": stmt.excluded.payload,
+            "lease_owner": null(),
+            "lease_expires_at": null(),
+        },
+    )
+    db.execute(stmt, list(rows.values()),
+               execution_options={"insertmanyvalues_page_size": SCHEDULER_BATCH_SIZE})
+
+
+def schedule_timer(db: Session, kind, key, due_at, payload=None):
+    """Create the timer (kind, key), or move it to a new due time. The caller commits."""
+    schedule_timers(db, [(kind, key, due_at, payload)])
+
+
+def cancel_timer(db: Session, kind, key):
+    """Remove a pending timer. The caller commits."""
+    db.query(ScheduledTimer).filter(
+        ScheduledTimer.kind == kind, ScheduledTimer.key == key
+    ).delete(synchronize_session=False)
+
+
+class TimerScheduler:
+    """
+    Durable timers shared by all workers.
+
+    Every timer is a row in scheduled_timers. Each worker claims the timers
+    falling due within SCHEDULER_LOOKAHEAD_SECONDS by taking a lease on them
+    (FOR UPDATE SKIP LOCKED on Postgres, so workers never block each other)
+    and keeps them in a heap ordered by due time. Timers that fall due together
+    are passed to their kind's handler as one batch, and deleted in the same
+    transaction as the handler's writes. A handler that fails leaves its timers
+    leased; they fire again once the lease runs out, so delivery is at least once.
+    """
+
+    def __init__(self, poll_interval=SCHEDULER_POLL_SECONDS, lookahead_seconds=SCHEDULER_LOOKAHEAD_SECONDS,
+                 lease_seconds=SCHEDULER_LEASE_SECONDS, batch_size=SCHEDULER_BATCH_SIZE):
+        self.poll_interval = poll_interval
+        self.lookahead = timedelta(seconds=lookahead_seconds)
+        self.lease = timedelta(seconds=lease_seconds)
+        self.batch_size = batch_size
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._handlers = {}
+        # (due_at, timer_id, kind) of the timers this worker holds a lease on
+        self._heap = []
+        # (due_at, timer_id) of the heap entries. A timer moved to a new due
+        # time is pushed again, the entry for the old time is skipped on firing.
+        self._queued = set()
+        self._wake = None
+        self._loop = None
+        self._task = None
+
+    def register(self, kind, handler):
+        """
+        Set the handler of a timer kind. It is called as handler(db, timers)
+        with the ScheduledTimer rows due together and must not commit.
+        """
+        self._handlers[kind] = handler
+
+    def schedule(self, db: Session, kind, key, due_at, payload=None):
+        schedule_timer(db, kind, key, due_at, payload)
+        db.commit()
+        if due_at <= datetime.utcnow() + self.lookahead:
+            self.wake()
+
+    def schedule_many(self, db: Session, timers):
+        """Schedule (kind, key, due_at, payload) tuples in one statement."""
+        timers = list(timers)
+        schedule_timers(db, timers)
+        db.commit()
+        if any(due_at <= datetime.utcnow() + self.lookahead for _, _, due_at, _ in timers):
+            self.wake()
+
+    def cancel(self, db: Session, kind, key):
+        cancel_timer(db, kind, key)
+        db.commit()
+
+    def wake(self):
+        """Claim and fire timers now instead of at the next poll."""
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._wake.set)
+
+    def pending_count(self):
+        return len(self._heap)
+
+    def claim(self, db: Session):
+        """Lease the timers due within the lookahead window and return how many were claimed."""
+        if not self._handlers:
+            return 0
+        now = datetime.utcnow()
+        claimable = or_(ScheduledTimer.lease_owner.is_(None), ScheduledTimer.lease_expires_at < now)
+        ids = [timer_id for timer_id, in db.query(ScheduledTimer.id).filter(
+            ScheduledTimer.due_at <= now + self.lookahead, claimable,
+            # Only kinds this worker can fire
+            ScheduledTimer.kind.in_(list(self._handlers)),
+        ).order_by(ScheduledTimer.due_at).limit(self.batch_size).with_for_update(skip_locked=True)]
+        if not ids:
+            db.commit()
+            return 0
+
+        # The claimable condition is repeated for databases without row locks
+        db.query(ScheduledTimer).filter(ScheduledTimer.id.in_(ids), claimable).update(
+            {"lease_owner": self.owner, "lease_expires_at": now + self.lease},
+            synchronize_session=False,
+        )
+        db.commit()
+
+        claimed = db.query(ScheduledTimer.id, ScheduledTimer.kind, ScheduledTimer.due_at).filter(
+            ScheduledTimer.id.in_(ids), ScheduledTimer.lease_owner == self.owner).all()
+        for timer_id, kind, due_at in claimed:
+            if (due_at, timer_id) not in self._queued:
+                self._queued.add((due_at, timer_id))
+                heapq.heappush(self._heap, (due_at, timer_id, kind))
+        return len(claimed)
+
+    def fire_due(self, db: Session):
+        """Run the handlers of every timer that is due and return how many fired."""
+        now = datetime.utcnow()
+        due = {}
+        while self._heap and self._heap[0][0] <= now:
+            due_at, timer_id, kind = heapq.heappop(self._heap)
+            self._queued.discard((due_at, timer_id))
+            due.setdefault(kind, []).append(timer_id)
+
+        fired = 0
+        for kind, ids in due.items():
+            handler = self._handlers.get(kind)
+            if handler is None:
+                print(f"No handler registered for timer kind {kind}")
+                continue
+            for start in range(0, len(ids), self.batch_size):
+                fired += self._fire_batch(db, handler, ids[start:start + self.batch_size])
+        return fired
+
+    def _fire_batch(self, db: Session, handler, ids):
+        try:
+            # Timers canceled or rescheduled since they were claimed no longer
+            # carry our lease, or are not due yet when we claimed them again
+            timers = db.query(ScheduledTimer).filter(
+                ScheduledTimer.id.in_(ids), ScheduledTimer.lease_owner == self.owner,
+                ScheduledTimer.due_at <= datetime.utcnow(),
+            ).with_for_update().all()
+            if not timers:
+                db.commit()
+                return 0
+            handler(db, timers)
+            db.query(ScheduledTimer).filter(
+                ScheduledTimer.id.in_([timer.id for timer in timers])
+            ).delete(synchronize_session=False)
+            db.commit()
+            return len(timers)
+        except Exception as e:
+            db.rollback()
+            print(f"Error firing {len(ids)} timers: {e}")
+            return 0
+
+    def release(self, db: Session):
+        """Give up every lease of this worker so other workers can take the timers over."""
+        db.query(ScheduledTimer).filter(ScheduledTimer.lease_owner == self.owner).update(
+            {"lease_owner": None, "lease_expires_at": None}, synchronize_session=False)
+        db.commit()
+        self._heap.clear()
+        self._queued.clear()
+
+    def _run_once(self):
+        db = SessionLocal()
+        try:
+            claimed = self.claim(db)
+            self.fire_due(db)
+            return claimed
+        finally:
+            db.close()
+
+    def _seconds_until_next(self):
+        if not self._heap:
+            return self.poll_interval
+        remaining = (self._heap[0][0] - datetime.utcnow()).total_seconds()
+        return max(0.0, min(remaining, self.poll_interval))
+
+    async def run(self):
+        while True:
+            claimed = 0
+            try:
+                claimed = await asyncio.to_thread(self._run_once)
+            except Exception as e:
+                print(f"Error running scheduled timers: {e}")
+            # A full batch means more timers are waiting to be claimed
+            timeout = 0 if claimed >= self.batch_size else self._seconds_until_next()
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+
+    def start(self):
+        if self._task is None:
+            self._loop = asyncio.get_event_loop()
+            self._wake = asyncio.Event()
+            self._task = self._loop.create_task(self.run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+            self._loop = None
+
+        def release_with_new_session():
+            db = SessionLocal()
+            try:
+                self.release(db)
+            finally:
+                db.close()
+
+        await asyncio.to_thread(release_with_new_session)
+
+
+scheduler = TimerScheduler()
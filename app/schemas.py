@@ -1,6 +1,6 @@
-from pydantic import BaseModel, EmailStr
-from typing import List, Optional
-from datetime import datetime
+from pydantic import BaseModel, EmailStr, validator
+from typing import List, Optional, Union
+from datetime import datetime, timezone
 
 
 class UserBase(BaseModel):
@@ -64,13 +64,48 @@ class DriverLocationCreate(DriverLocationBase):
 
 
 class DriverLocationResponse(DriverLocationBase):
-    id: int
-    updated_at: datetime
+    id: Optional[int] = None
+    driver_id: int
+    timestamp: datetime
 
     class Config:
         orm_mode = True
 
 
+class NearbyDriverResponse(BaseModel):
+    driver_id: int
+    driver_name: str
+    latitude: float
+    longitude: float
+    remaining_tonnage: float
+    distance_to_trip: float
+
+
+class DriverLocationFix(DriverLocationBase):
+    driver_id: int
+    timestamp: Optional[datetime] = None
+
+    @validator("timestamp")
+    def to_naive_utc(cls, value):
+        # Stored timestamps are naive UTC, aware ones could not be compared with them
+        if value is not None and value.tzinfo is not None:
+            value = value.astimezone(timezone.utc).replace(tzinfo=None)
+        return value
+
+
+class DriverLocationBatch(BaseModel):
+    fixes: List[DriverLocationFix]
+
+
+class DriverLocationFixResult(BaseModel):
+    index: int
+    driver_id: int
+    status: str  # "accepted" or "rejected"
+    detail: Optional[str] = None
+    geofence_ids: List[int] = []
+    outside_geofence: bool = False
+
+
 # New schema for updating driver location
 class DriverLocationUpdate(BaseModel):
     latitude: Optional[float]  # Optional
@@ -90,13 +125,26 @@ class TripBase(BaseModel):
     next_halt: Optional[str] = None
     safety_info: Optional[str] = None
     tonnage: float
+    source_lat: Optional[float] = None
+    source_lng: Optional[float] = None
+    destination_lat: Optional[float] = None
+    destination_lng: Optional[float] = None
+
+
+class IntermediateStop(BaseModel):
+    destination: str
+    latitude: Optional[float] = None
+    longitude: Optional[float] = None
 
 
 class TripCreate(TripBase):
     vehicle_id: int
-    driver_id: int
-    # New field for intermediate destinations
-    intermediate_destinations: Optional[List[str]] = None
+    # Trips created without a driver are pending until POST /trips/assign-batch assigns them
+    driver_id: Optional[int] = None
+    # Stops in visiting order, by name or with coordinates
+    intermediate_destinations: Optional[List[Union[IntermediateStop, str]]] = None
+    # Reorder the stops for the shortest path, every stop needs coordinates
+    optimize_stop_order: bool = False
 
 
 class TripResponse(TripBase):
@@ -140,10 +188,16 @@ class DelayReportResponse(DelayReportCreate):
 
 
 class GeofenceBase(BaseModel):
-    lat: float
-    lng: float
-    radius: float
+    lat: Optional[float] = None
+    lng: Optional[float] = None
+    radius: Optional[float] = None
     time_limit_minutes: int  # Added field for time limit
+    shape: str = "circle"  # "circle" or "polygon"
+    # [[lat, lng], ...] vertices, required for polygons
+    polygon: Optional[List[List[float]]] = None
+    # Validity window (UTC), open ended when omitted
+    valid_from: Optional[datetime] = None
+    valid_until: Optional[datetime] = None
 
 
 class GeofenceCreate(GeofenceBase):
@@ -157,10 +211,35 @@ class GeofenceResponse(GeofenceBase):
         orm_mode = True
 
 
+class BatchAssignment(BaseModel):
+    trip_id: int
+    driver_id: int
+    vehicle_id: int
+    distance_km: float
+
+
+class BatchAssignResponse(BaseModel):
+    assignments: List[BatchAssignment]
+    unassigned_trip_ids: List[int]
+
+
+class TripImportError(BaseModel):
+    # Line of the upload the row starts on
+    row: int
+    errors: List[str]
+
+
+class TripImportResponse(BaseModel):
+    imported: int
+    failed: int
+    # The first TRIP_IMPORT_MAX_ERRORS failed rows
+    errors: List[TripImportError]
+
+
 class TripAssignResponse(BaseModel):
     message: str
-    # Assuming route details are returned as a string
-    route_details: Optional[str]
+    # Distance, duration and path of the best route
+    route_details: Optional[dict]
 
     class Config:
         orm_mode = True
@@ -169,6 +248,8 @@ class TripAssignResponse(BaseModel):
 class IntermediateDestinationBase(BaseModel):
     destination: str
     sequence: int
+    latitude: Optional[float] = None
+    longitude: Optional[float] = None
 
 
 class IntermediateDestinationCreate(IntermediateDestinationBase):
@@ -180,3 +261,43 @@ class IntermediateDestinationResponse(IntermediateDestinationBase):
 
     class Config:
         orm_mode = True
+
+
+class TripSummary(TripResponse):
+    """A trip as listed per vehicle, its stops included but not its route."""
+    status: str
+    vehicle_id: Optional[int] = None
+    driver_id: Optional[int] = None
+    admin_id: Optional[int] = None
+    intermediate_destinations: List[IntermediateDestinationResponse] = []
+
+    @validator("status", pre=True)
+    def status_value(cls, status):
+        return getattr(status, "value", status)
+
+
+class StopOrderResponse(BaseModel):
+    message: str
+    stops: List[IntermediateDestinationResponse]
+    distance_before_km: float
+    distance_after_km: float
+
+
+class FacilityCreate(BaseModel):
+    name: str
+    latitude: float
+    longitude: float
+
+
+class FacilityResponse(FacilityCreate):
+    id: int
+
+    class Config:
+        orm_mode = True
+
+
+class FacilityLegResponse(BaseModel):
+    source_id: int
+    destination_id: int
+    distance_km: float
+    duration_s: float
@@ -0,0 +1,162 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from app.utils import calculate_distance_matrix
+
+# Time the optimizer may spend improving a stop order
+SEQUENCING_TIME_BUDGET_MS = float(os.getenv("SEQUENCING_TIME_BUDGET_MS", "150"))
+# Distance matrices kept for stop lists that are optimized again
+SEQUENCING_MATRIX_CACHE_SIZE = int(os.getenv("SEQUENCING_MATRIX_CACHE_SIZE", "256"))
+# Longest run of consecutive stops Or-opt moves at once
+OR_OPT_MAX_SEGMENT = 3
+
+
+class DistanceMatrixCache:
+    """Distance matrices (km) of point lists, least recently used evicted first."""
+
+    def __init__(self, max_entries=SEQUENCING_MATRIX_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, points):
+        key = tuple((round(lat, 5), round(lng, 5)) for lat, lng in points)
+        with self._lock:
+            matrix = self._entries.get(key)
+            if matrix is not None:
+                self._entries.move_to_end(key)
+                return matrix
+        lats = [lat for lat, _ in points]
+        lngs = [lng for _, lng in points]
+        # Lists of floats, indexing them is much faster than numpy in the search loops
+        matrix = calculate_distance_matrix(lats, lngs, lats, lngs).tolist()
+        with self._lock:
+            self._entries[key] = matrix
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return matrix
+
+
+distance_matrices = DistanceMatrixCache()
+
+
+def path_length(order, cost):
+    return sum(cost[a][b] for a, b in zip(order, order[1:]))
+
+
+def nearest_neighbour(cost, first, last, inner):
+    order = [first]
+    remaining = set(inner)
+    while remaining:
+        current = order[-1]
+        following = min(remaining, key=lambda node: cost[current][node])
+        remaining.remove(following)
+        order.append(following)
+    order.append(last)
+    return order
+
+
+def two_opt(order, cost, deadline):
+    """Reverse segments while that shortens the path. The endpoints stay in place."""
+    improved = True
+    while improved and time.perf_counter() < deadline:
+        improved = False
+        for i in range(1, len(order) - 2):
+            a, b = order[i - 1], order[i]
+            cost_a, cost_b = cost[a], cost[b]
+            for j in range(i + 1, len(order) - 1):
+                c, d = order[j], order[j + 1]
+                # Distances between stops are symmetric, only the two joins change
+                if cost_a[c] + cost_b[d] < cost_a[b] + cost[c][d] - 1e-9:
+                    order[i:j + 1] = reversed(order[i:j + 1])
+                    improved = True
+                    a, b = order[i - 1], order[i]
+                    cost_a, cost_b = cost[a], cost[b]
+            if time.perf_counter() >= deadline:
+                break
+    return order
+
+
+def or_opt(order, cost, deadline):
+    """Move runs of up to OR_OPT_MAX_SEGMENT stops to a better place in the path."""
+    improved = True
+    while improved and time.perf_counter() < deadline:
+        improved = False
+        for length in range(1, OR_OPT_MAX_SEGMENT + 1):
+            i = 1
+            while i + length < len(order):
+                segment = order[i:i + length]
+                prev, nxt = order[i - 1], order[i + length]
+                removed = cost[prev][segment[0]] + cost[segment[-1]][nxt] - cost[prev][nxt]
+                rest = order[:i] + order[i + length:]
+                best_gain, best_at = 1e-9, None
+                for k in range(len(rest) - 1):
+                    a, b = rest[k], rest[k + 1]
+                    gain = removed - (cost[a][segment[0]] + cost[segment[-1]][b] - cost[a][b])
+                    if gain > best_gain:
+                        best_gain, best_at = gain, k
+                if best_at is not None:
+                    order[:] = rest[:best_at + 1] + segment + rest[best_at + 1:]
+                    improved = True
+                i += 1
+                if time.perf_counter() >= deadline:
+                    return order
+    return order
+
+
+def optimize_stop_order(stops, start=None, end=None, time_budget_ms=SEQUENCING_TIME_BUDGET_MS):
+    """
+    Order (lat, lng) stops to shorten the path from start, through every stop,
+    to end, by great-circle distance. A missing start or end leaves that side
+    of the path free. Returns the indices of the stops in visiting order and
+    the path length in km before and after.
+    """
+    if len(stops) < 2:
+        return list(range(len(stops))), 0.0, 0.0
+    points = [start or stops[0]] + list(stops) + [end or stops[0]]
+    return optimize_order(distance_matrices.get(points), start is not None, end is not None, time_budget_ms)
+
+
+def optimize_order(cost, fixed_start=True, fixed_end=True, time_budget_ms=SEQUENCING_TIME_BUDGET_MS):
+    """
+    Order the stops of a cost matrix over [start] + stops + [end], e.g. road
+    distances from the facility matrix, which need not be symmetric.
+
+    Nearest neighbour builds the first order, then 2-opt and Or-opt improve it
+    in turns until neither helps or the time budget runs out. Returns the
+    indices of the stops in visiting order and the path cost before and after.
+    """
+    count = len(cost) - 2
+    if count < 2:
+        return list(range(max(count, 0))), 0.0, 0.0
+    deadline = time.perf_counter() + time_budget_ms / 1000
+
+    cost = [list(row) for row in cost]
+    # A free endpoint is a dummy point at no distance from every stop
+    if not fixed_start:
+        cost[0] = [0.0] * len(cost)
+    if not fixed_end:
+        for row in cost:
+            row[-1] = 0.0
+    # 2-opt reverses stretches of the path, it compares joins on symmetric costs
+    symmetric = all(cost[i][j] == cost[j][i] for i in range(1, count + 1) for j in range(i))
+    reversible = cost if symmetric else [
+        [(a + b) / 2 for a, b in zip(row, column)] for row, column in zip(cost, zip(*cost))]
+    first, last = 0, count + 1
+    inner = list(range(1, count + 1))
+
+    original = path_length([first] + inner + [last], cost)
+    order = nearest_neighbour(cost, first, last, inner)
+    best_order, best = list(order), path_length(order, cost)
+    while time.perf_counter() < deadline:
+        two_opt(order, reversible, deadline)
+        or_opt(order, cost, deadline)
+        length = path_length(order, cost)
+        if length >= best - 1e-9:
+            break
+        best_order, best = list(order), length
+
+    if best > original:
+        return list(range(count)), original, original
+    return [node - 1 for node in best_order[1:-1]], original, best
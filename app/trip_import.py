@@ -0,0 +1,142 @@
+import codecs
+import csv
+import json
+import os
+from sqlalchemy import insert, text
+from sqlalchemy.ext.asyncio import AsyncSession
+from app import models
+
+# Rows validated, geocoded and written per transaction
+TRIP_IMPORT_CHUNK = int(os.getenv("TRIP_IMPORT_CHUNK", "5000"))
+# Row errors listed in the response, the rest are only counted
+TRIP_IMPORT_MAX_ERRORS = int(os.getenv("TRIP_IMPORT_MAX_ERRORS", "1000"))
+# Separator of the stops in the intermediate_destinations column of a CSV file
+CSV_STOP_SEPARATOR = ";"
+
+TRIP_COLUMNS = [
+    "id", "vehicle_id", "driver_id", "source", "destination", "status", "expected_arrival", "next_halt",
+    "safety_info", "tonnage", "source_lat", "source_lng", "destination_lat", "destination_lng", "upvotes", "downvotes",
+]
+STOP_COLUMNS = ["trip_id", "destination", "sequence", "latitude", "longitude"]
+
+
+class RowError(Exception):
+    pass
+
+
+async def iter_lines(chunks):
+    """The lines of a stream of UTF-8 bytes, numbered from 1, without their line endings."""
+    decoder = codecs.getincrementaldecoder("utf-8-sig")(errors="replace")
+    pending = ""
+    number = 0
+    async for chunk in chunks:
+        pending += decoder.decode(chunk)
+        lines = pending.split("\n")
+        pending = lines.pop()
+        for line in lines:
+            number += 1
+            yield number, line.rstrip("\r")
+    pending += decoder.decode(b"", final=True)
+    if pending:
+        yield number + 1, pending.rstrip("\r")
+
+
+async def csv_rows(lines):
+    """
+    The rows of a CSV stream as (line number, dict or RowError), the first
+    row naming the columns. Empty cells are left out, so the defaults apply.
+    Quoted cells may span lines.
+    """
+    header = None
+    record, start, quotes = [], 0, 0
+    async for number, line in lines:
+        if not record:
+            start = number
+        record.append(line)
+        # An odd number of quotes so far means a quoted cell continues on the next line
+        quotes += line.count('"')
+        if quotes % 2:
+            continue
+        values = next(csv.reader(["\n".join(record)]), [])
+        record, quotes = [], 0
+        if not any(value.strip() for value in values):
+            continue
+        if header is None:
+            header = [name.strip() for name in values]
+            continue
+        if len(values) != len(header):
+            yield start, RowError(f"Expected {len(header)} columns, found {len(values)}")
+            continue
+        row = {name: value for name, value in zip(header, values) if value != ""}
+        stops = row.get("intermediate_destinations")
+        if stops is not None:
+            row["intermediate_destinations"] = [
+                stop.strip() for stop in stops.split(CSV_STOP_SEPARATOR) if stop.strip()]
+        yield start, row
+    if record:
+        yield start, RowError("Unterminated quoted cell")
+
+
+async def ndjson_rows(lines):
+    """The rows of a newline-delimited JSON stream as (line number, dict or RowError)."""
+    async for number, line in lines:
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError as e:
+            yield number, RowError(f"Invalid JSON: {e}")
+            continue
+        if not isinstance(row, dict):
+            yield number, RowError("Expected a JSON object")
+            continue
+        yield number, row
+
+
+async def insert_trips(db: AsyncSession, trips, stops):
+    """
+    Insert trips, given as dicts of Trip columns, and the stops of each one,
+    given as dicts of IntermediateDestination columns without trip_id. Uses
+    COPY on Postgres and multi-row INSERTs elsewhere. Returns the trip ids.
+    The caller commits.
+    """
+    if db.bind.dialect.name == "postgresql":
+        # Ids are taken from the sequence up front, so stops can be copied without reading trips back
+        ids = (await db.scalars(
+            text("SELECT nextval(pg_get_serial_sequence('trips', 'id')) FROM generate_series(1, :count)"),
+            {"count": len(trips)},
+        )).all()
+        raw = await (await db.connection()).get_raw_connection()
+        connection = raw.driver_connection
+        await connection.copy_records_to_table("trips", columns=TRIP_COLUMNS, records=[
+            tuple(trip_id if column == "id" else trip_record(trip, column) for column in TRIP_COLUMNS)
+            for trip_id, trip in zip(ids, trips)
+        ])
+        await connection.copy_records_to_table("intermediate_destinations", columns=STOP_COLUMNS, records=[
+            (trip_id, stop["destination"], stop["sequence"], stop.get("latitude"), stop.get("longitude"))
+            for trip_id, trip_stops in zip(ids, stops) for stop in trip_stops
+        ])
+        return ids
+
+    # SQLite gives the rows of the transaction, which holds the write lock,
+    # ascending rowids in insertion order. Sorting them back is much faster
+    # than sort_by_parameter_order, which inserts one row per statement there.
+    # Nulls are rendered, or rows with and without a value go in separate batches
+    ids = sorted((await db.scalars(
+        insert(models.Trip).returning(models.Trip.id),
+        [dict(trip, upvotes=0, downvotes=0) for trip in trips],
+        execution_options={"render_nulls": True},
+    )).all())
+    stop_rows = [dict(stop, trip_id=trip_id) for trip_id, trip_stops in zip(ids, stops) for stop in trip_stops]
+    if stop_rows:
+        await db.execute(
+            insert(models.IntermediateDestination), stop_rows, execution_options={"render_nulls": True})
+    return ids
+
+
+def trip_record(trip, column):
+    if column in ("upvotes", "downvotes"):
+        return 0
+    value = trip.get(column)
+    # The enum is stored by name, as SQLAlchemy does
+    return value.name if column == "status" else value
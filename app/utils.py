@@ -2,14 +2,28 @@ from datetime import datetime, timedelta
 from jose import JWTError, jwt
 from passlib.context import CryptContext
 from app import models
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 from math import radians, sin, cos, sqrt, atan2
+import asyncio
+import json
 import os
-import requests
+import numpy as np
 from dotenv import load_dotenv
+from app.http_client import http_client
 
 load_dotenv()
 MAPMYINDIA_API_KEY = os.getenv("MAPMYINDIA_API_KEY")
+MAPMYINDIA_SYNC_ENABLED = os.getenv(
+    "MAPMYINDIA_SYNC_ENABLED", "false").lower() == "true"
+MAPMYINDIA_API_URL = os.getenv(
+    "MAPMYINDIA_API_URL", "https://apis.mapmyindia.com/advancedmaps/v1")
+ROUTING_API_URL = os.getenv(
+    "ROUTING_API_URL", "https://example-mapping-api.com/route")
+TWILIO_API_URL = os.getenv("TWILIO_API_URL", "https://api.twilio.com/2010-04-01")
+TWILIO_ACCOUNT_SID = os.getenv("TWILIO_ACCOUNT_SID")
+TWILIO_AUTH_TOKEN = os.getenv("TWILIO_AUTH_TOKEN")
+TWILIO_PHONE_NUMBER = os.getenv("TWILIO_PHONE_NUMBER")
 
 SECRET_KEY = os.getenv("SECRET_KEY", "your_secret_key")
 ALGORITHM = "HS256"
@@ -40,36 +54,39 @@ def create_access_token(data: dict, expires_delta: timedelta = None):
     return encoded_jwt
 
 
-def create_geofence(lat, lng, radius):
-    url = f"https://apis.mapmyindia.com/advancedmaps/v1/{
-        MAPMYINDIA_API_KEY}/geofence"
+# Function to push a geofence to MapMyIndia. Fences are evaluated locally, so
+# this only runs when MAPMYINDIA_SYNC_ENABLED is set.
+
+
+async def sync_geofence_to_mapmyindia(geofence: models.Geofence):
+    url = f"{MAPMYINDIA_API_URL}/{MAPMYINDIA_API_KEY}/geofence"
     payload = {
-        "fenceName": f"Geofence_{lat}_{lng}",
-        "centerLat": lat,
-        "centerLng": lng,
-        "radius": radius
+        "fenceName": f"Geofence_{geofence.id}",
+        "centerLat": geofence.latitude,
+        "centerLng": geofence.longitude,
+        "radius": geofence.radius
     }
-    headers = {"Content-Type": "application/json"}
-    response = requests.post(url, json=payload, headers=headers)
+    if geofence.shape == "polygon":
+        payload["polygon"] = json.loads(geofence.polygon)
+    response = await http_client.post(url, json=payload)
 
     if response.status_code != 200:
         raise Exception(f"Error creating geofence: {response.text}")
 
     return response.json()
 
-# Function to check if a point is within a geofence
+# Function to check if a point is within a geofence, evaluated in-process
 
 
-def check_geofence(lat, lng, geofence_id):
-    url = f"https://apis.mapmyindia.com/advancedmaps/v1/{
-        MAPMYINDIA_API_KEY}/geofence/check"
-    payload = {"lat": lat, "lng": lng, "geofenceId": geofence_id}
-    response = requests.post(url, json=payload)
+def check_geofence(lat, lng, geofence: models.Geofence):
+    from app.geometry import as_polygon, distances_outside
 
-    if response.status_code != 200:
-        raise Exception(f"Error checking geofence: {response.text}")
-
-    return response.json()
+    polygon = None
+    if geofence.shape == "polygon":
+        polygon = as_polygon(json.loads(geofence.polygon))
+    outside = distances_outside(
+        [lat], [lng], geofence.latitude, geofence.longitude, geofence.radius, polygon)
+    return bool(outside[0] == 0)
 
 # Function to save a notification to the database
 
@@ -104,23 +121,76 @@ def calculate_distance(lat1, lon1, lat2, lon2):
     distance = R * c  
     return distance
 
+# Vectorized haversine: distance from one point to every point in the arrays
+
+
+def calculate_distances(lat, lon, lats, lons):
+    R = 6371.0  # Earth radius in kilometers
+
+    lat1_rad = np.radians(lat)
+    lats_rad = np.radians(np.asarray(lats, dtype=np.float64))
+    dlon = np.radians(np.asarray(lons, dtype=np.float64)) - np.radians(lon)
+    dlat = lats_rad - lat1_rad
+
+    a = np.sin(dlat / 2)**2 + np.cos(lat1_rad) * \
+        np.cos(lats_rad) * np.sin(dlon / 2)**2
+    return R * 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+
+# Vectorized haversine: N x M matrix of distances between two sets of points
+
+
+def calculate_distance_matrix(lats1, lons1, lats2, lons2):
+    R = 6371.0  # Earth radius in kilometers
+
+    lats1_rad = np.radians(np.asarray(lats1, dtype=np.float64))[:, None]
+    lons1_rad = np.radians(np.asarray(lons1, dtype=np.float64))[:, None]
+    lats2_rad = np.radians(np.asarray(lats2, dtype=np.float64))[None, :]
+    lons2_rad = np.radians(np.asarray(lons2, dtype=np.float64))[None, :]
+
+    # Computed in place, so at most two N x M arrays are alive at once
+    a = lats2_rad - lats1_rad
+    a *= 0.5
+    np.sin(a, out=a)
+    a *= a
+    b = lons2_rad - lons1_rad
+    b *= 0.5
+    np.sin(b, out=b)
+    b *= b
+    b *= np.cos(lats1_rad)
+    b *= np.cos(lats2_rad)
+    a += b
+
+    # 2 * atan2(sqrt(a), sqrt(1 - a)) == 2 * asin(sqrt(a)) for 0 <= a <= 1
+    np.clip(a, 0.0, 1.0, out=a)
+    np.sqrt(a, out=a)
+    np.arcsin(a, out=a)
+    a *= 2 * R
+    return a
+
 
 active_connections = {}
 
 
-def save_flash_notification(user_id: int, message: str, db: Session):
+def save_flash_notification(user_id: int, message: str, db: AsyncSession):
+    """Store a notification for a user who is not connected, the caller commits."""
     flash_notification = models.Notification(
-        user_id=user_id,
+        driver_id=user_id,
         message=message,
         timestamp=datetime.utcnow()
     )
     db.add(flash_notification)
-    db.commit()
     print(f"Flash notification saved for user {user_id}: {message}")
 
 
-def get_best_route_from_api(start_location, end_location, waypoints=None):
-    api_url = "https://example-mapping-api.com/route"  # Replace with your API endpoint
+async def get_best_route_from_api(start_location, end_location, waypoints=None):
+    from app.routing import ROAD_GRAPH_PATH, route_locally
+
+    # Stops given as coordinates are routed on the local road graph when there is one
+    if ROAD_GRAPH_PATH:
+        route = await asyncio.to_thread(route_locally, start_location, end_location, waypoints)
+        if route:
+            return route
+
     params = {
         "start": start_location,
         "end": end_location,
@@ -129,7 +199,7 @@ def get_best_route_from_api(start_location, end_location, waypoints=None):
         "avoid": "tolls",
     }
     try:
-        response = requests.get(api_url, params=params)
+        response = await http_client.get(ROUTING_API_URL, params=params)
         response.raise_for_status()
         route_data = response.json()
 
@@ -143,15 +213,19 @@ def get_best_route_from_api(start_location, end_location, waypoints=None):
         return None
 
 
-def notify_admin_of_delay_report(driver_id: int, delay_report: models.DelayReport, db: Session):
-    admin = db.query(models.User).filter(models.User.role == "admin").first()
-    if admin:
-        message = f"Driver {driver_id} has submitted a delay report: {
-            delay_report.reason}. Details: {delay_report.custom_message}"
-        send_flash_notification(admin.id, message, db)
+async def send_sms(to: str, body: str):
+    """Send a text message through Twilio's REST API."""
+    response = await http_client.post(
+        f"{TWILIO_API_URL}/Accounts/{TWILIO_ACCOUNT_SID}/Messages.json",
+        data={"To": to, "From": TWILIO_PHONE_NUMBER, "Body": body},
+        auth=(TWILIO_ACCOUNT_SID or "", TWILIO_AUTH_TOKEN or ""),
+    )
+    if response.status_code >= 400:
+        raise Exception(f"Error sending SMS: {response.text}")
+    return response.json()
 
 
-async def send_flash_notification(user_id: int, message: str, db: Session):
+async def send_flash_notification(user_id: int, message: str, db: AsyncSession):
     websocket = active_connections.get(user_id)
     if websocket:
         try:
@@ -163,20 +237,3 @@ async def send_flash_notification(user_id: int, message: str, db: Session):
                   user_id}: {e}")
     else:
         save_flash_notification(user_id, message, db)
-
-
-def send_geofence_alert(driver_id: int, geofence: models.Geofence, db: Session):
-    user = db.query(models.User).filter(models.User.id == driver_id).first()
-    if user:
-        message = f"Geofence breach detected near {
-            geofence.latitude}, {geofence.longitude}. Please check."
-        send_flash_notification(driver_id, message, db)
-        notification = models.Notification(
-            user_id=driver_id,
-            message=message,
-            timestamp=datetime.now()
-        )
-        db.add(notification)
-        db.commit()
-
-
@@ -0,0 +1,11 @@
+import os
+import tempfile
+
+# The app reads its configuration at import time, so it is set before any
+# test imports it. Tests run against a throwaway SQLite database.
+_scratch = tempfile.mkdtemp(prefix="drivelogix-tests-")
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{_scratch}/test.db")
+os.environ.setdefault("FACILITY_MATRIX_DIR", os.path.join(_scratch, "facility_matrix"))
+os.environ.setdefault("REDIS_PORT", "6379")
+os.environ.setdefault("REDIS_PORT_NOTIFICATION", "6379")
+os.environ.setdefault("SECRET_KEY", "test-secret")
@@ -0,0 +1,44 @@
+from types import SimpleNamespace
+from app import models
+from app.corridor import TripCorridorCache
+from app.db import SessionLocal, engine
+from app.spatial import GeofenceIndex
+
+PATH = [[12.90, 77.60], [12.90, 77.70]]
+
+
+def fence(radius):
+    return SimpleNamespace(
+        id=1, latitude=12.90, longitude=77.65, radius=radius, time_limit_minutes=10,
+        shape="circle", polygon=None, valid_from=None, valid_until=None)
+
+
+def test_corridors_follow_geofence_index_rebuilds():
+    models.Base.metadata.create_all(engine)
+    db = SessionLocal()
+    trip = models.Trip(
+        driver_id=7, source="Depot", destination="Customer", tonnage=1,
+        status=models.TripStatus.IN_ROUTE, route_details={"path": PATH}, corridor_geofence_ids=[1])
+    db.add(trip)
+    db.commit()
+    try:
+
+        index = GeofenceIndex()
+        index.build([fence(0.5)])
+        corridors = TripCorridorCache(index=index, ttl_seconds=3600)
+        corridors.ensure_loaded(db)
+        assert [f.radius for f, _ in corridors.nearby(7, 12.90, 77.65)] == [0.5]
+
+        # Edited within the TTL: the corridor must not keep the old fence entry
+        index.build([fence(2.0)])
+        corridors.ensure_loaded(db)
+        assert [f.radius for f, _ in corridors.nearby(7, 12.90, 77.65)] == [2.0]
+
+        # Expired: the fence is gone from the index, so from the corridor too
+        index.build([])
+        corridors.ensure_loaded(db)
+        assert corridors.nearby(7, 12.90, 77.65) == []
+    finally:
+        db.delete(trip)
+        db.commit()
+        db.close()
@@ -0,0 +1,47 @@
+import math
+import numpy as np
+import pytest
+from app.utils import calculate_distance, calculate_distance_matrix, calculate_distances
+
+EARTH_HALF_CIRCUMFERENCE_KM = math.pi * 6371.0
+
+
+def random_points(rng, count):
+    return rng.uniform(-90, 90, count), rng.uniform(-180, 180, count)
+
+
+def test_distances_match_scalar_on_random_points():
+    rng = np.random.default_rng(0)
+    lats, lngs = random_points(rng, 500)
+    for lat, lng in zip(*random_points(rng, 20)):
+        expected = [calculate_distance(lat, lng, other_lat, other_lng) for other_lat, other_lng in zip(lats, lngs)]
+        np.testing.assert_allclose(calculate_distances(lat, lng, lats, lngs), expected, rtol=1e-9, atol=1e-9)
+
+
+def test_distance_matrix_matches_scalar_on_random_points():
+    rng = np.random.default_rng(1)
+    lats1, lngs1 = random_points(rng, 40)
+    lats2, lngs2 = random_points(rng, 60)
+    expected = [
+        [calculate_distance(lat1, lng1, lat2, lng2) for lat2, lng2 in zip(lats2, lngs2)]
+        for lat1, lng1 in zip(lats1, lngs1)
+    ]
+    matrix = calculate_distance_matrix(lats1, lngs1, lats2, lngs2)
+    assert matrix.shape == (40, 60)
+    np.testing.assert_allclose(matrix, expected, rtol=1e-9, atol=1e-9)
+
+
+@pytest.mark.parametrize("lat, lng", [(0.0, 0.0), (12.9716, 77.5946), (-33.8688, 151.2093), (90.0, 0.0)])
+def test_zero_distance(lat, lng):
+    assert calculate_distance(lat, lng, lat, lng) == 0.0
+    assert calculate_distances(lat, lng, [lat], [lng])[0] == 0.0
+    assert calculate_distance_matrix([lat], [lng], [lat], [lng])[0, 0] == 0.0
+
+
+@pytest.mark.parametrize("lat, lng", [(0.0, 0.0), (12.9716, 77.5946), (-33.8688, 151.2093), (90.0, 0.0)])
+def test_antipodal_points(lat, lng):
+    other_lat, other_lng = -lat, lng - 180.0
+    scalar = calculate_distance(lat, lng, other_lat, other_lng)
+    assert scalar == pytest.approx(EARTH_HALF_CIRCUMFERENCE_KM)
+    assert calculate_distances(lat, lng, [other_lat], [other_lng])[0] == pytest.approx(scalar)
+    assert calculate_distance_matrix([lat], [lng], [other_lat], [other_lng])[0, 0] == pytest.approx(scalar)
@@ -0,0 +1,156 @@
+import asyncio
+import httpx
+import pytest
+from app import http_client as module
+from app.http_client import CircuitBreaker, CircuitOpenError, OutboundClient
+
+URL = "http://provider.test/route"
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(module.time, "monotonic", clock)
+    return clock
+
+
+@pytest.fixture
+def backoffs(monkeypatch):
+    """Upper bounds of the jittered backoffs, which are not actually slept."""
+    bounds = []
+
+    def uniform(low, high):
+        bounds.append(high)
+        return 0
+    monkeypatch.setattr(module.random, "uniform", uniform)
+    return bounds
+
+
+def outbound(handler, **kwargs):
+    calls = []
+
+    def record(request):
+        calls.append(request)
+        return handler(request)
+    return OutboundClient(transport=httpx.MockTransport(record), **kwargs), calls
+
+
+def status(code):
+    return lambda request: httpx.Response(code)
+
+
+def test_retries_idempotent_requests_with_backoff(backoffs):
+    async def run():
+        client, calls = outbound(status(503), retries=2, backoff_seconds=0.2)
+        response = await client.get(URL)
+        await client.close()
+        return response, calls
+
+    response, calls = asyncio.run(run())
+    assert response.status_code == 503
+    assert len(calls) == 3
+    assert backoffs == pytest.approx([0.4, 0.8])
+
+
+def test_does_not_retry_requests_that_may_have_been_sent(backoffs):
+    def timeout(request):
+        raise httpx.ReadTimeout("timed out", request=request)
+
+    async def run():
+        client, failed = outbound(status(503))
+        assert (await client.post(URL)).status_code == 503
+        client, timed_out = outbound(timeout)
+        with pytest.raises(httpx.ReadTimeout):
+            await client.post(URL)
+        client, not_found = outbound(status(404))
+        assert (await client.get(URL)).status_code == 404
+        return failed, timed_out, not_found
+
+    failed, timed_out, not_found = asyncio.run(run())
+    assert len(failed) == len(timed_out) == len(not_found) == 1
+    assert backoffs == []
+
+
+def test_retries_requests_that_never_reached_the_server(backoffs):
+    def refuse(request):
+        raise httpx.ConnectError("connection refused", request=request)
+
+    async def run():
+        client, calls = outbound(refuse, retries=2)
+        with pytest.raises(httpx.ConnectError):
+            await client.post(URL)
+        return calls
+
+    assert len(asyncio.run(run())) == 3
+
+
+def test_circuit_opens_and_lets_one_trial_through(clock, backoffs):
+    responses = iter([500, 500, 500, 200])
+
+    async def run():
+        client, calls = outbound(lambda request: httpx.Response(next(responses)), retries=0)
+        breaker = client._breakers["provider.test"] = CircuitBreaker(failure_threshold=2, reset_seconds=30)
+
+        for _ in range(2):
+            assert (await client.get(URL)).status_code == 500
+        assert breaker.state == "open"
+        with pytest.raises(CircuitOpenError):
+            await client.get(URL)
+        assert len(calls) == 2
+
+        # After the reset time one trial goes through; it fails and reopens the circuit
+        clock.now += 30
+        assert breaker.state == "half-open"
+        assert (await client.get(URL)).status_code == 500
+        assert breaker.state == "open"
+        with pytest.raises(CircuitOpenError):
+            await client.get(URL)
+
+        # A successful trial closes it
+        clock.now += 30
+        assert (await client.get(URL)).status_code == 200
+        assert breaker.state == "closed"
+        return calls
+
+    assert len(asyncio.run(run())) == 4
+
+
+def test_half_open_circuit_allows_a_single_trial(clock):
+    breaker = CircuitBreaker(failure_threshold=1, reset_seconds=30)
+    breaker.record_failure()
+    clock.now += 30
+    assert breaker.allow()
+    assert not breaker.allow()
+    # A trial that never reports back is replaced after another reset time
+    clock.now += 30
+    assert breaker.allow()
+
+
+def test_limits_concurrent_requests_per_host():
+    in_flight = {}
+    peak = {}
+
+    async def handler(request):
+        host = request.url.host
+        in_flight[host] = in_flight.get(host, 0) + 1
+        peak[host] = max(peak.get(host, 0), in_flight[host])
+        await asyncio.sleep(0.01)
+        in_flight[host] -= 1
+        return httpx.Response(200)
+
+    async def run():
+        client = OutboundClient(transport=httpx.MockTransport(handler), per_host_concurrency=2)
+        await asyncio.gather(*(
+            client.get(f"http://{host}/") for host in ["a.test", "b.test"] for _ in range(6)))
+        await client.close()
+
+    asyncio.run(run())
+    assert peak == {"a.test": 2, "b.test": 2}
@@ -0,0 +1,57 @@
+from datetime import datetime, timedelta
+import pytest
+from sqlalchemy.exc import OperationalError
+from app import location_history as history
+from app.db import SessionLocal, engine
+from app.location_store import Position
+from app.models import Base, DriverLocationHistory
+
+
+@pytest.fixture
+def db():
+    Base.metadata.create_all(engine)
+    session = SessionLocal()
+    session.query(DriverLocationHistory).delete()
+    session.commit()
+    yield session
+    session.close()
+
+
+def fixes(count, start=datetime(2026, 1, 1)):
+    return [Position(1, 12.9, 77.6, start + timedelta(seconds=i)) for i in range(count)]
+
+
+def test_rows_that_cannot_be_stored_are_dropped_alone(db):
+    writer = history.LocationHistoryWriter(batch_size=100)
+    batch = fixes(250)
+    # A NULL latitude violates the NOT NULL constraint, like a fix without a partition
+    bad = {3, 120, 249}
+    writer.append([p._replace(latitude=None) if i in bad else p for i, p in enumerate(batch)])
+
+    assert writer.flush(db) == 247
+    assert writer.pending_count() == 0
+    assert db.query(DriverLocationHistory).count() == 247
+
+
+def test_failed_batch_is_kept_when_the_database_is_unavailable(db, monkeypatch):
+    writer = history.LocationHistoryWriter(batch_size=100)
+    writer.append(fixes(150))
+
+    def unavailable(db, positions):
+        raise OperationalError("INSERT", {}, Exception("connection refused"))
+
+    monkeypatch.setattr(history, "insert_history", unavailable)
+    with pytest.raises(OperationalError):
+        writer.flush(db)
+    assert writer.pending_count() == 150
+
+    monkeypatch.undo()
+    assert writer.flush(db) == 150
+    assert db.query(DriverLocationHistory).count() == 150
+
+
+def test_timestamp_window():
+    now = datetime(2026, 10, 19, 12)
+    oldest, newest = history.timestamp_window(now)
+    assert oldest == now - timedelta(days=history.LOCATION_HISTORY_RETENTION_DAYS)
+    assert newest == now + timedelta(seconds=history.LOCATION_MAX_CLOCK_SKEW_SECONDS)
@@ -0,0 +1,57 @@
+import asyncio
+from sqlalchemy import create_engine, select, update
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.orm import Session
+from app.models import Base, Vehicle
+from app.replicas import Replica, ReplicaSet, RoutingSession
+
+
+def create_database(path, vehicle_number):
+    """A SQLite database holding one vehicle, so reads show which database answered."""
+    engine = create_engine(f"sqlite:///{path}")
+    Base.metadata.create_all(engine)
+    with Session(engine) as db:
+        db.add(Vehicle(vehicle_number=vehicle_number, total_tonnage=10, remaining_tonnage=10))
+        db.commit()
+    engine.dispose()
+    return create_async_engine(f"sqlite+aiosqlite:///{path}")
+
+
+async def vehicle_numbers(db):
+    return sorted(await db.scalars(select(Vehicle.vehicle_number)))
+
+
+async def route_session(tmp_path):
+    primary = create_database(tmp_path / "primary.db", "KA-primary")
+    replica = Replica("replica", create_database(tmp_path / "replica.db", "KA-replica"))
+    replicas = ReplicaSet([replica])
+    sessions = async_sessionmaker(
+        primary, class_=AsyncSession, sync_session_class=RoutingSession, replicas=replicas,
+        expire_on_commit=False)
+    try:
+        async with sessions() as db:
+            # Reads go to the replica
+            assert await vehicle_numbers(db) == ["KA-replica"]
+            # Writes go to the primary, and the session's later reads follow them
+            db.add(Vehicle(vehicle_number="KA-new", total_tonnage=5, remaining_tonnage=5))
+            await db.flush()
+            assert await vehicle_numbers(db) == ["KA-new", "KA-primary"]
+            await db.commit()
+
+        async with sessions() as db:
+            assert await vehicle_numbers(db) == ["KA-replica"]
+            # Bulk updates count as writes too
+            await db.execute(update(Vehicle).values(remaining_tonnage=1))
+            assert await vehicle_numbers(db) == ["KA-new", "KA-primary"]
+            await db.commit()
+
+        async with sessions() as db:
+            assert set(await db.scalars(select(Vehicle.remaining_tonnage))) == {10}
+        assert replica.picks == 3
+    finally:
+        await primary.dispose()
+        await replicas.stop()
+
+
+def test_routing_session_reads_replica_until_it_writes(tmp_path):
+    asyncio.run(route_session(tmp_path))
@@ -0,0 +1,47 @@
+from datetime import datetime, timedelta
+import pytest
+from app.db import SessionLocal, engine
+from app.models import Base, ScheduledTimer
+from app.scheduler import TimerScheduler
+
+
+@pytest.fixture
+def db():
+    Base.metadata.create_all(engine)
+    session = SessionLocal()
+    session.query(ScheduledTimer).delete()
+    session.commit()
+    yield session
+    session.close()
+
+
+@pytest.fixture
+def scheduler():
+    scheduler = TimerScheduler(lookahead_seconds=60)
+    scheduler.fired = []
+    scheduler.register("test", lambda db, timers: scheduler.fired.extend(t.key for t in timers))
+    return scheduler
+
+
+def test_timer_moved_later_does_not_fire_at_the_old_time(db, scheduler):
+    now = datetime.utcnow()
+    scheduler.schedule(db, "test", "a", now - timedelta(seconds=1))
+    scheduler.claim(db)
+    scheduler.schedule(db, "test", "a", now + timedelta(seconds=30))
+    scheduler.claim(db)
+
+    assert scheduler.fire_due(db) == 0
+    assert scheduler.fired == []
+    assert db.query(ScheduledTimer).count() == 1
+
+
+def test_timer_moved_earlier_fires_at_the_new_time(db, scheduler):
+    now = datetime.utcnow()
+    scheduler.schedule(db, "test", "a", now + timedelta(seconds=30))
+    scheduler.claim(db)
+    scheduler.schedule(db, "test", "a", now - timedelta(seconds=1))
+    scheduler.claim(db)
+
+    assert scheduler.fire_due(db) == 1
+    assert scheduler.fired == ["a"]
+    assert db.query(ScheduledTimer).count() == 0
@@ -0,0 +1,59 @@
+import asyncio
+import httpx
+from sqlalchemy import event
+from app import models
+from app.db import AsyncSessionLocal, async_engine, engine
+from app.main import app
+
+STOPS_PER_TRIP = 3
+
+
+async def add_vehicle_with_trips(count):
+    async with AsyncSessionLocal() as db:
+        vehicle = models.Vehicle(vehicle_number=f"KA-{count}", total_tonnage=10, remaining_tonnage=10)
+        db.add(vehicle)
+        await db.flush()
+        for i in range(count):
+            trip = models.Trip(
+                vehicle_id=vehicle.id, source="Depot", destination=f"Customer {i}",
+                tonnage=1, status=models.TripStatus.PENDING)
+            trip.intermediate_destinations = [
+                models.IntermediateDestination(destination=f"Stop {n}", sequence=n)
+                for n in range(1, STOPS_PER_TRIP + 1)
+            ]
+            db.add(trip)
+        await db.commit()
+        return vehicle.id
+
+
+async def count_get_trips_queries(counts):
+    """Statements issued by GET /trips/{vehicle_id} for a vehicle with each number of trips."""
+    statements = []
+
+    def count_statement(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    vehicle_ids = {count: await add_vehicle_with_trips(count) for count in counts}
+    event.listen(async_engine.sync_engine, "before_cursor_execute", count_statement)
+    try:
+        queries = {}
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+            for count, vehicle_id in vehicle_ids.items():
+                statements.clear()
+                response = await client.get(f"/trips/{vehicle_id}", params={"limit": 1000})
+                assert response.status_code == 200
+                trips = response.json()
+                assert len(trips) == count
+                assert all(len(trip["intermediate_destinations"]) == STOPS_PER_TRIP for trip in trips)
+                queries[count] = len(statements)
+        return queries
+    finally:
+        event.remove(async_engine.sync_engine, "before_cursor_execute", count_statement)
+        await async_engine.dispose()
+
+
+def test_get_trips_query_count_does_not_grow_with_trips():
+    models.Base.metadata.create_all(engine)
+    queries = asyncio.run(count_get_trips_queries([5, 50]))
+    # One query for the page of trips and one for the stops of the whole page
+    assert queries[5] == queries[50] == 2